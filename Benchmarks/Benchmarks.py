@@ -0,0 +1,292 @@
+import argparse
+import json
+import platform
+import subprocess
+import tracemalloc
+from datetime import datetime, timedelta
+from statistics import median
+from threading import Timer
+from time import perf_counter
+
+import backtrader as bt
+from backtrader import Cerebro, TimeFrame, date2num
+
+# Для импортирования QKStore
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parents[2]))
+
+from BackTraderQuik.QKStore import QKStore  # Хранилище QUIK
+from BackTraderQuik.QKSimulator import QKSimulator  # Симулятор QUIK
+from BackTraderQuik.QKBroker import QKBroker  # Брокер QUIK
+
+# Замеры скорости загрузки истории, задержки новых баров, постановки заявок и запросов брокера на симуляторе QUIK
+# Результаты пишутся в JSON файл папки Results. Сравнение с прошлыми результатами: --compare <Файл результатов>
+start_dt = datetime(2024, 1, 10, 10, 0)  # Дата/время первой свечи
+
+
+def make_candles(count, seed=0):
+    """Минутные свечи внутри торговой сессии (10:00-18:20) для симулятора"""
+    candles, price = [], 100.0 + seed % 100
+    for i in range(count):
+        day, minute = divmod(i, 500)  # 500 минутных свечей в день
+        dt = start_dt + timedelta(days=day, minutes=minute)
+        open_price = price
+        price = max(price + (i * 7919 + seed) % 21 / 100 - 0.1, 1)  # Детерминированное движение цены
+        candles.append((dt, open_price, max(open_price, price) + 0.05, min(open_price, price) - 0.05, price, 100))
+    return candles
+
+
+def new_store(**kwargs):
+    """Новое хранилище. Хранилище - singleton, поэтому для каждого замера сбрасываем созданное"""
+    QKStore._singleton = None
+    return QKStore(clock_period=0, symbol_classes=('TQBR', 'SPBFUT'), **kwargs)
+
+
+def percentiles(values):
+    """Медиана, 99-й перцентиль и максимум в миллисекундах"""
+    values = sorted(values)
+    if not values:
+        return {'p50_ms': None, 'p99_ms': None, 'max_ms': None}
+    return {'p50_ms': median(values) * 1000,
+            'p99_ms': values[min(int(len(values) * 0.99), len(values) - 1)] * 1000,
+            'max_ms': values[-1] * 1000}
+
+
+class Idle(bt.Strategy):
+    """Торговая система без действий для замера загрузки истории"""
+    def next(self):
+        pass
+
+
+def bench_history(tickers, bars, latency):
+    """Скорость загрузки истории: бары в секунду и пиковая память
+
+    :param int tickers: Кол-во тикеров
+    :param int bars: Кол-во баров каждого тикера
+    :param float latency: Задержка запросов симулятора в секундах
+    """
+    def run():
+        sim = QKSimulator(latency=latency)
+        for i in range(tickers):
+            sim.add_candles('TQBR', f'T{i:04}', 1, make_candles(bars, i))
+        store = new_store(provider=sim)
+        cerebro = Cerebro(stdstats=False)
+        for i in range(tickers):
+            cerebro.adddata(store.getdata(dataname=f'TQBR.T{i:04}', timeframe=TimeFrame.Minutes, compression=1))
+        cerebro.addstrategy(Idle)
+        start = perf_counter()
+        cerebro.run()
+        return perf_counter() - start
+
+    elapsed = run()
+    tracemalloc.start()  # Память замеряем отдельным запуском, т.к. трассировка замедляет загрузку
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'params': {'tickers': tickers, 'bars': bars}, 'seconds': elapsed,
+            'bars_per_second': tickers * bars / elapsed, 'peak_memory_mb': peak / 2 ** 20}
+
+
+class TimedSimulator(QKSimulator):
+    """Симулятор, запоминающий время отправки новых баров"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = {}  # Время отправки. (Код тикера, Дата/время бара BackTrader) -> Время
+
+    def callback(self, cmd, data, delay=0.0):
+        if cmd == 'OnNewCandle':
+            self.sent[(data['sec'], date2num(self.candle_datetime(data)))] = perf_counter()
+        super().callback(cmd, data, delay)
+
+
+class LiveLatency(bt.Strategy):
+    """Задержка от прихода нового бара в QUIK до next"""
+    params = (('sim', None), ('expected', 0))
+
+    def __init__(self):
+        self.latencies = []
+        self.last = {}  # Дата/время последнего замеренного бара по тикеру
+
+    def next(self):
+        now = perf_counter()
+        for data in self.datas:
+            if self.last.get(data._name) == data.datetime[0]:  # Если бар тикера уже замерен
+                continue
+            self.last[data._name] = data.datetime[0]
+            sent = self.p.sim.sent.get((data._name.split('.')[1], data.datetime[0]))
+            if sent is not None:  # Замеряем только новые бары
+                self.latencies.append(now - sent)
+        if len(self.latencies) >= self.p.expected:
+            self.env.runstop()
+
+
+def bench_live(tickers, live_bars, bar_period, latency):
+    """Задержка от прихода нового бара в QUIK до next торговой системы
+
+    :param int tickers: Кол-во тикеров
+    :param int live_bars: Кол-во новых баров каждого тикера
+    :param float bar_period: Период новых баров в секундах
+    :param float latency: Задержка запросов симулятора в секундах
+    """
+    sim = TimedSimulator(live_bars=live_bars, bar_period=bar_period, latency=latency)
+    for i in range(tickers):
+        sim.add_candles('TQBR', f'T{i:04}', 1, make_candles(500 + live_bars, i))
+    store = new_store(provider=sim)
+    cerebro = Cerebro(stdstats=False)
+    for i in range(tickers):
+        cerebro.adddata(store.getdata(dataname=f'TQBR.T{i:04}', timeframe=TimeFrame.Minutes, compression=1, live=True))
+    cerebro.addstrategy(LiveLatency, sim=sim, expected=tickers * live_bars)
+    timer = Timer(live_bars * bar_period + 5, cerebro.runstop)  # Если не все бары дошли
+    timer.start()
+    strategy = cerebro.run()[0]
+    timer.cancel()
+    sim.close_connection()
+    return {'params': {'tickers': tickers, 'live_bars': live_bars}, 'received': len(strategy.latencies), **percentiles(strategy.latencies)}
+
+
+class TimedBroker(QKBroker):
+    """Брокер, запоминающий время обработки сделок"""
+    def __init__(self, store, **kwargs):
+        super().__init__(store, **kwargs)
+        self.filled = []  # Время окончания обработки каждой сделки
+
+    def on_trade(self, data):
+        super().on_trade(data)
+        self.filled.append(perf_counter())
+
+
+class RoundTrip(bt.Strategy):
+    """Время от заявки по рынку до обработки ее сделки брокером. Покупка и продажа по очереди на каждом новом баре"""
+    params = (('orders', 0),)
+
+    def __init__(self):
+        self.order = None  # Заявка в работе
+        self.sent = []  # Время отправки каждой заявки
+
+    def notify_order(self, order):
+        if order.status == order.Completed:
+            self.order = None
+            if len(self.sent) >= self.p.orders:
+                self.env.runstop()
+
+    def next(self):
+        if self.data._laststatus != self.data.LIVE or self.order:
+            return
+        self.sent.append(perf_counter())
+        self.order = self.buy(size=1) if not self.position else self.sell(size=1)
+
+
+def bench_orders(orders, bar_period, latency):
+    """Время заявки по рынку от buy/sell до обработки сделки брокером и стоимость обработки OnTransReply/OnTrade
+
+    :param int orders: Кол-во заявок
+    :param float bar_period: Период новых баров в секундах
+    :param float latency: Задержка запросов симулятора в секундах
+    """
+    live_bars = orders * 10  # Новых баров с запасом. Следующая заявка ставится на новом баре после исполнения предыдущей
+    sim = QKSimulator(live_bars=live_bars, bar_period=bar_period, latency=latency)
+    sim.add_candles('SPBFUT', 'SiZ4', 1, make_candles(500 + live_bars))
+    store = new_store(provider=sim, metrics=True)
+    cerebro = Cerebro(stdstats=False)
+    broker = TimedBroker(store, use_positions=False)
+    cerebro.setbroker(broker)
+    cerebro.adddata(store.getdata(dataname='SPBFUT.SiZ4', timeframe=TimeFrame.Minutes, compression=1, live=True))
+    cerebro.addstrategy(RoundTrip, orders=orders)
+    timer = Timer(live_bars * bar_period + 5, cerebro.runstop)  # Если не все заявки исполнились
+    timer.start()
+    strategy = cerebro.run()[0]
+    timer.cancel()
+    sim.close_connection()
+    latencies = [filled - sent for sent, filled in zip(strategy.sent, broker.filled)]
+    histograms = store.metrics.snapshot()['histograms']
+    callbacks = {}
+    for callback in ('OnTransReply', 'OnTrade'):
+        histogram = histograms.get(('qk_callback_seconds', (('callback', callback),)))
+        callbacks[f'{callback}_mean_ms'] = histogram['sum'] / histogram['count'] * 1000 if histogram else None
+    return {'params': {'orders': orders}, 'filled': len(latencies), **percentiles(latencies), **callbacks}
+
+
+def bench_account(calls, positions, is_futures, latency):
+    """Стоимость getcash/getvalue брокера: время и кол-во запросов в QUIK на вызов
+
+    :param int calls: Кол-во вызовов
+    :param int positions: Кол-во открытых позиций
+    :param bool is_futures: Фьючерсный счет
+    :param float latency: Задержка запросов симулятора в секундах
+    """
+    class_code, firm_id = ('SPBFUT', 'SPBFUT') if is_futures else ('TQBR', 'MC0003')
+    sim = QKSimulator(latency=latency, firm_id=firm_id)
+    for i in range(positions):
+        sim.add_candles(class_code, f'T{i:04}', 1, make_candles(10, i))
+        sim.positions[(class_code, f'T{i:04}')] = [i + 1, 100.0]
+    store = new_store(provider=sim, metrics=True)
+    broker = store.getbroker(FirmId=firm_id, IsFutures=is_futures)
+    broker.start()
+    result = {'params': {'positions': positions, 'futures': is_futures}}
+    for name in ('getcash', 'getvalue'):
+        method = getattr(broker, name)
+        requests = sum(histogram['count'] for histogram in store.metrics.snapshot()['histograms'].values())
+        start = perf_counter()
+        for _ in range(calls):
+            method()
+        result[f'{name}_us'] = (perf_counter() - start) / calls * 1_000_000
+        result[f'{name}_requests'] = (sum(histogram['count'] for histogram in store.metrics.snapshot()['histograms'].values()) - requests) / calls
+    broker.stop()
+    sim.close_connection()
+    return result
+
+
+def version():
+    """Версия кода: git describe или None, если это не репозиторий git"""
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    """Изменение результатов относительно файла прошлых результатов"""
+    with open(path, encoding='utf-8') as f:
+        previous = json.load(f)
+    print(f'Сравнение с {path} ({previous.get("version")})')
+    for name, runs in results['results'].items():
+        # Запуски сопоставляем по условиям замера
+        previous_runs = {json.dumps(run['params'], sort_keys=True): run for run in previous['results'].get(name, [])}
+        for run in runs:
+            previous_run = previous_runs.get(json.dumps(run['params'], sort_keys=True), {})
+            for key, value in run.items():
+                old = previous_run.get(key)
+                if isinstance(value, float) and isinstance(old, (int, float)) and old:
+                    print(f'{name} {run["params"]} {key}: {old:.4g} -> {value:.4g} ({(value - old) / old:+.1%})')
+
+
+if __name__ == '__main__':  # Точка входа при запуске этого скрипта
+    parser = argparse.ArgumentParser(description='Замеры BackTraderQuik на симуляторе QUIK')
+    parser.add_argument('--tickers', default='1,10,100,500', help='Кол-во тикеров загрузки истории через запятую')
+    parser.add_argument('--bars', type=int, default=1000, help='Кол-во баров истории каждого тикера')
+    parser.add_argument('--latency', type=float, default=0.001, help='Задержка запросов симулятора в секундах')
+    parser.add_argument('--output', default=None, help='Файл результатов. По умолчанию, Results/<Дата/время>.json')
+    parser.add_argument('--compare', default=None, help='Файл прошлых результатов для сравнения')
+    args = parser.parse_args()
+
+    results = {'version': version(), 'time': datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'backtrader': bt.__version__, 'platform': platform.platform(),
+               'latency': args.latency, 'results': {}}
+    results['results']['history'] = [bench_history(int(tickers), args.bars, args.latency) for tickers in args.tickers.split(',')]
+    results['results']['live'] = [bench_live(tickers, 20, 0.05, args.latency) for tickers in (1, 10)]
+    results['results']['orders'] = [bench_orders(20, 0.05, args.latency)]
+    results['results']['account'] = [bench_account(1000, positions, is_futures, args.latency)
+                                      for is_futures in (True, False) for positions in (1, 10)]
+    for name, runs in results['results'].items():
+        for run in runs:
+            print(name, run)
+
+    output = Path(args.output) if args.output else Path(__file__).parent / 'Results' / f'{datetime.now():%Y%m%d_%H%M%S}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f'Результаты записаны в {output}')
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,27 @@
+from backtrader import Cerebro, TimeFrame
+import Strategy as ts  # Торговые системы
+
+# Для импортирования QKStore
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parents[2]))
+
+from BackTraderQuik.QKStore import QKStore  # Хранилище QUIK
+
+# Новые тики или секундные бары одного тикера из потока обезличенных сделок
+# Тикер должен быть включен в таблицу обезличенных сделок QUIK
+if __name__ == '__main__':  # Точка входа при запуске этого скрипта
+    symbol = 'SPBFUT.SiZ4'  # Тикер
+    store = QKStore()  # Хранилище QUIK
+    # Инициируем "движок" BackTrader.
+    # Стандартная статистика сделок и кривой доходности не нужна
+    cerebro = Cerebro(stdstats=False)
+    # 1. Каждая сделка - отдельный бар
+    data = store.getdata(dataname=symbol, timeframe=TimeFrame.Ticks)
+
+    # 2. 5-и секундные бары, собранные из сделок
+    # data = store.getdata(dataname=symbol, timeframe=TimeFrame.Seconds, compression=5)
+
+    cerebro.adddata(data)  # Добавляем данные
+    cerebro.addstrategy(ts.PrintStatusAndBars)  # Добавляем торговую систему
+    cerebro.run()  # Запуск торговой системы
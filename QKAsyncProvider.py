@@ -0,0 +1,338 @@
+import asyncio
+import concurrent.futures
+import json
+from itertools import count
+from queue import SimpleQueue
+from threading import Thread
+
+
+class QKAsyncProvider:
+    """Асинхронное подключение к QUIK через QuikSharp
+
+    Запросы отправляются без ожидания ответов на предыдущие запросы.
+    Ответы сопоставляются с запросами по номеру. Медленный запрос не задерживает остальные.
+    Функции обратного вызова вызываются из цикла событий, если не задана своя функция раздачи
+    """
+
+    encoding = 'cp1251'  # Кодировка QuikSharp
+    limit = 64 * 1024 * 1024  # Максимальный размер ответа. Ответы со свечами могут быть большими
+
+    def __init__(self, host='127.0.0.1', requests_port=34130, callbacks_port=34131, dispatch=None):
+        """
+        :param str host: Адрес/IP компьютера с QUIK
+        :param int requests_port: Порт запросов
+        :param int callbacks_port: Порт функций обратного вызова. None - функции обратного вызова не нужны
+        :param dispatch: Функция раздачи функций обратного вызова dispatch(cmd, data). None - вызов из цикла событий
+        """
+        self.host = host
+        self.requests_port = requests_port
+        self.callbacks_port = callbacks_port
+        self.dispatch = dispatch or self.call_handler
+        self.ids = count(1)  # Номера запросов
+        self.futures = {}  # Ожидаемые ответы. Номер запроса -> Будущий ответ
+        self.writer = None  # Отправка запросов
+        self.tasks = []  # Задачи чтения ответов и функций обратного вызова
+
+    async def connect(self):
+        """Подключение к QUIK"""
+        reader, self.writer = await asyncio.open_connection(self.host, self.requests_port, limit=self.limit)
+        self.tasks = [asyncio.create_task(self.read_responses(reader))]
+        if self.callbacks_port is not None:
+            callbacks_reader, callbacks_writer = await asyncio.open_connection(self.host, self.callbacks_port, limit=self.limit)
+            self.tasks.append(asyncio.create_task(self.read_callbacks(callbacks_reader, callbacks_writer)))
+
+    async def close(self):
+        """Отключение от QUIK"""
+        self.shutdown()
+
+    def shutdown(self):
+        """Закрытие подключения. Вызывается и из задачи чтения ответов, поэтому без ожидания и без отмены текущей задачи"""
+        current = asyncio.current_task()
+        for task in self.tasks:
+            if task is not current:
+                task.cancel()
+        if self.writer:  # Новые запросы по закрытому подключению сразу завершаются ошибкой
+            self.writer.close()
+        self.fail_requests()
+
+    def fail_requests(self):
+        """Ответов на оставшиеся запросы не будет. Ждущие их запросы завершаются ошибкой"""
+        for future in self.futures.values():
+            if not future.done():
+                future.set_exception(ConnectionError('Подключение к QUIK закрыто'))
+        self.futures.clear()
+
+    async def request(self, cmd, data=''):
+        """Запрос в QUIK
+
+        :param str cmd: Команда QuikSharp
+        :param data: Данные запроса
+        :return: Ответ QUIK. Данные ответа в ключе data
+        """
+        if self.writer is None or self.writer.is_closing():  # Ответа по закрытому подключению не будет
+            raise ConnectionError('Подключение к QUIK закрыто')
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.futures[request_id] = future
+        raw = f'{json.dumps({"data": data, "id": request_id, "cmd": cmd, "t": ""}, ensure_ascii=False)}\r\n'
+        self.writer.write(raw.encode(self.encoding))
+        try:
+            await self.writer.drain()  # Если QuikSharp не успевает читать запросы, то ждем, а не копим их в буфере
+            return await future
+        finally:
+            self.futures.pop(request_id, None)
+
+    async def read_responses(self, reader):
+        """Чтение ответов на запросы. Ответ передается запросу с тем же номером"""
+        try:
+            while line := await reader.readline():
+                try:
+                    response = json.loads(line.decode(self.encoding))
+                except ValueError as e:  # Испорченный ответ пропускаем. Остальные ответы продолжаем читать
+                    print(f'Ошибка разбора ответа QUIK: {e}')
+                    continue
+                future = self.futures.get(response.get('id'))
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (OSError, ValueError) as e:  # Подключение разорвано, или ответ больше limit
+            print(f'Ошибка чтения ответов QUIK: {e}')
+        finally:  # Чтение ответов остановлено. Подключение закрываем, ждущие и новые запросы завершаются ошибкой
+            self.shutdown()
+
+    async def read_callbacks(self, reader, writer):
+        """Чтение и раздача функций обратного вызова"""
+        try:
+            while line := await reader.readline():
+                try:
+                    callback = json.loads(line.decode(self.encoding))
+                except ValueError as e:  # Испорченную функцию обратного вызова пропускаем
+                    print(f'Ошибка разбора функции обратного вызова QUIK: {e}')
+                    continue
+                cmd = callback.get('cmd', '')
+                # Новый бар передается сразу, остальные события вместе с командой
+                self.dispatch(cmd, callback['data'] if cmd == 'OnNewCandle' else callback)
+        finally:
+            writer.close()
+
+    def call_handler(self, cmd, data):
+        """Вызов функции обратного вызова с именем команды, если она задана"""
+        handler = getattr(self, cmd, None) if cmd.startswith('On') else None
+        if handler is not None:
+            handler(data)
+
+    async def data(self, cmd, data=''):
+        """Данные ответа QUIK на запрос"""
+        return (await self.request(cmd, data)).get('data')
+
+    # Запросы
+
+    async def is_connected(self):
+        """Подключен ли QUIK к серверу брокера. 1 - подключен, 0 - нет"""
+        return await self.data('isConnected')
+
+    async def get_info_param(self, param):
+        """Параметр информационного окна QUIK"""
+        return await self.data('getInfoParam', param)
+
+    async def get_classes_list(self):
+        """Коды площадок через запятую"""
+        return await self.data('getClassesList')
+
+    async def get_class_securities(self, class_code):
+        """Коды тикеров площадки через запятую"""
+        return await self.data('getClassSecurities', class_code)
+
+    async def get_security_info(self, class_code, sec_code):
+        """Информация о тикере"""
+        return await self.data('getSecurityInfo', f'{class_code}|{sec_code}')
+
+    async def get_security_info_bulk(self, keys):
+        """Информация о тикерах
+
+        :param list keys: Коды площадок и тикеров в формате <Код площадки>|<Код тикера>
+        """
+        return await self.data('getSecurityInfoBulk', keys)
+
+    async def get_security_class(self, class_codes, sec_code):
+        """Код площадки тикера из кодов площадок через запятую"""
+        return await self.data('getSecurityClass', f'{class_codes}|{sec_code}')
+
+    async def get_candles_ds(self, class_code, sec_code, interval, count):
+        """Свечи тикера. count = 0 - все доступные свечи"""
+        return await self.data('get_candles_from_data_source', f'{class_code}|{sec_code}|{interval}|{count}')
+
+    async def is_subs(self, class_code, sec_code, interval):
+        """Есть ли подписка на свечи тикера/интервала"""
+        return await self.data('is_subscribed', f'{class_code}|{sec_code}|{interval}')
+
+    async def subs_to_candles(self, class_code, sec_code, interval):
+        """Подписка на свечи тикера/интервала"""
+        return await self.data('subscribe_to_candles', f'{class_code}|{sec_code}|{interval}')
+
+    async def unsubs_from_candles(self, class_code, sec_code, interval):
+        """Отмена подписки на свечи тикера/интервала"""
+        return await self.data('unsubscribe_from_candles', f'{class_code}|{sec_code}|{interval}')
+
+    async def get_param_ex(self, class_code, sec_code, param):
+        """Параметр текущей таблицы торгов тикера"""
+        return await self.data('getParamEx', f'{class_code}|{sec_code}|{param}')
+
+    async def param_request(self, class_code, sec_code, param):
+        """Заказ получения параметра текущей таблицы торгов тикера. Изменения приходят в OnParam"""
+        return await self.data('paramRequest', f'{class_code}|{sec_code}|{param}')
+
+    async def cancel_param_request(self, class_code, sec_code, param):
+        """Отмена заказа получения параметра текущей таблицы торгов тикера"""
+        return await self.data('cancelParamRequest', f'{class_code}|{sec_code}|{param}')
+
+    async def send_transaction(self, transaction):
+        """Отправка транзакции
+
+        :return: Ответ QUIK целиком. При ошибке команда ответа lua_transaction_error
+        """
+        return await self.request('sendTransaction', transaction)
+
+    async def get_order_by_number(self, order_num):
+        """Заявка по номеру. Номер заявки, если заявка не найдена"""
+        return await self.data('get_order_by_number', order_num)
+
+    async def get_futures_limit(self, firm_id, trade_account_id, limit_type, currency_code):
+        """Фьючерсный лимит"""
+        return await self.data('getFuturesLimit', f'{firm_id}|{trade_account_id}|{limit_type}|{currency_code}')
+
+    async def get_money_limits(self):
+        """Все денежные лимиты"""
+        return await self.data('getMoneyLimits')
+
+    async def get_all_depo_limits(self):
+        """Все лимиты по бумагам"""
+        return await self.data('get_depo_limits')
+
+    async def get_futures_holdings(self):
+        """Все фьючерсные позиции"""
+        return await self.data('getFuturesClientHoldings')
+
+
+class QKSyncProvider:
+    """Синхронное подключение к QUIK поверх асинхронного
+
+    Методы и функции обратного вызова называются так же, как в QuikPy, поэтому хранилище,
+    данные и брокер работают без изменений. Цикл событий работает в своем потоке.
+    Запросы из всех потоков идут по одному подключению без ожидания ответов на предыдущие запросы.
+    Функции обратного вызова вызываются из своего потока, чтобы они могли делать запросы
+    """
+
+    def __init__(self, host='127.0.0.1', requests_port=34130, callbacks_port=34131, timeout=None):
+        """
+        :param str host: Адрес/IP компьютера с QUIK
+        :param int requests_port: Порт запросов
+        :param int callbacks_port: Порт функций обратного вызова. None - функции обратного вызова не нужны
+        :param float timeout: Максимальное время ожидания ответа в секундах. None - без ограничения
+        """
+        self.timeout = timeout
+        # Функции обратного вызова QuikPy
+        self.OnConnected = self.OnDisconnected = self.OnNewCandle = self.OnAllTrade = self.default_handler
+        self.OnTrade = self.OnTransReply = self.OnOrder = self.OnStopOrder = self.default_handler
+        self.OnFuturesLimitChange = self.OnMoneyLimit = self.OnParam = self.default_handler
+        self.callbacks = SimpleQueue()  # Очередь функций обратного вызова (cmd, data)
+        self.loop = asyncio.new_event_loop()
+        Thread(target=self.loop.run_forever, name='QKAsyncProvider', daemon=True).start()
+        Thread(target=self.process_callbacks, name='QKCallbacks', daemon=True).start()
+        self.aprovider = QKAsyncProvider(host, requests_port, callbacks_port, lambda cmd, data: self.callbacks.put((cmd, data)))
+        self.run(self.aprovider.connect())
+
+    def run(self, coro):
+        """Выполнение запроса в цикле событий и ожидание ответа"""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()  # Запрос без ответа отменяем, чтобы он не остался в ожидаемых ответах
+            raise
+
+    def process_callbacks(self):
+        """Поток обработки функций обратного вызова"""
+        for cmd, data in iter(self.callbacks.get, None):
+            handler = getattr(self, cmd, None) if cmd.startswith('On') else None
+            if handler is None:
+                continue
+            try:
+                handler(data)
+            except Exception as e:  # Ошибка в обработчике не останавливает обработку остальных событий
+                print(f'Ошибка обработки {cmd}: {e}')
+
+    def default_handler(self, data):
+        """Обработчик по умолчанию. Событие пропускается"""
+        pass
+
+    DefaultHandler = default_handler
+
+    def close_connection(self):
+        """Закрытие подключения, потока обработки функций обратного вызова и цикла событий"""
+        self.run(self.aprovider.close())
+        self.callbacks.put(None)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    # Запросы. Возвращают данные ответа
+
+    def isConnected(self):
+        return self.run(self.aprovider.is_connected())
+
+    def getInfoParam(self, param):
+        return self.run(self.aprovider.get_info_param(param))
+
+    def getClassesList(self):
+        return self.run(self.aprovider.get_classes_list())
+
+    def getClassSecurities(self, class_code):
+        return self.run(self.aprovider.get_class_securities(class_code))
+
+    def getSecurityInfo(self, class_code, sec_code):
+        return self.run(self.aprovider.get_security_info(class_code, sec_code))
+
+    def getSecurityInfoBulk(self, keys):
+        return self.run(self.aprovider.get_security_info_bulk(keys))
+
+    def getSecurityClass(self, class_codes, sec_code):
+        return self.run(self.aprovider.get_security_class(class_codes, sec_code))
+
+    def get_candles_ds(self, class_code, sec_code, interval, count):
+        return self.run(self.aprovider.get_candles_ds(class_code, sec_code, interval, count))
+
+    def is_subs(self, class_code, sec_code, interval):
+        return self.run(self.aprovider.is_subs(class_code, sec_code, interval))
+
+    def subs_to_candles(self, class_code, sec_code, interval):
+        return self.run(self.aprovider.subs_to_candles(class_code, sec_code, interval))
+
+    def unsubs_from_candles(self, class_code, sec_code, interval):
+        return self.run(self.aprovider.unsubs_from_candles(class_code, sec_code, interval))
+
+    # Запросы брокера. Как в QuikPy, возвращают ответ с данными в ключе data
+
+    def GetParamEx(self, class_code, sec_code, param):
+        return {'data': self.run(self.aprovider.get_param_ex(class_code, sec_code, param))}
+
+    def ParamRequest(self, class_code, sec_code, param):
+        return {'data': self.run(self.aprovider.param_request(class_code, sec_code, param))}
+
+    def CancelParamRequest(self, class_code, sec_code, param):
+        return {'data': self.run(self.aprovider.cancel_param_request(class_code, sec_code, param))}
+
+    def SendTransaction(self, transaction):
+        return self.run(self.aprovider.send_transaction(transaction))
+
+    def GetOrderByNumber(self, order_num):
+        return {'data': self.run(self.aprovider.get_order_by_number(order_num))}
+
+    def GetFuturesLimit(self, firm_id, trade_account_id, limit_type, currency_code):
+        return {'data': self.run(self.aprovider.get_futures_limit(firm_id, trade_account_id, limit_type, currency_code))}
+
+    def GetMoneyLimits(self):
+        return {'data': self.run(self.aprovider.get_money_limits())}
+
+    def GetAllDepoLimits(self):
+        return {'data': self.run(self.aprovider.get_all_depo_limits())}
+
+    def GetFuturesHoldings(self):
+        return {'data': self.run(self.aprovider.get_futures_holdings())}
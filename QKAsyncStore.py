@@ -0,0 +1,51 @@
+from queue import Queue
+
+from .QKStore import QKStore
+from .QKAsyncProvider import QKSyncProvider
+
+
+class QKAsyncStore(QKStore):
+    """Хранилище QUIK с асинхронным подключением
+
+    Все запросы идут по одному подключению без ожидания ответов на предыдущие запросы,
+    поэтому медленная загрузка истории не задерживает отправку транзакций.
+    Данные и брокер работают так же, как с QKStore.
+    Из кода asyncio запросы выполняются через асинхронное подключение aprovider в цикле событий loop
+    """
+
+    params = (
+        ('requests_port', 34130),  # Порт запросов QuikSharp
+        ('callbacks_port', 34131),  # Порт функций обратного вызова QuikSharp
+        ('timeout', None),  # Максимальное время ожидания ответа в секундах. None - без ограничения
+    )
+
+    @property
+    def aprovider(self):
+        """Асинхронное подключение к QUIK"""
+        return self.provider.aprovider
+
+    @property
+    def loop(self):
+        """Цикл событий асинхронного подключения"""
+        return self.provider.loop
+
+    def make_provider(self, callbacks=True, ports=None):
+        """Новое подключение к QUIK
+
+        :param bool callbacks: Нужны ли подключению функции обратного вызова
+        :param tuple ports: Порты запросов и функций обратного вызова QuikSharp. None - порты из параметров
+        """
+        requests_port, callbacks_port = ports or (self.p.requests_port, self.p.callbacks_port)
+        return QKSyncProvider(self.p.host, requests_port, callbacks_port if callbacks else None, self.p.timeout)
+
+    def provider_pool(self, workers):
+        """Очередь подключений для одновременных запросов
+
+        Одновременные запросы идут по одному подключению. Дополнительные подключения не открываются
+
+        :param int workers: Кол-во одновременных запросов
+        """
+        providers = Queue()
+        for _ in range(workers):
+            providers.put(self.provider)
+        return providers
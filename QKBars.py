@@ -0,0 +1,245 @@
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from itertools import compress
+from threading import Condition
+
+from backtrader import date2num
+
+
+class QKBars:
+    """Буфер баров по столбцам
+
+    Бары QUIK переводятся один раз при поступлении.
+    Дата/время открытия бара хранится сразу в формате BackTrader.
+    Бары забираются слева (popleft), новые бары добавляются справа
+    """
+
+    columns = ('datetime', 'open', 'high', 'low', 'close', 'volume')  # Столбцы бара
+
+    def __init__(self):
+        # Новые бары по подписке добавляются из потока обработки функций обратного вызова.
+        # По условию поток BackTrader ждет новые бары, а не опрашивает буфер
+        self.lock = Condition()
+        self.datetime = array('d')  # Дата/время открытия бара в формате BackTrader
+        self.open = array('d')
+        self.high = array('d')
+        self.low = array('d')
+        self.close = array('d')
+        self.volume = array('d')
+        self.live = array('b')  # Признак нового бара
+        self.head = 0  # Индекс первого не забранного бара
+        self.waiting = 0  # Кол-во потоков, забравших все бары и ждущих новые
+
+    @classmethod
+    def from_quik(cls, bars):
+        """Буфер из баров QUIK
+
+        :param list bars: Бары QUIK
+        """
+        self = cls()
+        self.datetime.extend([date2num(cls.open_datetime(bar)) for bar in bars])
+        self.open.extend([bar['open'] for bar in bars])
+        self.high.extend([bar['high'] for bar in bars])
+        self.low.extend([bar['low'] for bar in bars])
+        self.close.extend([bar['close'] for bar in bars])
+        self.volume.extend([bar['volume'] for bar in bars])
+        self.live.extend([bool(bar.get('live')) for bar in bars])
+        return self
+
+    @staticmethod
+    def open_datetime(bar):
+        """Дата/время открытия бара QUIK"""
+        dt = bar['datetime']
+        return datetime(dt['year'], dt['month'], dt['day'], dt['hour'], dt['min'])
+
+    def __len__(self):
+        return len(self.datetime) - self.head
+
+    def __getitem__(self, item):
+        """Бар (dt, open, high, low, close, volume, live) по индексу или новый буфер по срезу"""
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            bars = QKBars()
+            for column in self.columns + ('live',):
+                getattr(bars, column).extend(getattr(self, column)[self.head + start:self.head + stop:step])
+            return bars
+        i = item + self.head if item >= 0 else item + len(self.datetime)
+        if not self.head <= i < len(self.datetime):
+            raise IndexError('bar index out of range')
+        return (self.datetime[i], self.open[i], self.high[i], self.low[i],
+                self.close[i], self.volume[i], bool(self.live[i]))
+
+    @classmethod
+    def quik_bar(cls, bar):
+        """Бар (dt, open, high, low, close, volume, live) из бара QUIK"""
+        return (date2num(cls.open_datetime(bar)), bar['open'], bar['high'],
+                bar['low'], bar['close'], bar['volume'], bool(bar.get('live')))
+
+    def append(self, dt, open, high, low, close, volume, live=False):
+        """Добавление бара справа"""
+        with self.lock:
+            self.datetime.append(dt)
+            self.open.append(open)
+            self.high.append(high)
+            self.low.append(low)
+            self.close.append(close)
+            self.volume.append(volume)
+            self.live.append(live)
+            self.lock.notify_all()  # Будим ожидающих новый бар
+
+    def extend(self, bars):
+        """Добавление баров другого буфера справа"""
+        with self.lock:
+            for column in self.columns + ('live',):
+                getattr(self, column).extend(getattr(bars, column)[bars.head:])
+            self.lock.notify_all()  # Будим ожидающих новые бары
+
+    def wait(self, timeout):
+        """Ожидание бара в буфере
+
+        :param float timeout: Максимальное время ожидания в секундах
+        :return: True - в буфере есть бары, False - бары не пришли за время ожидания
+        """
+        with self.lock:
+            self.waiting += 1
+            self.lock.notify_all()  # Будим ожидающих, пока буфер не будет выбран
+            try:
+                return self.lock.wait_for(lambda: len(self.datetime) > self.head, timeout)
+            finally:
+                self.waiting -= 1
+
+    def wait_drained(self, timeout):
+        """Ожидание, пока поток BackTrader не заберет все бары и не начнет ждать новые
+
+        :param float timeout: Максимальное время ожидания в секундах
+        :return: True - буфер выбран, и его ждут, False - не выбран за время ожидания
+        """
+        with self.lock:
+            return self.lock.wait_for(lambda: self.waiting and len(self.datetime) <= self.head, timeout)
+
+    def popleft(self):
+        """Удаление и выдача крайнего левого бара (dt, open, high, low, close, volume, live)"""
+        with self.lock:
+            i = self.head
+            if i >= len(self.datetime):
+                raise IndexError('pop from an empty bars')
+            bar = (self.datetime[i], self.open[i], self.high[i], self.low[i],
+                   self.close[i], self.volume[i], bool(self.live[i]))
+            self.head += 1
+            # Когда забрано больше половины баров, удаляем их из столбцов
+            if self.head >= 1024 and self.head * 2 >= len(self.datetime):
+                self.compact()
+            return bar
+
+    def pop(self):
+        """Удаление и выдача крайнего правого бара"""
+        with self.lock:
+            if self.head >= len(self.datetime):
+                raise IndexError('pop from an empty bars')
+            bar = self[-1]
+            for column in self.columns + ('live',):
+                getattr(self, column).pop()
+            return bar
+
+    def clear(self):
+        """Удаление всех баров"""
+        with self.lock:
+            for column in self.columns + ('live',):
+                del getattr(self, column)[:]
+            self.head = 0
+
+    def compact(self):
+        """Удаление забранных баров из столбцов"""
+        for column in self.columns + ('live',):
+            del getattr(self, column)[:self.head]
+        self.head = 0
+
+    def select(self, keep):
+        """Новый буфер из отобранных баров
+
+        :param list keep: Признаки по каждому бару. True - бар оставляем, False - отбрасываем
+        """
+        bars = QKBars()
+        for column in self.columns + ('live',):
+            getattr(bars, column).extend(compress(getattr(self, column)[self.head:], keep))
+        return bars
+
+    def since(self, dt):
+        """Бары с датой/временем открытия после dt"""
+        return self[bisect_right(self.datetime, dt, self.head) - self.head:]
+
+    def between(self, fromdate, todate):
+        """Бары с датой/временем открытия от fromdate до todate включительно"""
+        return self[bisect_left(self.datetime, fromdate, self.head) - self.head:
+                    bisect_right(self.datetime, todate, self.head) - self.head]
+
+
+class QKBarBuilder:
+    """Сборка баров большего интервала из баров меньшего интервала
+
+    Бары выравниваются по началу дня: минутный интервал 5 дает бары 10:00, 10:05, ...
+    """
+
+    epsilon = 1e-4  # Допуск погрешности даты/времени BackTrader в секундах
+
+    def __init__(self, seconds):
+        """
+        :param int seconds: Интервал собираемых баров в секундах. Не больше суток
+        """
+        self.seconds = seconds
+        self.bar = None  # Собираемый бар [dt, open, high, low, close, volume, live]
+        self.last = None  # Дата/время открытия последнего выданного бара
+
+    def bucket(self, dt):
+        """Дата/время открытия собираемого бара, в который попадает dt
+
+        :param float dt: Дата/время в формате BackTrader
+        """
+        day = int(dt)  # Начало дня
+        # Целых секунд с начала дня. Время с микросекундами отбрасываем вниз.
+        # Погрешность float (около 10 мкс) компенсируем, чтобы ровная секунда не ушла в предыдущую
+        seconds = math.floor((dt - day) * 86400 + self.epsilon)
+        if seconds >= 86400:  # Если после компенсации перешли на следующий день
+            day, seconds = day + 1, 0
+        return day + seconds // self.seconds * self.seconds / 86400
+
+    def is_late(self, dt):
+        """Попадает ли dt в уже выданный бар. Такой бар второй раз выдавать нельзя
+
+        :param float dt: Дата/время в формате BackTrader
+        """
+        return self.last is not None and self.bucket(dt) <= self.last
+
+    def add(self, dt, open, high, low, close, volume, live=False, close_dt=None):
+        """Добавление бара меньшего интервала
+
+        :param float dt: Дата/время открытия бара в формате BackTrader
+        :param float close_dt: Дата/время закрытия бара. Если попадает в следующий собираемый бар,
+            то собираемый бар выдается сразу, не дожидаясь следующего бара
+        :return: Список собранных баров (dt, open, high, low, close, volume, live)
+        """
+        bars = []
+        start = self.bucket(dt)
+        if self.bar and self.bar[0] != start:  # Если бар относится к следующему собираемому бару
+            bars.append(self.flush())  # то выдаем собранный бар
+        if self.bar is None:  # Новый собираемый бар
+            self.bar = [start, open, high, low, close, volume, live]
+        else:  # Продолжение собираемого бара
+            bar = self.bar
+            bar[2] = max(bar[2], high)
+            bar[3] = min(bar[3], low)
+            bar[4] = close
+            bar[5] += volume
+            bar[6] = live
+        if close_dt is not None and self.bucket(close_dt) != start:  # Если бар закрывает собираемый бар
+            bars.append(self.flush())  # то выдаем его сразу
+        return bars
+
+    def flush(self):
+        """Выдача собираемого бара. None, если бар не собирается"""
+        bar, self.bar = self.bar, None
+        if bar:
+            self.last = bar[0]
+        return tuple(bar) if bar else None
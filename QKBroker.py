@@ -1,6 +1,6 @@
 import collections
 from datetime import datetime, date
-import time
+from threading import Event, Lock, Thread, Timer
 
 from backtrader import BrokerBase, Order, BuyOrder, SellOrder
 from backtrader.position import Position
@@ -33,38 +33,69 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
         ('LimitKind', 0),  # День лимита
         ('CurrencyCode', 'SUR'),  # Валюта
         ('IsFutures', True),  # Фьючерсный счет
+        # Период сверки средств и стоимости позиций с QUIK в секундах.
+        # Между сверками они обновляются по изменениям лимитов из QUIK, а getcash/getvalue не делают запросов.
+        # 0 - запрос в QUIK при каждом getcash/getvalue
+        ('reconcile_period', 60),
+        ('fill_timeout', 3),  # Через сколько секунд повторно запрашивать заявку сделки, если по ней не пришло событие
+        ('fill_retries', 10),  # Сколько раз повторно запрашивать заявку сделки, пока не станет известен ее номер транзакции
+        ('trade_nums_size', 10000),  # Сколько последних номеров сделок хранить для фильтрации дублей. Дубли сделки приходят сразу за ней
     )
 
-    def __init__(self, **kwargs):
+    def __init__(self, store, **kwargs):
         super(QKBroker, self).__init__()
-        self.store = QKStore(**kwargs)  # Хранилище QUIK
+        self.store = store  # Хранилище QUIK
         self.notifs = collections.deque()  # Очередь уведомлений брокера о заявках
         self.startingcash = self.cash = 0  # Стартовые и текущие свободные средства по счету
         self.startingvalue = self.value = 0  # Стартовый и текущий баланс счета
         if not self.p.ClientCodeForOrders:  # Для брокера Финам нужно вместо кода клиента
             self.p.ClientCodeForOrders = self.p.ClientCode  # указать Номер торгового терминала
-        self.trade_nums = dict()  # Список номеров сделок по тикеру для фильтрации дублей сделок
+        self.trade_nums = collections.OrderedDict()  # Номера последних сделок для фильтрации дублей сделок. (Код площадки, Номер сделки) -> None
         self.positions = collections.defaultdict(Position)  # Список позиций
         self.orders = collections.OrderedDict()  # Список заявок, отправленных на биржу
         self.ocos = {}  # Список связанных заявок (One Cancel Others)
         self.pcs = collections.defaultdict(collections.deque)  # Очередь всех родительских/дочерних заявок (Parent - Children)
+        self.reconcile_stop = Event()  # Остановка сверки счета
+        # Средства и стоимость позиций меняют поток сверки, поток обработки функций обратного вызова и поток кэша цен.
+        # Запросы в QUIK под блокировкой не делаются, чтобы не задерживать поток обработки функций обратного вызова
+        self.account_lock = Lock()
+        self.limits_seq = 0  # Номер последнего события лимита. Сверка не перезаписывает лимит, пришедший во время ее запросов
+        self.value_delta = 0  # Изменение стоимости позиций по сделкам и ценам с начала расчета стоимости при сверке
+        self.qk_orders = {}  # Зеркало активных заявок QUIK по событиям OnOrder. Номер заявки -> Заявка QUIK
+        # Зеркало активных и сработавших стоп заявок QUIK по событиям OnStopOrder. Номер стоп заявки -> Стоп заявка QUIK
+        self.qk_stop_orders = {}
+        self.stop_linked = {}  # Стоп заявки выставленных по ним заявок. Номер заявки -> Номер стоп заявки
+        self.pending_fills = collections.defaultdict(list)  # Сделки, заявок которых еще нет на бирже. Номер заявки -> Список сделок
+        # Сделки обрабатывают поток обработки функций обратного вызова и потоки повторного запроса заявок
+        self.fills_lock = Lock()
 
     def start(self):
         super(QKBroker, self).start()
         self.store.provider.OnTransReply = self.on_trans_reply  # Ответ на транзакцию пользователя
         self.store.provider.OnTrade = self.on_trade  # Получение новой / изменение существующей сделки
+        self.store.provider.OnOrder = self.on_order  # Получение новой / изменение существующей заявки
+        self.store.provider.OnStopOrder = self.on_stop_order  # Получение новой / изменение существующей стоп заявки
+        self.store.provider.OnFuturesLimitChange = self.on_futures_limit_change  # Изменение фьючерсного лимита
+        self.store.provider.OnMoneyLimit = self.on_money_limit  # Изменение денежного лимита
+        self.store.quotes.listeners.append(self.on_quote)  # Изменение последних цен тикеров
         if self.p.use_positions:  # Если нужно при запуске брокера получить текущие позиции на бирже
             self.get_all_active_positions(self.p.ClientCode, self.p.FirmId, self.p.LimitKind, self.p.Lots, self.p.IsFutures)  # То получаем их
-        self.startingcash = self.cash = self.getcash()  # Стартовые и текущие свободные средства по счету
-        self.startingvalue = self.value = self.getvalue()  # Стартовый и текущий баланс счета
+        self.reconcile()  # Получаем средства и стоимость позиций из QUIK
+        self.startingcash = self.cash  # Стартовые свободные средства по счету
+        self.startingvalue = self.value  # Стартовый баланс счета
+        if self.p.reconcile_period:  # Дальше сверяемся с QUIK в отдельном потоке
+            self.reconcile_stop.clear()
+            Thread(target=self.run_reconcile, name='QKReconcile', daemon=True).start()
 
     def getcash(self):
         """Свободные средства по счету"""
         # TODO Если не находимся в режиме Live, то не делать запросы
-        if self.store.BrokerCls:  # Если брокер есть в хранилище
+        if self.store.BrokerCls and not self.p.reconcile_period:  # Если брокер есть в хранилище, и средства не сверяются в отдельном потоке
+            seq = self.limits_seq  # Номер события лимита до запроса
             cash = self.get_money_limits(self.p.ClientCode, self.p.FirmId, self.p.TradeAccountId, self.p.LimitKind, self.p.CurrencyCode, self.p.IsFutures)  # Свободные средства по счету
-            if cash:  # Если свободные средства были получены
-                self.cash = cash  # то запоминаем их
+            with self.account_lock:
+                if cash and seq == self.limits_seq:  # Если свободные средства были получены, и событие лимита за время запроса не приходило
+                    self.cash = cash  # то запоминаем их
         return self.cash
 
     def getvalue(self, datas=None):
@@ -72,10 +103,12 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
         # TODO Если не находимся в режиме Live, то не делать запросы
         # TODO Выдавать баланс по тикерам (datas) как в Alor
         # TODO Выдавать весь баланс, если не указан параметры. Иначе, выдавать баланс по параметрам
-        if self.store.BrokerCls:  # Если брокер есть в хранилище
+        if self.store.BrokerCls and not self.p.reconcile_period:  # Если брокер есть в хранилище, и стоимость не сверяется в отдельном потоке
+            seq = self.limits_seq  # Номер события лимита до запроса
             v = self.get_positions_limits(self.p.FirmId, self.p.TradeAccountId, self.p.IsFutures)  # Стоимость позиций по счету
-            if v:  # Если стоимость позиций была получена
-                self.value = v  # Баланс счета = свободные средства + стоимость позиций
+            with self.account_lock:
+                if v and seq == self.limits_seq:  # Если стоимость позиций была получена, и событие лимита за время запроса не приходило
+                    self.value = v  # Баланс счета = свободные средства + стоимость позиций
         return self.value
 
     def getposition(self, data):
@@ -113,14 +146,49 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
 
     def stop(self):
         super(QKBroker, self).stop()
+        self.reconcile_stop.set()  # Останавливаем сверку счета
+        if self.on_quote in self.store.quotes.listeners:
+            self.store.quotes.listeners.remove(self.on_quote)
+        self.store.provider.OnFuturesLimitChange = self.store.provider.DefaultHandler  # Изменение фьючерсного лимита
+        self.store.provider.OnMoneyLimit = self.store.provider.DefaultHandler  # Изменение денежного лимита
         self.store.provider.OnConnected = self.store.provider.DefaultHandler  # Соединение терминала с сервером QUIK
         self.store.provider.OnDisconnected = self.store.provider.DefaultHandler  # Отключение терминала от сервера QUIK
         self.store.provider.OnTransReply = self.store.provider.DefaultHandler  # Ответ на транзакцию пользователя
         self.store.provider.OnTrade = self.store.provider.DefaultHandler  # Получение новой / изменение существующей сделки
+        self.store.provider.OnOrder = self.store.provider.DefaultHandler  # Получение новой / изменение существующей заявки
+        self.store.provider.OnStopOrder = self.store.provider.DefaultHandler  # Получение новой / изменение существующей стоп заявки
         self.store.BrokerCls = None  # Удаляем класс брокера из хранилища
 
     # Функции
 
+    def reconcile(self):
+        """Сверка свободных средств и стоимости позиций с QUIK
+
+        Запросы идут без блокировки, поток обработки функций обратного вызова их не ждет.
+        Если за время запросов пришло событие лимита, то его значение новее, и сверенное значение не записывается.
+        Изменения стоимости позиций по сделкам и ценам за время расчета стоимости добавляются к сверенной стоимости
+        """
+        seq = self.limits_seq  # Номер события лимита до запросов
+        cash = self.get_money_limits(self.p.ClientCode, self.p.FirmId, self.p.TradeAccountId, self.p.LimitKind, self.p.CurrencyCode, self.p.IsFutures)  # Свободные средства по счету
+        with self.account_lock:
+            self.value_delta = 0  # Начинаем копить изменения стоимости позиций
+        v = self.get_positions_limits(self.p.FirmId, self.p.TradeAccountId, self.p.IsFutures)  # Стоимость позиций по счету
+        with self.account_lock:
+            if seq != self.limits_seq:  # Если за время запросов пришло событие лимита
+                return  # то его значения новее сверенных
+            if cash:  # Если свободные средства были получены
+                self.cash = cash  # то запоминаем их
+            if v:  # Если стоимость позиций была получена
+                self.value = v + self.value_delta  # то запоминаем ее вместе с изменениями за время расчета
+
+    def run_reconcile(self):
+        """Поток сверки счета с QUIK раз в reconcile_period секунд"""
+        while not self.reconcile_stop.wait(self.p.reconcile_period):
+            try:
+                self.reconcile()
+            except Exception as e:  # Ошибка сверки не останавливает поток. Следующая сверка будет через период
+                print(f'Ошибка сверки счета: {e}')
+
     def get_all_active_positions(self, client_code, firm_id, limit_kind, is_lots, is_futures=False):
         """Все активные позиции по счету
 
@@ -136,12 +204,13 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
             for active_futures_holding in active_futures_holdings:  # Пробегаемся по всем активным фьючерсным позициям
                 class_code = 'SPBFUT'  # Код площадки
                 sec_code = active_futures_holding['sec_code']  # Код тикера
+                converter = self.store.get_converter(class_code, sec_code)  # Перевод кол-ва и цен тикера
                 dataname = self.store.class_sec_code_to_data_name(class_code, sec_code)  # Получаем название тикера по коду площадки и коду тикера
                 size = active_futures_holding['totalnet']  # Кол-во
                 if is_lots:  # Если входящий остаток в лотах
-                    size = self.store.lots_to_size(class_code, sec_code, size)  # то переводим кол-во из лотов в штуки
+                    size = converter.lots_to_size(size)  # то переводим кол-во из лотов в штуки
                 price = float(active_futures_holding['avrposnprice'])  # Цена приобретения
-                price = self.store.quik_to_bt_price(class_code, sec_code, price)  # Переводим цену приобретения за лот в цену приобретения за штуку
+                price = converter.quik_to_bt_price(price)  # Переводим цену приобретения за лот в цену приобретения за штуку
                 self.positions[dataname] = Position(size, price)  # Сохраняем в списке открытых позиций
         else:  # Для остальных фирм
             depo_limits = self.store.provider.GetAllDepoLimits()['data']  # Все лимиты по бумагам (позиции по инструментам)
@@ -153,13 +222,15 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
             for firm_kind_depo_limit in account_depo_limits:  # Пробегаемся по всем позициям
                 dataname = firm_kind_depo_limit['sec_code']  # В позициях код тикера указывается без кода площадки
                 class_code, sec_code = self.store.data_name_to_class_sec_code(dataname)  # По коду тикера без площадки получаем код площадки и код тикера
+                converter = self.store.get_converter(class_code, sec_code)  # Перевод кол-ва и цен тикера
                 size = int(firm_kind_depo_limit['currentbal'])  # Кол-во
                 if is_lots:  # Если входящий остаток в лотах
-                    size = self.store.lots_to_size(class_code, sec_code, size)  # то переводим кол-во из лотов в штуки
+                    size = converter.lots_to_size(size)  # то переводим кол-во из лотов в штуки
                 price = float(firm_kind_depo_limit['wa_position_price'])  # Цена приобретения
-                price = self.store.quik_to_bt_price(class_code, sec_code, price)  # Для рынка облигаций цену приобретения умножаем на 10
+                price = converter.quik_to_bt_price(price)  # Для рынка облигаций цену приобретения умножаем на 10
                 dataname = self.store.class_sec_code_to_data_name(class_code, sec_code)  # Получаем название тикера по коду площадки и коду тикера
                 self.positions[dataname] = Position(size, price)  # Сохраняем в списке открытых позиций
+                self.store.quotes.subscribe(class_code, sec_code)  # Последняя цена нужна для стоимости позиции
 
     def get_money_limits(self, client_code, firm_id, trade_account_id, limit_kind, currency_code, is_futures=False):
         """Свободные средства по счету
@@ -220,8 +291,8 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
         pos_value = 0  # Стоимость позиций по счету
         for dataname in list(self.positions.keys()):  # Пробегаемся по копии позиций (чтобы не было ошибки при изменении позиций)
             class_code, sec_code = self.store.data_name_to_class_sec_code(dataname)  # По названию тикера получаем код площадки и код тикера
-            last_price = float(self.store.provider.GetParamEx(class_code, sec_code, 'LAST')['data']['param_value'])  # Последняя цена сделки
-            last_price = self.store.quik_to_bt_price(class_code, sec_code, last_price)  # Для рынка облигаций последнюю цену сделки умножаем на 10
+            last_price = self.store.quotes.get(class_code, sec_code)  # Последняя цена сделки из кэша
+            last_price = self.store.get_converter(class_code, sec_code).quik_to_bt_price(last_price)  # Для рынка облигаций последнюю цену сделки умножаем на 10
             pos = self.positions[dataname]  # Получаем позицию по тикеру
             pos_value += pos.size * last_price  # Добавляем стоимость позиции
         return pos_value  # Стоимость позиций по счету
@@ -234,14 +305,15 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
         order.addinfo(**kwargs)  # Передаем в заявку все дополнительные свойства из брокера, в т.ч. ClientCode, TradeAccountId, StopOrderKind
         class_code, sec_code = self.store.data_name_to_class_sec_code(data._name)  # Из названия тикера получаем код площадки и тикера
         order.addinfo(ClassCode=class_code, SecCode=sec_code)  # Код площадки ClassCode и тикера SecCode
-        si = self.store.get_symbol_info(class_code, sec_code)  # Получаем параметры тикера (min_price_step, scale)
-        if not si:  # Если тикер не найден
+        self.store.quotes.subscribe(class_code, sec_code)  # Последняя цена торгуемого тикера нужна для рыночных заявок и стоимости позиций
+        converter = self.store.get_converter(class_code, sec_code)  # Получаем перевод тикера (min_price_step, scale)
+        if converter.min_price_step is None:  # Если тикер не найден
             print(f'Постановка заявки {order.ref} по тикеру {class_code}.{sec_code} отменена. Тикер не найден')
             order.reject(self)  # то отменяем заявку (статус Order.Rejected)
             return order  # Возвращаем отмененную заявку
-        order.addinfo(MinPriceStep=float(si['min_price_step']))  # Минимальный шаг цены
-        order.addinfo(Slippage=float(si['min_price_step']) * self.store.p.StopSteps)  # Размер проскальзывания в деньгах Slippage
-        order.addinfo(Scale=int(si['scale']))  # Кол-во значащих цифр после запятой Scale
+        order.addinfo(MinPriceStep=converter.min_price_step)  # Минимальный шаг цены
+        order.addinfo(Slippage=converter.min_price_step * self.store.p.StopSteps)  # Размер проскальзывания в деньгах Slippage
+        order.addinfo(Scale=converter.scale)  # Кол-во значащих цифр после запятой Scale
         if oco:  # Если есть связанная заявка
             self.ocos[order.ref] = oco.ref  # то заносим в список связанных заявок
         if not transmit or parent:  # Для родительской/дочерних заявок
@@ -265,7 +337,8 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
         """Отправка заявки (транзакции) на биржу"""
         class_code = order.info['ClassCode']  # Код площадки
         sec_code = order.info['SecCode']  # Код тикера
-        size = abs(self.store.size_to_lots(class_code, sec_code, order.size))  # Размер позиции в лотах. В QUIK всегда передается положительный размер лота
+        converter = self.store.get_converter(class_code, sec_code)  # Перевод кол-ва и цен тикера
+        size = abs(converter.size_to_lots(order.size))  # Размер позиции в лотах. В QUIK всегда передается положительный размер лота
         price = order.price  # Цена заявки
         if not price:  # Если цена не указана для рыночных заявок
             price = 0.00  # Цена рыночной заявки должна быть нулевой (кроме фьючерсов)
@@ -274,10 +347,10 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
             slippage = int(slippage)  # поэтому, приводим такое проскальзывание к целому числу
         if order.exectype == Order.Market:  # Для рыночных заявок
             if class_code == 'SPBFUT':  # Для рынка фьючерсов
-                last_price = float(self.store.provider.GetParamEx(class_code, sec_code, 'LAST')['data']['param_value'])  # Последняя цена сделки
+                last_price = self.store.quotes.get(class_code, sec_code)  # Последняя цена сделки из кэша. Запроса в QUIK нет
                 price = last_price + slippage if order.isbuy() else last_price - slippage  # Из документации QUIK: При покупке/продаже фьючерсов по рынку нужно ставить цену хуже последней сделки
         else:  # Для остальных заявок
-            price = self.store.bt_to_quik_price(class_code, sec_code, price)  # Переводим цену из BackTrader в QUIK
+            price = converter.bt_to_quik_price(price)  # Переводим цену из BackTrader в QUIK
         scale = order.info['Scale']  # Кол-во значащих цифр после запятой
         price = round(price, scale)  # Округляем цену до кол-ва значащих цифр
         if price.is_integer():  # Целое значение цены мы должны отправлять без десятичных знаков
@@ -296,7 +369,7 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
             transaction['STOPPRICE'] = str(price)  # Стоп цена срабатывания
             plimit = order.pricelimit  # Лимитная цена исполнения
             if plimit:  # Если задана лимитная цена исполнения
-                plimit = self.store.bt_to_quik_price(class_code, sec_code, plimit)  # Переводим цену из BackTrader в QUIK
+                plimit = converter.bt_to_quik_price(plimit)  # Переводим цену из BackTrader в QUIK
                 limit_price = round(plimit, scale)  # то ее и берем, округлив цену до кол-ва значащих цифр
             elif order.isbuy():  # Если цена не задана, и покупаем
                 limit_price = price + slippage  # то будем покупать по большей цене в размер проскальзывания
@@ -320,7 +393,7 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
         else:  # Для рыночных или лимитных заявок
             transaction['ACTION'] = 'NEW_ORDER'  # Новая рыночная или лимитная заявка
             transaction['TYPE'] = 'L' if order.exectype == Order.Limit else 'M'  # L = лимитная заявка (по умолчанию), M = рыночная заявка
-        response = self.store.provider.SendTransaction(transaction)  # Отправляем транзакцию на биржу
+        response = self.store.trade_provider.SendTransaction(transaction)  # Отправляем транзакцию на биржу
         order.submit(self)  # Отправляем заявку на биржу (статус Order.Submitted)
         if response['cmd'] == 'lua_transaction_error':  # Если возникла ошибка при постановке заявки на уровне QUIK
             print(f'Ошибка отправки заявки в QUIK {response["data"]["CLASSCODE"]}.{response["data"]["SECCODE"]} {response["lua_error"]}')  # то заявка не отправляется на биржу, выводим сообщение об ошибке
@@ -336,8 +409,15 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
             return  # то выходим, дальше не продолжаем
         order_num = order.info['order_num']  # Номер заявки на бирже
         class_code, sec_code = self.store.data_name_to_class_sec_code(order.data._name)  # По названию тикера получаем код площадки и код тикера
-        is_stop = order.exectype in [Order.Stop, Order.StopLimit] and \
-            isinstance(self.store.provider.GetOrderByNumber(order_num)['data'], int)  # Задана стоп заявка и лимитная заявка не выставлена
+        stop_order_num = order.info['stop_order_num'] if 'stop_order_num' in order.info else None  # Номер стоп заявки на бирже
+        qk_stop_order = self.qk_stop_orders.get(stop_order_num)  # Стоп заявка из зеркала стоп заявок QUIK
+        if qk_stop_order is not None:  # Если по стоп заявке было событие
+            linked_order = int(qk_stop_order.get('linkedorder', 0))  # Номер заявки, выставленной по сработавшей стоп заявке
+            is_stop = not linked_order  # Снимаем стоп заявку, пока она не сработала
+            order_num = stop_order_num if is_stop else linked_order  # После срабатывания снимаем выставленную по ней заявку
+        else:  # Если события по стоп заявке еще не было
+            is_stop = order.exectype in [Order.Stop, Order.StopLimit] and \
+                order_num not in self.qk_orders  # Задана стоп заявка и лимитная заявка не выставлена
         transaction = {
             'TRANS_ID': str(order.ref),  # Номер транзакции задается клиентом
             'CLASSCODE': class_code,  # Код площадки
@@ -348,7 +428,7 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
         else:  # Для лимитной заявки
             transaction['ACTION'] = 'KILL_ORDER'  # Будем удалять лимитную заявку
             transaction['ORDER_KEY'] = str(order_num)  # Номер заявки на бирже
-        self.store.provider.SendTransaction(transaction)  # Отправляем транзакцию на биржу
+        self.store.trade_provider.SendTransaction(transaction)  # Отправляем транзакцию на биржу
         return order  # В список уведомлений ничего не добавляем. Ждем события OnTransReply
 
     def oco_pc_check(self, order):
@@ -386,6 +466,8 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
             return  # не обрабатываем, пропускаем
         order: Order = self.orders[trans_id]  # Ищем заявку по номеру транзакции
         order.addinfo(order_num=order_num)  # Сохраняем номер заявки на бирже
+        if order_num in self.pending_fills:  # Если по заявке есть отложенные сделки
+            self.resolve_fills(order_num, trans_id)  # то номер транзакции заявки теперь известен
         # TODO Есть поле flags, но оно не документировано. Лучше вместо текстового результата транзакции разбирать по нему
         result_msg = str(qk_trans_reply['result_msg']).lower()  # По результату исполнения транзакции (очень плохое решение)
         status = int(qk_trans_reply['status'])  # Статус транзакции
@@ -430,22 +512,145 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
         self.notifs.append(order.clone())  # Уведомляем брокера о заявке
         if order.status != Order.Accepted:  # Если новая заявка не зарегистрирована
             self.oco_pc_check(order)  # то проверяем связанные и родительскую/дочерние заявки (Canceled, Rejected, Margin)
+        if not order.alive():  # Стоп заявка снятой / отклоненной заявки больше не нужна
+            self.forget_stop_order(order)
 
     def on_trade(self, data):
         """Обработчик события получения новой / изменения существующей сделки.
         Выполняется до события изменения существующей заявки. Нужен для определения цены исполнения заявок.
+        Заявка сделки ищется в зеркале заявок QUIK без запроса.
+        Если номер транзакции заявки еще не известен, то сделка откладывается до события по заявке или стоп заявке,
+        или до повторного запроса через fill_timeout секунд. Поток обработки функций обратного вызова не ждет
         """
         qk_trade = data['data']  # Сделка в QUIK
+        if not self.is_new_trade(qk_trade['class_code'], int(qk_trade['trade_num'])):  # Номер сделки дублируется 3 раза
+            return  # Дубль уже обработанной или отложенной сделки не обрабатываем
         order_num = int(qk_trade['order_num'])  # Номер заявки на бирже
-        json_order = self.store.provider.GetOrderByNumber(order_num)['data']  # По номеру заявки в сделке пробуем получить заявку с биржи
-        if isinstance(json_order, int):  # Если заявка не найдена, то в ответ получаем целое число номера заявки. Возможно заявка есть, но она не успела прийти к брокеру
-            print(f'Заявка с номером {order_num} не найдена на бирже с 1-ой попытки. Через 3 с будет 2-ая попытка')
-            time.sleep(3)  # Ждем 3 секунды, пока заявка не придет к брокеру
-            json_order = self.store.provider.GetOrderByNumber(order_num)['data']  # Снова пробуем получить заявку с биржи по ее номеру
-            if isinstance(json_order, int):  # Если заявка так и не была найдена
-                print(f'Заявка с номером {order_num} не найдена на бирже со 2-ой попытки')
-                return  # то выходим, дальше не продолжаем
-        trans_id = int(json_order['trans_id'])  # Получаем номер транзакции из заявки с биржи
+        qk_order = self.qk_orders.get(order_num)  # Заявка сделки из зеркала заявок QUIK
+        trans_id = self.order_trans_id(qk_order) if qk_order is not None else 0  # Номер транзакции заявки
+        if not trans_id:  # Если события по заявке еще не было, или она выставлена по стоп заявке, события по которой еще не было
+            with self.fills_lock:
+                is_first = order_num not in self.pending_fills  # Первая отложенная сделка по заявке
+                self.pending_fills[order_num].append(qk_trade)  # Откладываем сделку до события по заявке
+            if is_first:  # Повторный запрос заявки ставим один раз на заявку
+                timer = Timer(self.p.fill_timeout, self.retry_fills, (order_num,))
+                timer.daemon = True
+                timer.start()
+            return
+        self.execute_trade(trans_id, order_num, qk_trade)
+
+    def retry_fills(self, order_num, attempt=1):
+        """Повторный запрос заявки отложенных сделок
+
+        Пока номер транзакции заявки не известен, сделки остаются отложенными до события по заявке или стоп заявке,
+        а запрос повторяется через fill_timeout секунд. После fill_retries попыток сделки снимаются с отложенных,
+        а их номера забываются, чтобы повторная доставка сделки из QUIK обработала ее заново
+        """
+        if order_num not in self.pending_fills:  # Если сделки уже обработаны по событию заявки
+            return
+        json_order = self.store.provider.GetOrderByNumber(order_num)['data']  # Снова пробуем получить заявку с биржи по ее номеру
+        trans_id = 0 if isinstance(json_order, int) else self.order_trans_id(json_order)  # Номер транзакции заявки, если заявка найдена
+        if trans_id:  # Если номер транзакции заявки стал известен
+            self.resolve_fills(order_num, trans_id)  # то обрабатываем сделки
+            return
+        if attempt < self.p.fill_retries:  # Если попытки еще есть, то сделки остаются отложенными
+            timer = Timer(self.p.fill_timeout, self.retry_fills, (order_num, attempt + 1))
+            timer.daemon = True
+            timer.start()
+            return
+        print(f'Номер транзакции заявки {order_num} не получен за {self.p.fill_timeout * self.p.fill_retries:g} с')
+        with self.fills_lock:
+            for qk_trade in self.pending_fills.pop(order_num, ()):  # Снимаем сделки с отложенных
+                self.trade_nums.pop((qk_trade['class_code'], int(qk_trade['trade_num'])), None)  # и забываем их номера
+
+    def resolve_fills(self, order_num, trans_id):
+        """Обработка отложенных сделок заявки, номер транзакции которой стал известен"""
+        with self.fills_lock:
+            qk_trades = self.pending_fills.pop(order_num, None)
+        for qk_trade in qk_trades or ():
+            self.execute_trade(trans_id, order_num, qk_trade)
+
+    def on_order(self, data):
+        """Обработчик события получения новой / изменения существующей заявки"""
+        qk_order = data['data']  # Заявка в QUIK
+        order_num = int(qk_order['order_num'])  # Номер заявки на бирже
+        trans_id = self.order_trans_id(qk_order)  # Номер транзакции заявки
+        if qk_order['flags'] & 0b1:  # Если заявка активна (бит 0)
+            self.qk_orders[order_num] = qk_order  # то обновляем зеркало заявок
+        else:  # Исполненную или снятую заявку убираем из зеркала вместе с ее стоп заявкой
+            self.qk_orders.pop(order_num, None)
+            self.qk_stop_orders.pop(self.stop_linked.pop(order_num, None), None)
+        if trans_id and order_num in self.pending_fills:  # Если по заявке с известным номером транзакции есть отложенные сделки
+            self.resolve_fills(order_num, trans_id)
+
+    def forget_stop_order(self, order):
+        """Удаление из зеркала стоп заявки завершенной заявки BackTrader и ее связи с выставленной заявкой"""
+        if 'stop_order_num' not in order.info:  # Если заявка не стоп заявка
+            return
+        qk_stop_order = self.qk_stop_orders.pop(order.info['stop_order_num'], None)
+        if qk_stop_order is not None:
+            self.stop_linked.pop(int(qk_stop_order.get('linkedorder', 0)), None)
+
+    def order_trans_id(self, qk_order):
+        """Номер транзакции заявки QUIK
+
+        :param dict qk_order: Заявка QUIK
+        :return: Номер транзакции. У заявки, выставленной по стоп заявке без номера транзакции, - номер транзакции стоп заявки.
+        0 - заявка выставлена не из автоторговли, или событие по ее стоп заявке еще не пришло
+        """
+        trans_id = int(qk_order['trans_id'])
+        if not trans_id:  # Если у заявки нет номера транзакции
+            qk_stop_order = self.qk_stop_orders.get(self.stop_linked.get(int(qk_order['order_num'])))  # Стоп заявка, по которой выставлена заявка
+            if qk_stop_order is not None:
+                trans_id = int(qk_stop_order['trans_id'])  # то берем номер транзакции стоп заявки
+        return trans_id
+
+    def is_new_trade(self, class_code, trade_num):
+        """Проверка сделки на дубль. Запоминаются последние trade_nums_size номеров сделок, старые вытесняются
+
+        :param str class_code: Код площадки
+        :param int trade_num: Номер сделки
+        :return: True, если сделка пришла впервые
+        """
+        key = (class_code, trade_num)
+        with self.fills_lock:  # Сделки обрабатываются и из потоков повторного запроса заявок
+            is_new = key not in self.trade_nums
+            if is_new:  # Если сделка пришла впервые
+                self.trade_nums[key] = None  # то запоминаем ее номер
+                if len(self.trade_nums) > self.p.trade_nums_size:  # Если номеров больше, чем нужно хранить
+                    self.trade_nums.popitem(last=False)  # то вытесняем самый старый
+            size = len(self.trade_nums)
+        if self.store.metrics:  # Считаем дубли и размер фильтра дублей
+            if is_new:
+                self.store.metrics.set('qk_trade_nums', size)
+            else:
+                self.store.metrics.inc('qk_trade_duplicates_total')
+        return is_new
+
+    def on_stop_order(self, data):
+        """Обработчик события получения новой / изменения существующей стоп заявки"""
+        qk_stop_order = data['data']  # Стоп заявка в QUIK
+        stop_order_num = int(qk_stop_order['order_num'])  # Номер стоп заявки на бирже
+        trans_id = int(qk_stop_order['trans_id'])  # Номер транзакции стоп заявки
+        if trans_id in self.orders:  # Для стоп заявки из автоторговли
+            self.orders[trans_id].addinfo(stop_order_num=stop_order_num)  # запоминаем номер стоп заявки для ее снятия
+        linked_order = int(qk_stop_order.get('linkedorder', 0))  # Номер заявки, выставленной по сработавшей стоп заявке
+        if qk_stop_order['flags'] & 0b1 or linked_order:  # Если стоп заявка активна (бит 0) или сработала
+            self.qk_stop_orders[stop_order_num] = qk_stop_order  # то обновляем зеркало стоп заявок
+        else:  # Снятую стоп заявку убираем из зеркала
+            self.qk_stop_orders.pop(stop_order_num, None)
+        if linked_order:  # Если стоп заявка сработала
+            self.stop_linked[linked_order] = stop_order_num  # то запоминаем ее для выставленной заявки
+            if linked_order in self.pending_fills:  # Сделки заявки могли прийти раньше события по стоп заявке
+                self.resolve_fills(linked_order, trans_id)
+
+    def execute_trade(self, trans_id, order_num, qk_trade):
+        """Исполнение заявки BackTrader по сделке
+
+        :param int trans_id: Номер транзакции заявки
+        :param int order_num: Номер заявки на бирже
+        :param dict qk_trade: Сделка в QUIK
+        """
         if trans_id == 0:  # Заявки, выставленные не из автоторговли / только что (с нулевыми номерами транзакции)
             return  # не обрабатываем, пропускаем
         if trans_id not in self.orders:  # Пришла заявка не из автоторговли
@@ -455,28 +660,26 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
         order.addinfo(order_num=order_num)  # Сохраняем номер заявки на бирже (может быть переход от стоп заявки к лимитной с изменением номера на бирже)
         class_code = qk_trade['class_code']  # Код площадки
         sec_code = qk_trade['sec_code']  # Код тикера
-        dataname = self.store.class_sec_code_to_data_name(class_code, sec_code)  # Получаем название тикера по коду площадки и коду тикера
-        trade_num = int(qk_trade['trade_num'])  # Номер сделки (дублируется 3 раза)
-        if dataname not in self.trade_nums.keys():  # Если это первая сделка по тикеру
-            self.trade_nums[dataname] = []  # то ставим пустой список сделок
-        elif trade_num in self.trade_nums[dataname]:  # Если номер сделки есть в списке (фильтр для дублей)
-            return  # то выходим, дальше не продолжаем
-        self.trade_nums[dataname].append(trade_num)  # Запоминаем номер сделки по тикеру, чтобы в будущем ее не обрабатывать (фильтр для дублей)
+        converter = self.store.get_converter(class_code, sec_code)  # Перевод кол-ва и цен тикера
         size = int(qk_trade['qty'])  # Абсолютное кол-во
         if self.p.Lots:  # Если входящий остаток в лотах
-            size = self.store.lots_to_size(class_code, sec_code, size)  # то переводим кол-во из лотов в штуки
+            size = converter.lots_to_size(size)  # то переводим кол-во из лотов в штуки
         if qk_trade['flags'] & 0b100 == 0b100:  # Если сделка на продажу (бит 2)
             size *= -1  # то кол-во ставим отрицательным
-        price = self.store.quik_to_bt_price(class_code, sec_code, float(qk_trade['price']))  # Переводим цену исполнения за лот в цену исполнения за штуку
+        price = converter.quik_to_bt_price(float(qk_trade['price']))  # Переводим цену исполнения за лот в цену исполнения за штуку
         try:  # TODO Очень редко возникает ошибка:
             #    linebuffer.py, line 163, in __getitem__
             #    return self.array[self.idx + ago]
             #    IndexError: array index out of range
             dt = order.data.datetime[0]  # Дата и время исполнения заявки. Последняя известная
         except (KeyError, IndexError):  # При ошибке
-            dt = datetime.now(QKStore.MarketTimeZone)  # Берем текущее время на бирже из локального
+            dt = datetime.now(self.store.MarketTimeZone)  # Берем текущее время на бирже из локального
         pos = self.getposition(order.data)  # Получаем позицию по тикеру или нулевую позицию если тикера в списке позиций нет
         psize, pprice, opened, closed = pos.update(size, price)  # Обновляем размер/цену позиции на размер/цену сделки
+        if self.p.reconcile_period and not self.p.IsFutures:  # Стоимость позиций по бумагам до следующей сверки меняем на сделку
+            with self.account_lock:
+                self.value += size * price
+                self.value_delta += size * price
         order.execute(dt, size, price, closed, 0, 0, opened, 0, 0, 0, 0, psize, pprice)  # Исполняем заявку в BackTrader
         if order.executed.remsize:  # Если заявка исполнена частично (осталось что-то к исполнению)
             if order.status != order.Partial:  # Если заявка переходит в статус частичного исполнения (может исполняться несколькими частями)
@@ -488,3 +691,38 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
             # Снимаем oco-заявку только после полного исполнения заявки
             # Если нужно снять oco-заявку на частичном исполнении, то прописываем это правило в ТС
             self.oco_pc_check(order)  # Проверяем связанные и родительскую/дочерние заявки (Completed)
+            self.forget_stop_order(order)  # Стоп заявка исполненной заявки больше не нужна
+
+    def on_futures_limit_change(self, data):
+        """Обработчик события изменения фьючерсного лимита"""
+        qk_futures_limit = data['data']  # Фьючерсный лимит
+        if qk_futures_limit['firmid'] != self.p.FirmId or qk_futures_limit['trdaccid'] != self.p.TradeAccountId or \
+                int(qk_futures_limit['limit_type']) != 0 or not self.p.IsFutures:  # Лимит не по счету брокера
+            return  # не обрабатываем, пропускаем
+        with self.account_lock:
+            self.cash = float(qk_futures_limit['cbplimit']) + float(qk_futures_limit['varmargin']) + float(qk_futures_limit['accruedint'])  # Лимит откр.поз. + Вариац.маржа + Накоплен.доход
+            self.value = float(qk_futures_limit['cbplused'])  # Тек.чист.поз. (Заблокированное ГО под открытые позиции)
+            self.limits_seq += 1
+
+    def on_money_limit(self, data):
+        """Обработчик события изменения денежного лимита"""
+        qk_money_limit = data['data']  # Денежный лимит
+        if qk_money_limit['client_code'] != self.p.ClientCode or qk_money_limit['firmid'] != self.p.FirmId or \
+                int(qk_money_limit['limit_kind']) != self.p.LimitKind or qk_money_limit['currcode'] != self.p.CurrencyCode or \
+                self.p.IsFutures:  # Лимит не по счету брокера
+            return  # не обрабатываем, пропускаем
+        with self.account_lock:
+            self.cash = float(qk_money_limit['currentbal'])  # Денежный лимит (остаток) по счету
+            self.limits_seq += 1
+
+    def on_quote(self, class_code, sec_code, old_price, new_price):
+        """Изменение последней цены тикера. Стоимость позиций по бумагам до следующей сверки меняем на изменение цены"""
+        if self.p.IsFutures or not self.p.reconcile_period or old_price is None:
+            return
+        pos = self.positions.get(self.store.class_sec_code_to_data_name(class_code, sec_code))  # Позиция по тикеру без создания нулевой
+        if pos and pos.size:
+            converter = self.store.get_converter(class_code, sec_code)  # Перевод цен тикера. Может запрашивать QUIK, поэтому до блокировки
+            delta = pos.size * (converter.quik_to_bt_price(new_price) - converter.quik_to_bt_price(old_price))
+            with self.account_lock:
+                self.value += delta
+                self.value_delta += delta
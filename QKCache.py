@@ -0,0 +1,103 @@
+import os
+from array import array
+from threading import Lock
+
+from .QKBars import QKBars
+
+
+class QKCache:
+    """Локальный кэш свечей QUIK
+
+    На каждый тикер/интервал заводится папка <Код площадки>.<Код тикера>_<Интервал>.
+    Свечи хранятся в ней по столбцам: по файлу на каждый столбец.
+    Новые свечи дописываются в конец файлов
+    """
+
+    columns = QKBars.columns  # Дата/время открытия в формате BackTrader, цены, объем
+    typecode = 'd'  # Все столбцы хранятся как float
+
+    def __init__(self, path):
+        """
+        :param str path: Папка кэша
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.lock = Lock()  # Дописывать свечи тикера могут сразу несколько потоков
+
+    def key_path(self, class_code, sec_code, interval):
+        """Папка свечей тикера/интервала"""
+        return os.path.join(self.path, f'{class_code}.{sec_code}_{interval}')
+
+    def column_path(self, class_code, sec_code, interval, column):
+        """Файл столбца свечей тикера/интервала"""
+        return os.path.join(self.key_path(class_code, sec_code, interval), f'{column}.bin')
+
+    def load(self, class_code, sec_code, interval):
+        """Загрузка свечей из кэша
+
+        :param str class_code: Код площадки
+        :param str sec_code: Код тикера
+        :param int interval: Временной интервал в минутах
+        :return: Буфер баров. Пустой, если баров в кэше нет
+        """
+        bars = QKBars()
+        for column in self.columns:
+            values = getattr(bars, column)
+            try:
+                with open(self.column_path(class_code, sec_code, interval, column), 'rb') as f:
+                    raw = f.read()
+            except FileNotFoundError:  # Столбца нет. Кэш пустой
+                continue
+            values.frombytes(raw[:len(raw) - len(raw) % values.itemsize])  # Отбрасываем недописанное значение
+        # Если дозапись была прервана, то столбцы могут отличаться по длине. Оставляем только полные бары
+        size = min(len(getattr(bars, column)) for column in self.columns)
+        for column in self.columns:
+            del getattr(bars, column)[size:]
+        bars.live.frombytes(bytes(size))  # Бары из кэша всегда исторические
+        return bars
+
+    def last_datetime(self, class_code, sec_code, interval):
+        """Дата/время открытия последней свечи в кэше или None, если свечей нет"""
+        values = array(self.typecode)
+        try:
+            with open(self.column_path(class_code, sec_code, interval, 'datetime'), 'rb') as f:
+                size = f.seek(0, os.SEEK_END) // values.itemsize  # Кол-во значений в файле
+                if not size:
+                    return None
+                f.seek((size - 1) * values.itemsize)
+                values.frombytes(f.read(values.itemsize))
+        except FileNotFoundError:
+            return None
+        return values[0]
+
+    def repair(self, class_code, sec_code, interval):
+        """Обрезка столбцов до кол-ва полных свечей после прерванной дозаписи"""
+        paths = [self.column_path(class_code, sec_code, interval, column) for column in self.columns]
+        sizes = [os.path.getsize(path) if os.path.exists(path) else 0 for path in paths]  # Размеры столбцов. Нет столбца - нет свечей
+        itemsize = array(self.typecode).itemsize
+        size = min(sizes) // itemsize * itemsize  # Размер полных столбцов
+        for path, path_size in zip(paths, sizes):
+            if path_size != size:
+                os.truncate(path, size)
+
+    def append(self, class_code, sec_code, interval, bars):
+        """Дозапись баров в кэш
+
+        В кэш попадают только бары новее последнего бара в кэше
+
+        :param str class_code: Код площадки
+        :param str sec_code: Код тикера
+        :param int interval: Временной интервал в минутах
+        :param QKBars bars: Бары, отсортированные по дате/времени открытия
+        """
+        with self.lock:
+            self.repair(class_code, sec_code, interval)
+            last_dt = self.last_datetime(class_code, sec_code, interval)
+            if last_dt is not None:  # Пропускаем бары, которые уже есть в кэше
+                bars = bars.since(last_dt)
+            if not bars:  # Если новых баров нет
+                return  # то выходим, дальше не продолжаем
+            os.makedirs(self.key_path(class_code, sec_code, interval), exist_ok=True)
+            for column in self.columns:
+                with open(self.column_path(class_code, sec_code, interval, column), 'ab') as f:
+                    getattr(bars[:], column).tofile(f)
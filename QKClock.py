@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+from threading import Lock
+from time import monotonic
+
+
+class QKClock:
+    """Биржевые часы QUIK
+
+    Сверяются с сервером QUIK не чаще одного раза в period секунд.
+    Между сверками время отсчитывается по монотонным часам компьютера
+    """
+
+    def __init__(self, store, period=60):
+        """
+        :param QKStore store: Хранилище QUIK
+        :param float period: Период сверки с сервером QUIK в секундах
+        """
+        self.store = store
+        self.period = period
+        self.lock = Lock()  # Часами пользуются все данные и поток обработки функций обратного вызова
+        self.server_dt = None  # Время сервера QUIK на момент последней сверки
+        self.synced = None  # Монотонное время последней сверки
+
+    def now(self):
+        """Текущее биржевое время"""
+        with self.lock:
+            # Если сверки еще не было или с нее прошло больше периода
+            if self.synced is None or monotonic() - self.synced >= self.period:
+                self.sync()  # то сверяемся с сервером QUIK
+            return self.server_dt + timedelta(seconds=monotonic() - self.synced)
+
+    def reset(self):
+        """Сверка при следующем запросе времени. Например, после переподключения к серверу QUIK"""
+        with self.lock:
+            self.synced = None
+
+    def sync(self):
+        """Сверка с сервером QUIK"""
+        provider = self.store.provider
+        # Может прийти неверная дата
+        # TODO: check on weekends
+        d = provider.getInfoParam('TRADEDATE')  # Дата dd.mm.yyyy
+        t = provider.getInfoParam('SERVERTIME')  # Время hh:mi:ss
+        self.synced = monotonic()
+        try:
+            self.server_dt = datetime.strptime(f'{d} {t}', '%d.%m.%Y %H:%M:%S')
+        except (TypeError, ValueError):  # Если QUIK не вернул время. Например, нет подключения к серверу
+            # то берем МСК время из локального времени до следующей сверки
+            self.server_dt = datetime.now(self.store.MarketTimeZone).replace(tzinfo=None)
@@ -0,0 +1,98 @@
+from array import array
+from itertools import repeat
+from operator import mul, truediv
+from typing import NamedTuple
+
+from .QKBars import QKBars
+
+
+class QKConverter(NamedTuple):
+    """Перевод кол-ва и цен тикера между BackTrader и QUIK
+
+    Создается хранилищем один раз на тикер. Все параметры тикера рассчитаны заранее,
+    перевод - только арифметика без запросов информации о тикере.
+    Цена QUIK = Цена BackTrader * price_mul / price_div
+    """
+
+    class_code: str  # Код площадки
+    sec_code: str  # Код тикера
+    lot_size: int = 0  # Размер лота. 0 - кол-во не переводится
+    price_mul: float = 1  # Множитель цены BackTrader для получения цены QUIK. Для фьючерсов - размер лота
+    price_div: float = 1  # Делитель цены BackTrader для получения цены QUIK. Для облигаций - 10
+    min_price_step: float = None  # Минимальный шаг цены. None - тикер не найден
+    scale: int = None  # Кол-во значащих цифр после запятой. None - тикер не найден
+
+    @classmethod
+    def from_symbol_info(cls, class_code, sec_code, symbol_info):
+        """Перевод по информации о тикере
+
+        :param str class_code: Код площадки
+        :param str sec_code: Код тикера
+        :param dict symbol_info: Информация о тикере. None - тикер не найден
+        """
+        if not symbol_info:  # Если тикер не найден
+            # то кол-во не переводится, а цены переводятся только для рынка облигаций
+            return cls(class_code, sec_code, price_div=10 if class_code == 'TQOB' else 1)
+        lot_size = symbol_info['lot_size']  # Размер лота тикера
+        if lot_size <= 0:  # Если лот не задан
+            lot_size = 0  # то кол-во не переводится
+        price_mul, price_div = 1, 1
+        if class_code == 'TQOB':  # Для рынка облигаций
+            price_div = 10  # цену BackTrader делим на 10
+        elif class_code == 'SPBFUT' and lot_size:  # Для рынка фьючерсов с заданным лотом
+            price_mul = lot_size  # цену BackTrader умножаем на лот
+        return cls(class_code, sec_code, lot_size, price_mul, price_div,
+                   float(symbol_info['min_price_step']), int(symbol_info['scale']))
+
+    def size_to_lots(self, size):
+        """Перевод кол-ва из штук в лоты"""
+        return int(size / self.lot_size) if self.lot_size else size
+
+    def lots_to_size(self, lots):
+        """Перевод кол-ва из лотов в штуки"""
+        return lots * self.lot_size if self.lot_size else lots
+
+    def bt_to_quik_price(self, price):
+        """Перевод цены из BackTrader в QUIK"""
+        return price * self.price_mul / self.price_div
+
+    def quik_to_bt_price(self, price):
+        """Перевод цены из QUIK в BackTrader"""
+        return price * self.price_div / self.price_mul
+
+    def bt_to_quik_prices(self, prices):
+        """Перевод пакета цен из BackTrader в QUIK
+
+        :param array prices: Цены BackTrader
+        :return: Новый массив цен QUIK
+        """
+        return self.scale_prices(prices, self.price_mul, self.price_div)
+
+    def quik_to_bt_prices(self, prices):
+        """Перевод пакета цен из QUIK в BackTrader
+
+        :param array prices: Цены QUIK
+        :return: Новый массив цен BackTrader
+        """
+        return self.scale_prices(prices, self.price_div, self.price_mul)
+
+    def quik_to_bt_bars(self, bars):
+        """Перевод цен пакета баров из QUIK в BackTrader
+
+        :param QKBars bars: Бары с ценами QUIK
+        :return: Новый буфер баров с ценами BackTrader
+        """
+        result = QKBars()
+        for column in QKBars.columns + ('live',):
+            values = getattr(bars, column)[bars.head:]
+            if column in ('open', 'high', 'low', 'close'):
+                values = self.quik_to_bt_prices(values)
+            getattr(result, column).extend(values)
+        return result
+
+    @staticmethod
+    def scale_prices(prices, multiplier, divisor):
+        """Цены, умноженные на multiplier и деленные на divisor. Перевод идет без цикла Python"""
+        if multiplier == divisor == 1:  # Если цены не переводятся
+            return array('d', prices)  # то только копируем их
+        return array('d', map(truediv, map(mul, prices, repeat(multiplier)), repeat(divisor)))
@@ -1,10 +1,12 @@
 from datetime import datetime, timedelta, time
-from collections import deque
+from itertools import repeat
 
 from backtrader.feed import AbstractDataBase
+from backtrader.linebuffer import LineBuffer, NAN
 from backtrader.metabase import MetaParams
 from backtrader import TimeFrame, date2num
-from backtrader.filters import SessionFilter
+
+from .QKBars import QKBars
 
 
 class QKData(AbstractDataBase):
@@ -14,7 +16,10 @@ class QKData(AbstractDataBase):
         # False - пропускать дожи 4-х цен, True - не пропускать
         ('FourPriceDoji', False),
         ('live', False),  # False - только история, True - история и новые бары
-        ('count', 0)  # Кол-во полученных свечей. 0 - все доступные
+        ('count', 0),  # Кол-во полученных свечей. 0 - все доступные
+        ('qcheck', 0.5),  # Максимальное время ожидания нового бара в секундах (в live)
+        # False - цены QUIK, True - цены BackTrader (за штуку, облигации в валюте). Как у брокера
+        ('bt_prices', False),
     )
 
     _time_correction = timedelta(seconds=1)
@@ -37,51 +42,64 @@ class QKData(AbstractDataBase):
                 self.interval = 23200
         self.interval *= self.p.compression
 
-        self.time_offset = timedelta(minutes=self.interval)
+        self.time_offset = self.interval / 1440  # Длительность бара в формате BackTrader
 
         # Передаем параметры в хранилище QUIK. Может работать самостоятельно, не через хранилище
         self.store = store
         self.prov = self.store.provider
         # По тикеру получаем код площадки и код тикера
         self.class_code, self.sec_code = self.store.from_ticker(self.p.dataname)
+        self.converter = self.store.get_converter(self.class_code, self.sec_code)  # Перевод цен тикера
 
-        self.bars = deque()
+        self.bars = QKBars()  # Буфер баров по столбцам
+        self.history = None  # Исторические бары, заранее загруженные хранилищем
+        self.history_last_dt = None  # Дата/время открытия последнего бара истории. После него пойдут бары подписки
+        self.builder = None  # Сборщик баров из подписки на меньший интервал
+        self.session = None  # Начало и окончание торговой сессии в секундах с начала дня
+        self.feed_name = f'{self.class_code}.{self.sec_code}_{self.interval}'  # Название данных в метриках
 
     def setenvironment(self, env):
         """Добавление хранилища QUIK в cerebro"""
         super().setenvironment(env)
         env.addstore(self.store)  # Добавление хранилища QUIK в cerebro
+        # Хранилище заранее загрузит историю всех своих данных.
+        # Сравниваем по ссылке, т.к. == у данных BackTrader создает индикатор
+        if not any(data is self for data in self.store.datas):
+            self.store.datas.append(self)
 
     def start(self):
         super().start()
-        if not self.p.FourPriceDoji:
-            self.addfilter(DojiFilter)
-
-        if (self.p.sessionstart != time.min
-                or self.p.sessionend != time(23, 59, 59, 999990)):
-            self.addfilter(SessionFilter)
-
+        self.feed_name = self._name or self.feed_name  # Название, заданное в cerebro
+        # Дожи 4-х цен и бары вне сессии отбрасываем при поступлении, до линий BackTrader
+        self.session = self.session_seconds()
         self.subs2bars()
 
     def subs2bars(self):
         # Отправляем уведомление об отправке исторических (не новых) баров
         self.put_notification(self.NOTSUBSCRIBED)
-        # Добавляем в список подписанных тикеров/интервалов
-        dataname = f'{self.class_code}.{self.sec_code}_{self.interval}'
-        self.store.subscribed_data[dataname] = self
 
-        self.bars.extend(self.prov.get_candles_ds(self.class_code, self.sec_code,
-                                                  self.interval, self.p.count))
+        # Если хранилище не загрузило историю заранее, то загружаем ее сами
+        history = self.history if self.history is not None else self.get_history()
+        self.history = None
 
         if self.p.live:
             # Delete the last bar because it will return by subscription
-            self.bars.pop()
-            # TODO: Does is_subs check needed?
-            if not self.prov.is_subs(self.class_code, self.sec_code, self.interval):
-                self.prov.subs_to_candles(self.class_code, self.sec_code, self.interval)
+            if history:
+                history.pop()
         else:
-            if self.is_unformed_bar(self.bars[-1]):
-                self.bars.pop()
+            if history and self.is_unformed_bar(history.datetime[-1]):
+                history.pop()
+        if history:
+            self.history_last_dt = history.datetime[-1]
+        history = history.select(self.batch_mask(history))
+        if self.p.bt_prices:  # Цены переводим всем пакетом
+            history = self.converter.quik_to_bt_bars(history)
+        self.bars.extend(history)
+
+        if self.p.live:
+            # Подписываемся через хранилище после истории, чтобы новые бары шли за историческими.
+            # Бары могут собираться из подписки на меньший интервал
+            self.store.subscribe(self)
 
         if self.bars:
             # Отправляем уведомление о подключении и начале получения исторических баров
@@ -100,67 +118,190 @@ class QKData(AbstractDataBase):
                 return False
             if self._laststatus != self.LIVE:
                 self.put_notification(self.LIVE)
-            return None
+            # Ждем новый бар от потока обработки функций обратного вызова, а не опрашиваем буфер.
+            # Время ожидания задает cerebro через do_qcheck
+            if not self.bars.wait(self._qcheck):
+                return None
 
-        bar = self.bars.popleft()
+        dt, bar_open, high, low, close, volume, live = self.bars.popleft()
         # TODO: Could be removed
-        if not self.is_old_bar(bar):
+        if not self.is_old_bar(dt):
             return None
 
         # Бывает ситуация, когда QUIK несколько минут не передает новые бары,
         # а затем передает все пропущенные. Чтобы не совершать сделки на истории,
         # меняем режим торгов на историю до прихода нового бара
         # Если в LIVE режиме, и следующий бар не является LIVE
-        if self._laststatus == self.LIVE and not bar['live']:
+        if self._laststatus == self.LIVE and not live:
             # Отправляем уведомление об отправке исторических (не новых) баров
             self.put_notification(self.DELAYED)
 
-        # Переводим в формат хранения даты/времени в BackTrader
-        self.lines.datetime[0] = date2num(self.open_datetime(bar))
-        # self.lines.open[0] = self.store.quik_to_bt_price(self.class_code, self.sec_code, bar['open'])
-        # self.lines.high[0] = self.store.quik_to_bt_price(self.class_code, self.sec_code, bar['high'])
-        # self.lines.low[0] = self.store.quik_to_bt_price(self.class_code, self.sec_code, bar['low'])
-        # self.lines.close[0] = self.store.quik_to_bt_price(self.class_code, self.sec_code, bar['close'])
-        self.lines.open[0] = bar['open']
-        self.lines.high[0] = bar['high']
-        self.lines.low[0] = bar['low']
-        self.lines.close[0] = bar['close']
-        self.lines.volume[0] = bar['volume']
+        # Дата/время уже в формате хранения BackTrader
+        self.lines.datetime[0] = dt
+        self.lines.open[0] = bar_open
+        self.lines.high[0] = high
+        self.lines.low[0] = low
+        self.lines.close[0] = close
+        self.lines.volume[0] = volume
         # Открытый интерес в QUIK не учитывается
         self.lines.openinterest[0] = 0
+        if self.store.metrics:  # Считаем бары, выданные в BackTrader
+            self.store.metrics.inc('qk_feed_bars_total', feed=self.feed_name)
         return True
 
+    def preload(self):
+        """Загрузка всех исторических баров в линии BackTrader одним пакетом
+
+        Бары в буфере уже отобраны по датам, дожи 4-х цен и сессии.
+        Если к данным добавлены фильтры, то бары загружаются по одному
+        """
+        lines = self.lines.lines
+        if (self._filters or self._ffilters or self._tzinput or self._barstack or self._barstash
+                or any(line.mode != LineBuffer.UnBounded or line.extension for line in lines)):
+            return super().preload()
+        bars = self.bars
+        bars.compact()  # Столбцы начинаются с первого не забранного бара
+        size = len(bars)
+        for alias, line in zip(self.lines.getlinealiases(), lines):
+            if alias in QKBars.columns:
+                line.array.extend(getattr(bars, alias))
+            else:  # Открытый интерес в QUIK не учитывается
+                line.array.extend(repeat(0.0 if alias == 'openinterest' else NAN, size))
+            line.idx += size
+            line.lencount += size
+        bars.clear()
+        if self.store.metrics:
+            self.store.metrics.inc('qk_feed_bars_total', size, feed=self.feed_name)
+        self._last()
+        self.home()
+        self.put_notification(self.DISCONNECTED)
+
     def stop(self):
         super().stop()
         if self.p.live:
-            self.prov.unsubs_from_candles(self.class_code, self.sec_code, self.interval)
+            self.store.unsubscribe(self)
         self.put_notification(self.DISCONNECTED)
 
     def haslivedata(self):
-        return self._laststatus==self.LIVE
+        """Есть ли новые бары в буфере. Если нет, то cerebro даст время на их ожидание"""
+        return self._laststatus == self.LIVE and len(self.bars) > 0
 
     # Функции
 
-    def is_old_bar(self, bar):
-        """Проверка бара на соответствие условиям выборки"""
+    def get_history(self, provider=None, now=None):
+        """Исторические бары в диапазоне дат fromdate/todate
+
+        Если в хранилище задан кэш свечей, то берем бары из кэша, а из QUIK получаем только новые.
+        Новые сформированные бары дописываем в кэш.
+        Без кэша при заданной начальной дате получаем из QUIK только бары с нее
+
+        :param QuikPy provider: Подключение к QUIK. По умолчанию, подключение хранилища
+        :param float now: Текущее биржевое время в формате BackTrader. По умолчанию, по биржевым часам
+        """
+        provider = provider or self.prov
+        fromdate = date2num(self.p.fromdate) if self.p.fromdate else float('-inf')  # Начальная дата
+        todate = date2num(self.p.todate) if self.p.todate else float('inf')  # Конечная дата
+        cache = self.store.cache
+        if not cache:  # Если кэша нет
+            if self.p.count or fromdate == float('-inf'):  # Если задано кол-во баров или не задана начальная дата
+                bars = QKBars.from_quik(provider.get_candles_ds(
+                    self.class_code, self.sec_code, self.interval, self.p.count))
+            else:  # Если задана только начальная дата
+                bars = self.get_bars_since(fromdate, provider, now)  # то получаем бары с нее
+            return bars.between(fromdate, todate)
+        cached = cache.load(self.class_code, self.sec_code, self.interval)
+        if not cached:  # Если кэш пустой
+            # то заполняем его всеми барами. Начальную дату не учитываем, чтобы в кэше не было пропусков
+            new_bars = QKBars.from_quik(provider.get_candles_ds(
+                self.class_code, self.sec_code, self.interval, self.p.count))
+        else:
+            last_dt = cached.datetime[-1]  # Дата/время открытия последнего бара в кэше
+            # Если в кэше есть все бары до конечной даты, то в QUIK не обращаемся.
+            # Иначе, получаем из QUIK бары, начиная с последнего в кэше
+            new_bars = QKBars() if last_dt >= todate else self.get_bars_since(last_dt, provider, now).since(last_dt)
+        # Последний бар может быть несформированным. В кэш его не заносим
+        cache.append(self.class_code, self.sec_code, self.interval, new_bars[:-1])
+        # Если задано кол-во баров, то пропускаем все бары, кроме последних
+        skip = max(len(cached) + len(new_bars) - self.p.count, 0) if self.p.count else 0
+        history = cached[skip:].between(fromdate, todate)
+        history.extend(new_bars[max(skip - len(cached), 0):].between(fromdate, todate))
+        return history
+
+    def get_bars_since(self, dt, provider=None, now=None):
+        """Бары из QUIK, начиная с бара с датой/временем открытия dt
+
+        :param float dt: Дата/время открытия бара в формате BackTrader
+        :param QuikPy provider: Подключение к QUIK. По умолчанию, подключение хранилища
+        :param float now: Текущее биржевое время в формате BackTrader. По умолчанию, по биржевым часам
+        """
+        return self.store.get_bars_since(self.class_code, self.sec_code, self.interval, dt, provider or self.prov, now)
+
+    def put_bar(self, dt, open, high, low, close, volume, live=False):
+        """Постановка нового бара в буфер. Вызывается хранилищем из потока обработки функций обратного вызова
+
+        Дожи 4-х цен и бары вне сессии в буфер не попадают
+        """
+        if not self.p.FourPriceDoji and high == low:  # Если пропускаем дожи 4-х цен
+            return
+        if self.session and not self.session[0] <= round(dt % 1 * 86400, 3) <= self.session[1]:  # Если бар вне сессии
+            return
+        if self.p.bt_prices:
+            converter = self.converter
+            open, high, low, close = (converter.quik_to_bt_price(open), converter.quik_to_bt_price(high),
+                                      converter.quik_to_bt_price(low), converter.quik_to_bt_price(close))
+        self.bars.append(dt, open, high, low, close, volume, live)
+
+    def session_seconds(self):
+        """Начало и окончание торговой сессии в секундах с начала дня. None, если сессия не задана"""
+        if (self.p.sessionstart == time.min
+                and self.p.sessionend == time(23, 59, 59, 999990)):
+            return None
+        start, end = self.p.sessionstart, self.p.sessionend
+        return (start.hour * 3600 + start.minute * 60 + start.second + start.microsecond / 1e6,
+                end.hour * 3600 + end.minute * 60 + end.second + end.microsecond / 1e6)
+
+    def batch_mask(self, bars):
+        """Какие бары пакета оставить. Дожи 4-х цен и бары вне сессии отбрасываем
+
+        :param QKBars bars: Пакет баров
+        :return: Список признаков. True - бар оставляем, False - отбрасываем
+        """
+        keep = [True] * len(bars)
+        if not self.p.FourPriceDoji:  # Если пропускаем дожи 4-х цен
+            keep = [high != low for high, low in zip(bars.high[bars.head:], bars.low[bars.head:])]
+        if self.session:  # Если задана торговая сессия
+            start, end = self.session
+            # Время открытия бара в секундах с начала дня округляем, чтобы не зависеть от погрешности float
+            keep = [k and start <= round(dt % 1 * 86400, 3) <= end
+                    for k, dt in zip(keep, bars.datetime[bars.head:])]
+        return keep
+
+    def is_old_bar(self, dt):
+        """Проверка бара на соответствие условиям выборки
+
+        :param float dt: Дата/время открытия бара в формате BackTrader
+        """
         # Если получили несформированный бар. Например, дневной бар в середине сессии
-        if self.is_unformed_bar(bar):
+        if self.is_unformed_bar(dt):
             print('ПРИШЕЛ НЕСФОРМИРОВАННЫЙ БАР ПО ПОДПИСКЕ\n'
                   'ОШИБКА. РАБОТАТЬ БУДЕТ, НО ТАК НЕ ДОЛЖНО БЫТЬ')
             return False
         # Если получили предыдущий или более старый бар
         # TODO: This as well may be removed since the check takes place in lua
-        if date2num(self.open_datetime(bar)) <= self.lines.datetime[-1]:
+        if dt <= self.lines.datetime[-1]:
             print('ПРИШЕЛ ПРЕДЫДУЩИЙ ИЛИ БОЛЕЕ СТАРЫЙ БАР ПО ПОДПИСКЕ.\n'
                   'ОШИБКА. РАБОТАТЬ БУДЕТ, НО ТАК НЕ ДОЛЖНО БЫТЬ')
             return False
 
         return True
 
-    def is_unformed_bar(self, bar):
+    def is_unformed_bar(self, dt):
+        """Проверка бара на несформированность
+
+        :param float dt: Дата/время открытия бара в формате BackTrader
+        """
         # Дата/время закрытия бара
-        dt_close = self.open_datetime(bar)
-        dt_close += self.time_offset
+        dt_close = dt + self.time_offset
 
         # Текущее биржевое время из QUIK. Корректируем его на несколько секунд,
         # т.к. минутный бар может прийти в 59 секунд прошлой минуты
@@ -168,30 +309,19 @@ class QKData(AbstractDataBase):
         # time_market_now += self._time_correction
 
         # Если получили несформированный бар. Например, дневной бар в середине сессии
-        if time_market_now < dt_close:
+        if date2num(time_market_now) < dt_close:
             return True
         return False
 
-    @staticmethod
-    def open_datetime(bar):
-        """Дата/время открытия бара"""
-        dt = bar['datetime']
-        return datetime(dt['year'], dt['month'], dt['day'], dt['hour'], dt['min'])
-
     def quik_datetime_now(self):
         """Текущая дата и время
 
-        - Если получили последний бар истории, то запрашием текущие дату и время из QUIK
+        - Если получили последний бар истории, то берем текущие дату и время с биржевых часов хранилища
         - Если находимся в режиме получения истории,
           то переводим текущие дату и время с компьютера в МСК
         """
-        # Переводим строки в дату и время и возвращаем их
         if self.store.connected and self._laststatus == self.LIVE:
-            # Может прийти неверная дата
-            # TODO: check on weekends
-            d = self.prov.getInfoParam('TRADEDATE')  # Дата dd.mm.yyyy
-            t = self.prov.getInfoParam('SERVERTIME')  # Время hh:mi:ss
-            return datetime.strptime(f'{d} {t}', '%d.%m.%Y %H:%M:%S')
+            return self.store.clock.now()
         else:
             # Получаем МСК время из локального времени
             return datetime.now(self.store.MarketTimeZone).replace(tzinfo=None)
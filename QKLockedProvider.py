@@ -0,0 +1,72 @@
+from threading import Condition
+
+
+class QKLockedProvider:
+    """Подключение QuikPy с запросами по одному
+
+    У QuikPy один сокет запросов без блокировки. По нему идут запросы потока BackTrader, потока обработки функций
+    обратного вызова, сверки счета, кэша цен и восстановления подписок. Запросы ждут друг друга, чтобы ответы не перепутались.
+    Транзакции идут раньше остальных ждущих запросов, но ждут окончания уже выполняемого запроса.
+    Функции обратного вызова задаются и вызываются без блокировки
+    """
+
+    skip = ('default_handler', 'DefaultHandler', 'close_connection')  # Функции подключения без блокировки
+    priority = ('SendTransaction',)  # Запросы, которые идут раньше остальных ждущих запросов
+
+    def __init__(self, provider):
+        """
+        :param QuikPy provider: Подключение к QUIK
+        """
+        object.__setattr__(self, 'provider', provider)
+        object.__setattr__(self, 'condition', Condition())  # Блокировка сокета запросов
+        object.__setattr__(self, 'busy', False)  # Выполняется ли запрос
+        object.__setattr__(self, 'urgent', 0)  # Кол-во ждущих запросов из priority
+        object.__setattr__(self, 'wrappers', {})  # Запросы с блокировкой. Название -> Функция
+
+    def __getattr__(self, name):
+        value = getattr(self.provider, name)
+        if not callable(value) or name.startswith(('_', 'On')) or name in self.skip:
+            return value
+        wrapper = self.wrappers.get(name)
+        if wrapper is None:
+            wrapper = self.wrappers[name] = self.locked(value, name in self.priority)
+        return wrapper
+
+    def __setattr__(self, name, value):
+        if name in self.__dict__:  # Свои атрибуты меняем у себя
+            object.__setattr__(self, name, value)
+        else:  # Функции обратного вызова задаем подключению
+            setattr(self.provider, name, value)
+
+    def locked(self, function, is_priority=False):
+        """Запрос, ждущий окончания остальных запросов подключения
+
+        :param function: Запрос
+        :param bool is_priority: Запрос идет раньше остальных ждущих запросов
+        """
+        def wrapper(*args, **kwargs):
+            self.acquire(is_priority)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.release()
+        return wrapper
+
+    def acquire(self, is_priority=False):
+        """Ожидание свободного сокета запросов. Обычные запросы пропускают вперед ждущие запросы из priority"""
+        with self.condition:
+            if is_priority:
+                self.urgent += 1
+            try:
+                while self.busy or (not is_priority and self.urgent):
+                    self.condition.wait()
+            finally:
+                if is_priority:
+                    self.urgent -= 1
+            self.busy = True
+
+    def release(self):
+        """Освобождение сокета запросов"""
+        with self.condition:
+            self.busy = False
+            self.condition.notify_all()
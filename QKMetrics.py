@@ -0,0 +1,190 @@
+import os
+from bisect import bisect_left
+from threading import Lock
+from time import monotonic, perf_counter
+
+
+class QKMetrics:
+    """Метрики хранилища QUIK: счетчики, текущие значения и гистограммы задержек
+
+    Метрика задается названием и метками. Например, qk_request_seconds с меткой method='get_candles_ds'.
+    Снимок метрик выдается словарем или текстом в формате Prometheus
+    """
+
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))  # Границы корзин гистограмм в секундах
+
+    def __init__(self):
+        self.lock = Lock()  # Метрики пишут поток BackTrader, поток обработки функций обратного вызова и потоки загрузки
+        self.counters = {}  # Счетчики. (Название, Метки) -> Значение
+        self.gauges = {}  # Текущие значения. (Название, Метки) -> Значение
+        self.histograms = {}  # Гистограммы. (Название, Метки) -> [Кол-во по корзинам, Сумма, Кол-во]
+        self.collectors = []  # Функции, обновляющие текущие значения перед снимком
+        self.start_time = monotonic()  # Время создания метрик. От него считается скорость в первом снимке
+        # Счетчики и время прошлого снимка для расчета скорости. У каждого потребителя снимков свои.
+        # Потребитель -> (Счетчики, Время)
+        self.windows = {}
+
+    @staticmethod
+    def key(name, labels):
+        """Ключ метрики из названия и меток"""
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """Увеличение счетчика"""
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Текущее значение"""
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        """Добавление задержки в гистограмму"""
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            histogram[0][bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def add_collector(self, collector):
+        """Функция collector(metrics), обновляющая текущие значения перед снимком. Например, очереди баров"""
+        self.collectors.append(collector)
+
+    def snapshot(self, consumer='default'):
+        """Снимок метрик
+
+        :param str consumer: Потребитель снимков. Скорость считается с прошлого снимка этого же потребителя,
+            поэтому снимки разных потребителей не сбивают друг другу скорость. None - без расчета скорости
+        :return: Словарь counters, gauges, rates (скорость счетчиков в секунду с прошлого снимка потребителя),
+            histograms (count, sum, buckets - кол-во по корзинам) с ключами (Название, Метки)
+        """
+        for collector in self.collectors:
+            collector(self)
+        with self.lock:
+            rates = {}
+            if consumer is not None:
+                now = monotonic()
+                last_counters, last_time = self.windows.get(consumer, ({}, self.start_time))
+                elapsed = max(now - last_time, 1e-9)
+                rates = {key: (value - last_counters.get(key, 0)) / elapsed for key, value in self.counters.items()}
+                self.windows[consumer] = (dict(self.counters), now)
+            return {'counters': dict(self.counters),
+                    'gauges': dict(self.gauges),
+                    'rates': rates,
+                    'histograms': {key: {'count': histogram[2], 'sum': histogram[1], 'buckets': list(histogram[0])}
+                                   for key, histogram in self.histograms.items()}}
+
+    def quantile(self, name, q, **labels):
+        """Оценка квантиля задержки по гистограмме: верхняя граница корзины. None, если задержек нет
+
+        :param str name: Название гистограммы
+        :param float q: Квантиль от 0 до 1. Например, 0.99
+        """
+        with self.lock:
+            histogram = self.histograms.get(self.key(name, labels))
+            if not histogram:
+                return None
+            rank, total = q * histogram[2], 0
+            for bound, count in zip(self.buckets, histogram[0]):
+                total += count
+                if total >= rank:
+                    return bound
+            return self.buckets[-1]
+
+    def prometheus(self):
+        """Снимок метрик в текстовом формате Prometheus. Скорость Prometheus считает сам, поэтому ее здесь нет"""
+        snapshot = self.snapshot(None)
+        lines = []
+        for kind, values in (('counter', snapshot['counters']), ('gauge', snapshot['gauges'])):
+            for name in sorted({name for name, _ in values}):
+                lines.append(f'# TYPE {name} {kind}')
+                lines.extend(f'{name}{self.format_labels(labels)} {value}'
+                             for (metric, labels), value in sorted(values.items()) if metric == name)
+        histograms = snapshot['histograms']
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f'# TYPE {name} histogram')
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                total = 0
+                for bound, count in zip(self.buckets, histogram['buckets']):
+                    total += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{name}_bucket{self.format_labels(labels + (("le", le),))} {total}')
+                lines.append(f'{name}_sum{self.format_labels(labels)} {histogram["sum"]}')
+                lines.append(f'{name}_count{self.format_labels(labels)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def format_labels(labels):
+        """Метки в формате Prometheus"""
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+    def dump(self, path):
+        """Запись метрик в файл в формате Prometheus. Файл заменяется целиком"""
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+class QKMetricsProvider:
+    """Подключение к QUIK с замером задержек
+
+    Все запросы подключения идут в гистограмму qk_request_seconds с меткой method,
+    ошибки запросов - в счетчик qk_request_errors_total.
+    Заданные функции обратного вызова идут в гистограмму qk_callback_seconds с меткой callback
+    """
+
+    def __init__(self, provider, metrics):
+        """
+        :param provider: Подключение к QUIK
+        :param QKMetrics metrics: Метрики
+        """
+        object.__setattr__(self, 'provider', provider)
+        object.__setattr__(self, 'metrics', metrics)
+        object.__setattr__(self, 'wrappers', {})  # Запросы с замером задержек. Название -> Функция
+
+    def __getattr__(self, name):
+        value = getattr(self.provider, name)
+        if not callable(value) or name.startswith(('_', 'On')):  # Атрибуты и функции обратного вызова выдаем как есть
+            return value
+        wrapper = self.wrappers.get(name)
+        if wrapper is None:
+            wrapper = self.wrappers[name] = self.timed(name, 'qk_request_seconds', 'method', 'qk_request_errors_total')
+        return wrapper
+
+    def __setattr__(self, name, value):
+        if name.startswith('On') and callable(value):  # Функции обратного вызова замеряем
+            value = self.timed(name, 'qk_callback_seconds', 'callback', 'qk_callback_errors_total', value)
+        setattr(self.provider, name, value)
+
+    def timed(self, name, histogram, label, errors, function=None):
+        """Функция с замером задержки
+
+        :param str name: Название запроса или функции обратного вызова
+        :param str histogram: Название гистограммы задержек
+        :param str label: Название метки
+        :param str errors: Название счетчика ошибок
+        :param function: Функция. По умолчанию, запрос подключения с названием name
+        """
+        function = function or getattr(self.provider, name)
+        metrics = self.metrics
+
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                metrics.inc(errors, **{label: name})
+                raise
+            finally:
+                metrics.observe(histogram, perf_counter() - start, **{label: name})
+        return wrapper
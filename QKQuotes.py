@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+
+class QKQuotes:
+    """Кэш последних цен тикеров QUIK
+
+    На тикеры кэша заказывается получение параметра LAST (ParamRequest).
+    По событию изменения параметров OnParam цена перечитывается в отдельном потоке.
+    Пока тикер ждет перечитывания, новые события по нему не ставят запросов в очередь.
+    Обезличенные сделки обновляют цену без запросов.
+    Слушатели получают изменения цены listener(class_code, sec_code, old_price, new_price).
+    Запросы цен из разных потоков идут по подключению хранилища по одному (QKLockedProvider)
+    """
+
+    def __init__(self, store):
+        """
+        :param QKStore store: Хранилище QUIK
+        """
+        self.store = store
+        self.lock = Lock()  # Цены обновляют поток обработки функций обратного вызова и поток перечитывания
+        self.prices = {}  # Последние цены. (Код площадки, Код тикера) -> Цена QUIK. None - еще не получена
+        self.pending = set()  # Тикеры, ожидающие перечитывания цены
+        self.listeners = []  # Функции, получающие изменения цен
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='QKQuotes')  # Перечитывание цен не задерживает функции обратного вызова
+
+    def subscribe(self, class_code, sec_code):
+        """Получение последней цены тикера по событиям QUIK"""
+        key = (class_code, sec_code)
+        with self.lock:
+            if key in self.prices:  # Если тикер уже в кэше
+                return
+            self.prices[key] = None
+        self.store.provider.ParamRequest(class_code, sec_code, 'LAST')
+
+    def get(self, class_code, sec_code):
+        """Последняя цена тикера QUIK. Из QUIK запрашивается только при первом обращении
+
+        :param str class_code: Код площадки
+        :param str sec_code: Код тикера
+        :return: Последняя цена сделки QUIK
+        """
+        price = self.prices.get((class_code, sec_code))
+        if price is None:  # Если цены еще нет
+            self.subscribe(class_code, sec_code)
+            price = self.refresh(class_code, sec_code)
+        return price
+
+    def refresh(self, class_code, sec_code):
+        """Перечитывание последней цены тикера из QUIK"""
+        self.pending.discard((class_code, sec_code))  # Изменения после запроса перечитаем еще раз
+        price = float(self.store.provider.GetParamEx(class_code, sec_code, 'LAST')['data']['param_value'])
+        self.update(class_code, sec_code, price)
+        return price
+
+    def update(self, class_code, sec_code, price):
+        """Новая последняя цена тикера кэша"""
+        key = (class_code, sec_code)
+        with self.lock:
+            old_price = self.prices.get(key)
+            if key not in self.prices or price == old_price:  # Если тикера нет в кэше или цена не изменилась
+                return
+            self.prices[key] = price
+            listeners = list(self.listeners)
+        # Слушатели могут делать запросы в QUIK. Вызываем их без блокировки, чтобы не задерживать обезличенные сделки.
+        # Изменения цены идут цепочкой old_price -> price, поэтому сумма изменений не зависит от порядка вызовов
+        for listener in listeners:
+            listener(class_code, sec_code, old_price, price)
+
+    def on_param(self, data):
+        """Изменение параметров тикера. Цена перечитывается в отдельном потоке"""
+        key = (data['data']['class_code'], data['data']['sec_code'])
+        with self.lock:  # Кэш может закрываться в это время
+            if key not in self.prices or key in self.pending:  # Если тикера нет в кэше, или он уже ждет перечитывания
+                return
+            self.pending.add(key)
+            self.executor.submit(self.refresh, *key)
+
+    def on_all_trade(self, class_code, sec_code, price):
+        """Обезличенная сделка тикера"""
+        if (class_code, sec_code) in self.prices:
+            self.update(class_code, sec_code, float(price))
+
+    def close(self):
+        """Отмена получения цен и остановка перечитывания"""
+        with self.lock:
+            keys = list(self.prices)
+            self.prices.clear()
+            self.pending.clear()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        for class_code, sec_code in keys:
+            self.store.provider.CancelParamRequest(class_code, sec_code, 'LAST')
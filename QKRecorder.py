@@ -0,0 +1,236 @@
+import os
+import pickle
+import struct
+from bisect import bisect_left
+from threading import Condition, Event, Lock, Thread
+from time import monotonic, time
+
+
+class QKRecorder:
+    """Запись ответов и функций обратного вызова QUIK в двоичный файл
+
+    Файл только дописывается. Каждая запись: заголовок (время, вид записи, длина данных) и данные pickle.
+    Ответы на запросы записываются со временем отправки запроса
+    Записи сбрасываются на диск сразу, чтобы после сбоя в файле осталась вся последовательность событий
+    """
+
+    magic = b'QKLOG1\n'  # Начало файла записи
+    header = struct.Struct('<dBI')  # Заголовок записи: время, вид записи, длина данных
+    RESPONSE, CALLBACK, ERROR = range(3)  # Виды записей: ответ на запрос, функция обратного вызова, ошибка запроса
+
+    def __init__(self, path):
+        """
+        :param str path: Файл записи. Если файл есть, то записи дописываются в конец
+        """
+        self.lock = Lock()  # Пишут потоки запросов и поток обработки функций обратного вызова
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab')
+        if is_new:
+            self.file.write(self.magic)
+
+    def write(self, kind, name, args, value, timestamp=None):
+        """Запись
+
+        :param int kind: Вид записи
+        :param str name: Название запроса или функции обратного вызова
+        :param tuple args: Параметры запроса
+        :param value: Ответ на запрос, данные функции обратного вызова или текст ошибки
+        :param float timestamp: Время. По умолчанию, текущее
+        """
+        payload = pickle.dumps((name, args, value), pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if self.file.closed:  # Функции обратного вызова могут прийти после остановки хранилища
+                return
+            self.file.write(self.header.pack(timestamp or time(), kind, len(payload)))
+            self.file.write(payload)
+            self.file.flush()
+
+    def close(self):
+        """Закрытие файла записи"""
+        with self.lock:
+            self.file.close()
+
+    @classmethod
+    def read(cls, path):
+        """Чтение записей файла. Недописанная последняя запись пропускается
+
+        :param str path: Файл записи
+        :return: Генератор записей (время, вид записи, название, параметры, значение)
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(cls.magic)) != cls.magic:
+                raise ValueError(f'{path} не является файлом записи QUIK')
+            while len(header := f.read(cls.header.size)) == cls.header.size:
+                timestamp, kind, size = cls.header.unpack(header)
+                payload = f.read(size)
+                if len(payload) < size:  # Запись не успели дописать
+                    return
+                name, args, value = pickle.loads(payload)
+                yield timestamp, kind, name, args, value
+
+
+class QKRecordProvider:
+    """Подключение к QUIK с записью ответов на запросы и функций обратного вызова"""
+
+    skip = ('default_handler', 'DefaultHandler', 'close_connection')  # Функции подключения, которые не записываются
+
+    def __init__(self, provider, recorder):
+        """
+        :param provider: Подключение к QUIK
+        :param QKRecorder recorder: Запись
+        """
+        object.__setattr__(self, 'provider', provider)
+        object.__setattr__(self, 'recorder', recorder)
+        object.__setattr__(self, 'wrappers', {})  # Запросы с записью. Название -> Функция
+
+    def __getattr__(self, name):
+        value = getattr(self.provider, name)
+        if not callable(value) or name.startswith(('_', 'On')) or name in self.skip:
+            return value
+        wrapper = self.wrappers.get(name)
+        if wrapper is None:
+            wrapper = self.wrappers[name] = self.recorded_request(name, value)
+        return wrapper
+
+    def __setattr__(self, name, value):
+        if name.startswith('On') and callable(value):  # Функции обратного вызова записываем до обработки
+            value = self.recorded_callback(name, value)
+        setattr(self.provider, name, value)
+
+    def recorded_request(self, name, function):
+        """Запрос с записью ответа или ошибки"""
+        recorder = self.recorder
+
+        def wrapper(*args, **kwargs):
+            params = args + tuple(sorted(kwargs.items()))  # Параметры записываем одним кортежем
+            start = time()  # Ответ записываем со временем отправки запроса, чтобы он шел до вызванных им событий
+            try:
+                value = function(*args, **kwargs)
+            except Exception as e:
+                recorder.write(QKRecorder.ERROR, name, params, repr(e), start)
+                raise
+            recorder.write(QKRecorder.RESPONSE, name, params, value, start)
+            return value
+        return wrapper
+
+    def recorded_callback(self, name, function):
+        """Функция обратного вызова с записью данных"""
+        recorder = self.recorder
+
+        def wrapper(data):
+            recorder.write(QKRecorder.CALLBACK, name, (), data)
+            return function(data)
+        return wrapper
+
+
+class QKReplayProvider:
+    """Воспроизведение записи QUIK вместо подключения к QUIK
+
+    Функции обратного вызова вызываются из своего потока в порядке записи.
+    Каждая ждет, пока не будут сделаны записанные до нее подписки и транзакции, но не дольше sync_timeout.
+    Запросы получают первый ответ с теми же параметрами, записанный после текущего момента воспроизведения
+    (времени последней вызванной функции обратного вызова), т.к. запросы при обработке события записываются после него.
+    Если такого ответа нет, то последний записанный.
+    Если запроса с такими параметрами не записано, то ответ ищется по названию запроса.
+    Подключается к хранилищу параметром provider: QKStore(provider=QKReplayProvider(path))
+
+    Торговая система, решения которой зависят от времени прихода событий (переход данных в live, исполнение заявки
+    до следующего бара), воспроизводится точно при speed=1. При ускоренном воспроизведении новый бар выдается,
+    когда данные его подписки заберут все бары, поэтому данные переходят в LIVE, как при записи
+    """
+
+    sync = ('subs_to_candles', 'SendTransaction')  # Запросы, после которых приходят функции обратного вызова
+
+    def __init__(self, path, speed=None, sync_timeout=1.0):
+        """
+        :param str path: Файл записи
+        :param float speed: Скорость воспроизведения функций обратного вызова. 1 - как при записи. None - без пауз
+        :param float sync_timeout: Максимальное время ожидания подписок и транзакций, записанных до функции обратного вызова, в секундах
+        """
+        self.speed = speed
+        self.sync_timeout = sync_timeout
+        self.responses = {}  # Записанные ответы. (Название, Параметры) или Название -> ([Время], [(Вид записи, Значение)])
+        self.events = []  # Функции обратного вызова. (Время, Кол-во подписок и транзакций до нее, Название, Данные)
+        requests = 0
+        # Запросы записаны по времени их отправки, а в файл попадают после ответа. Восстанавливаем порядок по времени
+        for timestamp, kind, name, args, value in sorted(QKRecorder.read(path), key=lambda record: record[0]):
+            if kind == QKRecorder.CALLBACK:
+                self.events.append((timestamp, requests, name, value))
+                continue
+            for key in ((name, repr(args)), name):
+                times, values = self.responses.setdefault(key, ([], []))
+                times.append(timestamp)
+                values.append((kind, value))
+            if name in self.sync:
+                requests += 1
+        self.now = float('-inf')  # Текущий момент воспроизведения
+        self.answered = 0  # Кол-во подписок и транзакций
+        self.last_sync = None  # Время записи и время ответа последней подписки или транзакции
+        self.condition = Condition()  # Ожидание запросов функциями обратного вызова
+        self.stopped = Event()  # Остановка воспроизведения
+        self.finished = Event()  # Все функции обратного вызова воспроизведены
+        # Ожидание, пока данные заберут бары wait_consumed(cmd, data, timeout). Задает хранилище. Нужно при ускоренном воспроизведении
+        self.wait_consumed = None
+        # Функции обратного вызова QuikPy
+        self.OnConnected = self.OnDisconnected = self.OnNewCandle = self.OnAllTrade = self.default_handler
+        self.OnTrade = self.OnTransReply = self.OnOrder = self.OnStopOrder = self.default_handler
+        self.OnFuturesLimitChange = self.OnMoneyLimit = self.OnParam = self.default_handler
+        Thread(target=self.replay, name='QKReplay', daemon=True).start()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.answer(name, args + tuple(sorted(kwargs.items())))
+
+    def answer(self, name, args):
+        """Записанный ответ на запрос"""
+        responses = self.responses.get((name, repr(args))) or self.responses.get(name)
+        if responses is None:  # Если запрос не записывался
+            return None
+        times, values = responses
+        index = min(bisect_left(times, self.now), len(values) - 1)
+        kind, value = values[index]
+        if name in self.sync:
+            with self.condition:
+                self.answered += 1
+                self.last_sync = (times[index], monotonic())  # Паузы после подписок и транзакций тоже воспроизводим
+                self.condition.notify_all()
+        if kind == QKRecorder.ERROR:
+            raise ConnectionError(value)
+        return value
+
+    def replay(self):
+        """Поток воспроизведения функций обратного вызова"""
+        last_call = None  # Время записи и время вызова прошлой функции обратного вызова
+        for timestamp, requests, name, data in self.events:
+            with self.condition:
+                self.condition.wait_for(lambda: self.answered >= requests or self.stopped.is_set(), self.sync_timeout)
+                # Паузу отсчитываем от более позднего события: прошлой функции обратного вызова или подписки/транзакции
+                last = max(filter(None, (last_call, self.last_sync)), default=None)
+            if self.speed and last is not None:
+                delay = (timestamp - last[0]) / self.speed - (monotonic() - last[1])
+                if delay > 0:
+                    self.stopped.wait(delay)
+            elif not self.speed and self.wait_consumed is not None:  # Без пауз темп задает поток BackTrader
+                self.wait_consumed(name, data, self.sync_timeout)
+            if self.stopped.is_set():
+                return
+            self.now = timestamp
+            last_call = (timestamp, monotonic())
+            try:
+                getattr(self, name)(data)
+            except Exception as e:  # Ошибка в обработчике не останавливает воспроизведение
+                print(f'Ошибка обработки {name}: {e}')
+        self.finished.set()
+
+    def default_handler(self, data):
+        """Обработчик по умолчанию. Событие пропускается"""
+        pass
+
+    DefaultHandler = default_handler
+
+    def close_connection(self):
+        """Остановка воспроизведения"""
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
@@ -0,0 +1,464 @@
+import os
+import re
+from datetime import datetime, timedelta
+from itertools import count
+from queue import SimpleQueue
+from threading import Event, RLock, Thread, Timer
+from time import sleep
+
+
+class QKSimulator:
+    """Симулятор QUIK для тестов и замеров без терминала QUIK
+
+    Реализует запросы и функции обратного вызова QuikPy, которые использует пакет.
+    Подключается к хранилищу параметром provider: QKStore(provider=QKSimulator(...)).
+
+    - История свечей берется из файлов <Код площадки>.<Код тикера>_<Интервал>.txt, например, TQBR.SBER_M1.txt,
+      в формате выгрузки QuikPy: дата/время DD.MM.YYYY HH:MI, open, high, low, close, volume через табуляцию.
+      Свечи можно добавить и из кода через add_candles
+    - Последние live_bars свечей каждого файла не попадают в историю, а приходят как новые бары по одной за шаг
+      каждые bar_period секунд. Время сервера - время закрытия последней пришедшей свечи.
+      Чтобы биржевые часы хранилища шли за ускоренным временем, задайте хранилищу clock_period=0
+    - Заявки регистрируются и исполняются по последней цене и по новым барам.
+      Лимитные и стоп заявки ждут, пока цена бара их не достигнет
+    - Задержка latency добавляется к каждому запросу, fill_latency - к ответам на транзакции.
+      Отключение от сервера вызывается disconnect или каждые disconnect_period секунд
+    """
+
+    file_pattern = re.compile(r'^(?P<class_code>[^.]+)\.(?P<sec_code>.+)_(?P<tf>MN|M|H|D|W)(?P<n>\d+)\.txt$')  # Название файла свечей
+    tf_minutes = {'M': 1, 'H': 60, 'D': 1440, 'W': 10080, 'MN': 23200}  # Минут в единице интервала файла
+
+    def __init__(self, path=None, live_bars=0, bar_period=1.0, latency=0.0, fill_latency=0.0,
+                 disconnect_period=None, disconnect_duration=5.0, symbols=None, cash=1_000_000.0,
+                 client_code='', firm_id='SPBFUT', trade_account_id='SPBFUT00PST', limit_kind=0, currency_code='SUR'):
+        """
+        :param str path: Папка файлов свечей. None - свечи добавляются через add_candles
+        :param int live_bars: Кол-во последних свечей каждого файла, которые приходят как новые бары
+        :param float bar_period: Период прихода новых баров в секундах
+        :param float latency: Задержка каждого запроса в секундах
+        :param float fill_latency: Задержка ответов на транзакции и сделок в секундах
+        :param float disconnect_period: Период отключений от сервера в секундах. None - без отключений
+        :param float disconnect_duration: Длительность отключения в секундах
+        :param dict symbols: Информация о тикерах. (Код площадки, Код тикера) -> Значения, отличные от значений по умолчанию
+        :param float cash: Свободные средства по счету
+        :param str client_code: Код клиента денежных лимитов и позиций
+        :param str firm_id: Фирма
+        :param str trade_account_id: Счет
+        :param int limit_kind: День лимита
+        :param str currency_code: Валюта
+        """
+        self.live_bars = live_bars
+        self.bar_period = bar_period
+        self.latency = latency
+        self.fill_latency = fill_latency
+        self.disconnect_period = disconnect_period
+        self.disconnect_duration = disconnect_duration
+        self.symbols = dict(symbols or {})
+        self.cash = cash
+        self.client_code, self.firm_id, self.trade_account_id = client_code, firm_id, trade_account_id
+        self.limit_kind, self.currency_code = limit_kind, currency_code
+        self.lock = RLock()  # Запросы идут из разных потоков
+        self.candles = {}  # Все свечи. (Код площадки, Код тикера, Интервал) -> Список свечей QUIK
+        self.heads = {}  # Кол-во пришедших свечей. (Код площадки, Код тикера, Интервал) -> Кол-во
+        self.subscriptions = set()  # Подписки. (Код площадки, Код тикера, Интервал)
+        self.param_requests = set()  # Заказанные параметры. (Код площадки, Код тикера)
+        self.connected = True  # Подключен ли QUIK к серверу
+        self.orders = {}  # Заявки. Номер заявки -> Заявка
+        self.stop_orders = {}  # Стоп заявки. Номер стоп заявки -> Стоп заявка
+        self.positions = {}  # Позиции в лотах. (Код площадки, Код тикера) -> [Кол-во, Средняя цена]
+        self.order_nums = count(1)  # Номера заявок
+        self.trade_nums = count(1)  # Номера сделок
+        # Функции обратного вызова QuikPy
+        self.OnConnected = self.OnDisconnected = self.OnNewCandle = self.OnAllTrade = self.default_handler
+        self.OnTrade = self.OnTransReply = self.OnOrder = self.OnStopOrder = self.default_handler
+        self.OnFuturesLimitChange = self.OnMoneyLimit = self.OnParam = self.default_handler
+        self.callbacks = SimpleQueue()  # Очередь функций обратного вызова (cmd, data)
+        self.stopped = Event()  # Остановка симулятора
+        self.market = None  # Поток прихода новых баров. Запускается при первой подписке
+        Thread(target=self.process_callbacks, name='QKSimulatorCallbacks', daemon=True).start()
+        if path:
+            self.load_files(path)
+
+    # Свечи
+
+    def load_files(self, path):
+        """Загрузка свечей из всех файлов папки"""
+        for filename in sorted(os.listdir(path)):
+            match = self.file_pattern.match(filename)
+            if not match:
+                continue
+            interval = self.tf_minutes[match['tf']] * int(match['n'])
+            candles = []
+            with open(os.path.join(path, filename), encoding='utf-8') as f:
+                for line in f:
+                    values = re.split(r'[\t,;]', line.strip())
+                    try:
+                        dt = datetime.strptime(values[0], '%d.%m.%Y %H:%M' if ' ' in values[0] else '%d.%m.%Y')
+                        candles.append(self.quik_candle(dt, *map(float, values[1:6])))
+                    except (ValueError, TypeError):  # Заголовок или пустая строка
+                        continue
+            self.add_candles(match['class_code'], match['sec_code'], interval, candles)
+
+    def add_candles(self, class_code, sec_code, interval, candles):
+        """Добавление свечей тикера/интервала
+
+        :param str class_code: Код площадки
+        :param str sec_code: Код тикера
+        :param int interval: Временной интервал в минутах
+        :param list candles: Свечи QUIK или кортежи (datetime, open, high, low, close, volume), отсортированные по дате/времени
+        """
+        candles = [candle if isinstance(candle, dict) else self.quik_candle(*candle) for candle in candles]
+        with self.lock:
+            self.candles[(class_code, sec_code, interval)] = candles
+            self.heads[(class_code, sec_code, interval)] = max(len(candles) - self.live_bars, 0)
+
+    @staticmethod
+    def quik_candle(dt, open, high, low, close, volume):
+        """Свеча QUIK"""
+        return {'datetime': {'year': dt.year, 'month': dt.month, 'day': dt.day, 'hour': dt.hour, 'min': dt.minute, 'sec': 0, 'ms': 0},
+                'open': open, 'high': high, 'low': low, 'close': close, 'volume': volume}
+
+    @staticmethod
+    def candle_datetime(candle):
+        """Дата/время открытия свечи QUIK"""
+        dt = candle['datetime']
+        return datetime(dt['year'], dt['month'], dt['day'], dt['hour'], dt['min'])
+
+    def last_candle(self, class_code, sec_code):
+        """Последняя пришедшая свеча тикера по наименьшему интервалу. None, если свечей нет"""
+        keys = sorted(key for key in self.candles if key[:2] == (class_code, sec_code) and self.heads[key])
+        return self.candles[keys[0]][self.heads[keys[0]] - 1] if keys else None
+
+    def now(self):
+        """Время сервера: время закрытия последней пришедшей свечи или локальное время, если свечей нет"""
+        with self.lock:
+            closes = [self.candle_datetime(self.candles[key][head - 1]) + timedelta(minutes=key[2])
+                      for key, head in self.heads.items() if head]
+        return max(closes) if closes else datetime.now()
+
+    def step(self):
+        """Приход следующей свечи каждого тикера/интервала"""
+        with self.lock:
+            matched = set()  # Тикеры, заявки которых уже проверены на этом шаге
+            for key in sorted(self.candles, key=lambda key: key[2]):  # По возрастанию интервала
+                head = self.heads[key]
+                if head >= len(self.candles[key]):  # Если новых свечей нет
+                    continue
+                candle = self.candles[key][head]
+                self.heads[key] = head + 1
+                class_code, sec_code, interval = key
+                if self.connected and key in self.subscriptions:
+                    self.callback('OnNewCandle', dict(candle, **{'class': class_code, 'sec': sec_code, 'interval': interval, 'live': True}))
+                if (class_code, sec_code) in matched:
+                    continue
+                matched.add((class_code, sec_code))
+                if self.connected and (class_code, sec_code) in self.param_requests:
+                    self.callback('OnParam', {'cmd': 'OnParam', 'data': {'class_code': class_code, 'sec_code': sec_code}})
+                if self.connected:
+                    self.callback('OnAllTrade', {'cmd': 'OnAllTrade', 'data': {
+                        'class_code': class_code, 'sec_code': sec_code, 'price': candle['close'],
+                        'qty': candle['volume'], 'datetime': dict(candle['datetime'], mcs=0)}})
+                self.match_orders(class_code, sec_code, candle)
+
+    def run_market(self):
+        """Поток прихода новых баров и отключений от сервера"""
+        next_disconnect = self.disconnect_period
+        elapsed = 0.0
+        while not self.stopped.wait(self.bar_period):
+            self.step()
+            elapsed += self.bar_period
+            if next_disconnect is not None and elapsed >= next_disconnect:
+                self.disconnect(self.disconnect_duration)
+                next_disconnect += self.disconnect_period
+
+    def disconnect(self, duration=None):
+        """Отключение QUIK от сервера. Новые бары за время отключения не приходят, но попадают в историю
+
+        :param float duration: Через сколько секунд подключиться. None - не подключаться
+        """
+        with self.lock:
+            if not self.connected:
+                return
+            self.connected = False
+        self.callback('OnDisconnected', {'cmd': 'OnDisconnected', 'data': ''})
+        if duration is not None:
+            timer = Timer(duration, self.connect)
+            timer.daemon = True
+            timer.start()
+
+    def connect(self):
+        """Подключение QUIK к серверу"""
+        with self.lock:
+            if self.connected:
+                return
+            self.connected = True
+        self.callback('OnConnected', {'cmd': 'OnConnected', 'data': ''})
+
+    # Функции обратного вызова
+
+    def callback(self, cmd, data, delay=0.0):
+        """Постановка функции обратного вызова в очередь, при необходимости с задержкой"""
+        if delay:
+            timer = Timer(delay, self.callbacks.put, ((cmd, data),))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.callbacks.put((cmd, data))
+
+    def process_callbacks(self):
+        """Поток обработки функций обратного вызова"""
+        for cmd, data in iter(self.callbacks.get, None):
+            try:
+                getattr(self, cmd)(data)
+            except Exception as e:  # Ошибка в обработчике не останавливает обработку остальных событий
+                print(f'Ошибка обработки {cmd}: {e}')
+
+    def default_handler(self, data):
+        """Обработчик по умолчанию. Событие пропускается"""
+        pass
+
+    DefaultHandler = default_handler
+
+    def close_connection(self):
+        """Остановка потоков симулятора"""
+        if not self.stopped.is_set():
+            self.stopped.set()
+            self.callbacks.put(None)
+
+    def wait(self):
+        """Задержка запроса"""
+        if self.latency:
+            sleep(self.latency)
+
+    # Заявки
+
+    def match_orders(self, class_code, sec_code, candle):
+        """Исполнение заявок и срабатывание стоп заявок тикера по новой свече"""
+        for stop_order in list(self.stop_orders.values()):
+            if (stop_order['class_code'], stop_order['sec_code']) != (class_code, sec_code):
+                continue
+            is_buy, stop_price = not stop_order['flags'] & 0b100, stop_order['condition_price']
+            take_profit = stop_order['stop_order_kind'] == 'TAKE_PROFIT_STOP_ORDER'
+            # Стоп на покупку срабатывает при росте цены, тейк профит на покупку - при падении. На продажу наоборот
+            triggered = candle['low'] <= stop_price if is_buy == take_profit else candle['high'] >= stop_price
+            if triggered:
+                del self.stop_orders[stop_order['order_num']]
+                stop_order['flags'] = 0  # Стоп заявка исполнена
+                price = stop_price if take_profit else stop_order['price']
+                # Как в QUIK, событие по стоп заявке с номером выставленной заявки приходит после событий по этой заявке
+                stop_order['linkedorder'] = self.new_order(stop_order['trans_id'], class_code, sec_code, is_buy, price, stop_order['qty'], False)
+                self.callback('OnStopOrder', {'cmd': 'OnStopOrder', 'data': dict(stop_order)}, self.fill_latency)
+        for order in list(self.orders.values()):
+            if (order['class_code'], order['sec_code']) != (class_code, sec_code) or not order['flags'] & 1:
+                continue
+            is_buy = not order['flags'] & 0b100
+            if is_buy and candle['low'] <= order['price'] or not is_buy and candle['high'] >= order['price']:
+                self.fill(order, order['price'])
+
+    def new_order(self, trans_id, class_code, sec_code, is_buy, price, qty, is_market):
+        """Регистрация заявки и исполнение по последней цене, если цена заявки ее достигает"""
+        order_num = next(self.order_nums)
+        order = {'order_num': order_num, 'trans_id': trans_id, 'class_code': class_code, 'sec_code': sec_code,
+                 'flags': 1 | (0 if is_buy else 0b100), 'price': price, 'qty': qty, 'balance': qty}
+        self.orders[order_num] = order
+        self.callback('OnTransReply', {'cmd': 'OnTransReply', 'data': {
+            'trans_id': trans_id, 'order_num': order_num, 'status': 3, 'result_msg': f'Заявка {order_num} зарегистрирована'}}, self.fill_latency)
+        self.callback('OnOrder', {'cmd': 'OnOrder', 'data': dict(order)}, self.fill_latency)
+        last = self.last_candle(class_code, sec_code)
+        if last is not None and (is_market or is_buy and price >= last['close'] or not is_buy and price <= last['close']):
+            self.fill(order, last['close'])
+        return order_num
+
+    def fill(self, order, price):
+        """Исполнение заявки целиком"""
+        qty, is_buy = order['balance'], not order['flags'] & 0b100
+        order['balance'], order['flags'] = 0, order['flags'] & 0b100  # Заявка исполнена
+        key = (order['class_code'], order['sec_code'])
+        lot_size = self.get_symbol_info(*key)['lot_size']
+        size, avg_price = self.positions.get(key, (0, 0.0))
+        new_size = size + (qty if is_buy else -qty)
+        if new_size and (size == 0 or (size > 0) == is_buy):  # Если позиция открывается или увеличивается
+            avg_price = (size * avg_price + (qty if is_buy else -qty) * price) / new_size
+        elif new_size and (new_size > 0) != (size > 0):  # Если позиция переворачивается
+            avg_price = price
+        self.positions[key] = [new_size, avg_price if new_size else 0.0]
+        self.cash -= (qty if is_buy else -qty) * lot_size * price
+        trade = {'trade_num': next(self.trade_nums), 'order_num': order['order_num'], 'trans_id': order['trans_id'],
+                 'class_code': key[0], 'sec_code': key[1], 'price': price, 'qty': qty, 'flags': order['flags']}
+        self.callback('OnTrade', {'cmd': 'OnTrade', 'data': trade}, self.fill_latency)
+        self.callback('OnOrder', {'cmd': 'OnOrder', 'data': dict(order)}, self.fill_latency)
+        # Сделка меняет лимиты счета
+        self.callback('OnFuturesLimitChange', {'cmd': 'OnFuturesLimitChange', 'data': self.futures_limit()}, self.fill_latency)
+        self.callback('OnMoneyLimit', {'cmd': 'OnMoneyLimit', 'data': self.money_limit()}, self.fill_latency)
+
+    def kill(self, trans_id, orders, order_num):
+        """Снятие заявки или стоп заявки"""
+        order = orders.get(order_num)
+        if order is None or not order['flags'] & 1:  # Если заявки нет или она уже не активна
+            self.callback('OnTransReply', {'cmd': 'OnTransReply', 'data': {
+                'trans_id': trans_id, 'order_num': order_num, 'status': 4, 'result_msg': 'Не найдена заявка для удаления'}}, self.fill_latency)
+            return
+        order['flags'] = (order['flags'] & 0b100) | 0b10  # Заявка снята
+        if orders is self.stop_orders:
+            del orders[order_num]
+        self.callback('OnTransReply', {'cmd': 'OnTransReply', 'data': {
+            'trans_id': trans_id, 'order_num': order_num, 'status': 3, 'result_msg': f'Заявка {order_num} снята'}}, self.fill_latency)
+        self.callback('OnStopOrder' if orders is self.stop_orders else 'OnOrder',
+                      {'cmd': 'OnStopOrder' if orders is self.stop_orders else 'OnOrder', 'data': dict(order)}, self.fill_latency)
+
+    # Лимиты
+
+    def futures_limit(self):
+        """Фьючерсный лимит. Заблокированное ГО - стоимость фьючерсных позиций"""
+        used = sum(abs(size) * price * self.get_symbol_info(*key)['lot_size']
+                   for key, (size, price) in self.positions.items() if key[0] == 'SPBFUT')
+        return {'firmid': self.firm_id, 'trdaccid': self.trade_account_id, 'limit_type': 0, 'currcode': self.currency_code,
+                'cbplimit': self.cash + used, 'varmargin': 0, 'accruedint': 0, 'cbplused': used}
+
+    def money_limit(self):
+        """Денежный лимит"""
+        return {'client_code': self.client_code, 'firmid': self.firm_id, 'limit_kind': self.limit_kind,
+                'currcode': self.currency_code, 'currentbal': self.cash}
+
+    # Запросы
+
+    def isConnected(self):
+        self.wait()
+        return int(self.connected)
+
+    def getInfoParam(self, param):
+        self.wait()
+        now = self.now()
+        return {'TRADEDATE': now.strftime('%d.%m.%Y'), 'SERVERTIME': now.strftime('%H:%M:%S')}.get(param, '')
+
+    def getClassesList(self):
+        self.wait()
+        with self.lock:
+            return ''.join(f'{class_code},' for class_code in dict.fromkeys(key[0] for key in self.candles))
+
+    def getClassSecurities(self, class_code):
+        self.wait()
+        with self.lock:
+            return ''.join(f'{sec_code},' for sec_code in dict.fromkeys(key[1] for key in self.candles if key[0] == class_code))
+
+    def get_symbol_info(self, class_code, sec_code):
+        """Информация о тикере. Значения по умолчанию заменяются значениями из symbols"""
+        return {'class_code': class_code, 'code': sec_code, 'name': sec_code, 'short_name': sec_code,
+                'lot_size': 1, 'min_price_step': 0.01, 'scale': 2, **self.symbols.get((class_code, sec_code), {})}
+
+    def getSecurityInfo(self, class_code, sec_code):
+        self.wait()
+        return self.get_symbol_info(class_code, sec_code)
+
+    def getSecurityInfoBulk(self, keys):
+        self.wait()
+        return [self.get_symbol_info(*key.split('|', 1)) for key in keys]
+
+    def getSecurityClass(self, class_codes, sec_code):
+        self.wait()
+        with self.lock:
+            return next((class_code for class_code in class_codes.split(',')
+                         if any(key[:2] == (class_code, sec_code) for key in self.candles)), None)
+
+    def get_candles_ds(self, class_code, sec_code, interval, count):
+        self.wait()
+        with self.lock:
+            key = (class_code, sec_code, interval)
+            candles = self.candles.get(key, [])[:self.heads.get(key, 0)]
+            return [dict(candle) for candle in (candles[-count:] if count else candles)]
+
+    def is_subs(self, class_code, sec_code, interval):
+        self.wait()
+        return (class_code, sec_code, interval) in self.subscriptions
+
+    def subs_to_candles(self, class_code, sec_code, interval):
+        self.wait()
+        with self.lock:
+            key = (class_code, sec_code, interval)
+            head = self.heads.get(key, 0)
+            if key not in self.subscriptions and head and self.connected:  # Как и QUIK, по новой подписке приходит текущая свеча
+                self.callback('OnNewCandle', dict(self.candles[key][head - 1], **{'class': class_code, 'sec': sec_code, 'interval': interval, 'live': True}))
+            self.subscriptions.add(key)
+            if self.market is None:  # Новые бары начинают приходить после первой подписки
+                self.market = Thread(target=self.run_market, name='QKSimulatorMarket', daemon=True)
+                self.market.start()
+        return True
+
+    def unsubs_from_candles(self, class_code, sec_code, interval):
+        self.wait()
+        with self.lock:
+            self.subscriptions.discard((class_code, sec_code, interval))
+        return True
+
+    def GetParamEx(self, class_code, sec_code, param):
+        self.wait()
+        with self.lock:
+            last = self.last_candle(class_code, sec_code)
+        return {'data': {'param_value': str(last['close'] if last and param == 'LAST' else 0)}}
+
+    def ParamRequest(self, class_code, sec_code, param):
+        self.wait()
+        with self.lock:
+            self.param_requests.add((class_code, sec_code))
+        return {'data': True}
+
+    def CancelParamRequest(self, class_code, sec_code, param):
+        self.wait()
+        with self.lock:
+            self.param_requests.discard((class_code, sec_code))
+        return {'data': True}
+
+    def SendTransaction(self, transaction):
+        self.wait()
+        trans_id = int(transaction['TRANS_ID'])
+        action = transaction['ACTION']
+        class_code, sec_code = transaction['CLASSCODE'], transaction['SECCODE']
+        with self.lock:
+            if action == 'NEW_ORDER':
+                self.new_order(trans_id, class_code, sec_code, transaction['OPERATION'] == 'B', float(transaction['PRICE']),
+                               int(transaction['QUANTITY']), transaction.get('TYPE') == 'M')
+            elif action == 'NEW_STOP_ORDER':
+                order_num = next(self.order_nums)
+                is_buy = transaction['OPERATION'] == 'B'
+                stop_order = {'order_num': order_num, 'trans_id': trans_id, 'class_code': class_code, 'sec_code': sec_code,
+                              'flags': 1 | (0 if is_buy else 0b100), 'condition_price': float(transaction['STOPPRICE']),
+                              'price': float(transaction['PRICE']), 'qty': int(transaction['QUANTITY']),
+                              'stop_order_kind': transaction.get('STOP_ORDER_KIND', 'SIMPLE_STOP_ORDER'), 'linkedorder': 0}
+                self.stop_orders[order_num] = stop_order
+                self.callback('OnTransReply', {'cmd': 'OnTransReply', 'data': {
+                    'trans_id': trans_id, 'order_num': order_num, 'status': 3, 'result_msg': f'Стоп-заявка {order_num} зарегистрирована'}}, self.fill_latency)
+                self.callback('OnStopOrder', {'cmd': 'OnStopOrder', 'data': dict(stop_order)}, self.fill_latency)
+            elif action == 'KILL_ORDER':
+                self.kill(trans_id, self.orders, int(transaction['ORDER_KEY']))
+            elif action == 'KILL_STOP_ORDER':
+                self.kill(trans_id, self.stop_orders, int(transaction['STOP_ORDER_KEY']))
+        return {'cmd': 'sendTransaction', 'data': True}
+
+    def GetOrderByNumber(self, order_num):
+        self.wait()
+        with self.lock:
+            order = self.orders.get(order_num)
+        # Как в QUIK, для не найденной заявки (в т.ч. стоп заявки) возвращается ее номер
+        return {'data': dict(order) if order else order_num}
+
+    def GetFuturesLimit(self, firm_id, trade_account_id, limit_type, currency_code):
+        self.wait()
+        with self.lock:
+            return {'data': self.futures_limit()}
+
+    def GetMoneyLimits(self):
+        self.wait()
+        return {'data': [self.money_limit()]}
+
+    def GetAllDepoLimits(self):
+        self.wait()
+        with self.lock:
+            return {'data': [{'client_code': self.client_code, 'firmid': self.firm_id, 'limit_kind': self.limit_kind,
+                              'sec_code': sec_code, 'currentbal': size, 'wa_position_price': price}
+                             for (class_code, sec_code), (size, price) in self.positions.items() if class_code != 'SPBFUT']}
+
+    def GetFuturesHoldings(self):
+        self.wait()
+        with self.lock:
+            return {'data': [{'sec_code': sec_code, 'totalnet': size, 'avrposnprice': price}
+                             for (class_code, sec_code), (size, price) in self.positions.items() if class_code == 'SPBFUT']}
@@ -1,14 +1,30 @@
+import os
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from queue import Queue
+from threading import Event, Lock, Thread
 from pytz import timezone
 
 from backtrader.store import Store
+from backtrader import TimeFrame, date2num
 
 # from backtrader import Order
 # from backtrader.position import Position
 
 from QuikPy import QuikPy
+from .QKBars import QKBars, QKBarBuilder
+from .QKCache import QKCache
+from .QKClock import QKClock
+from .QKLockedProvider import QKLockedProvider
+from .QKConverter import QKConverter
+from .QKMetrics import QKMetrics, QKMetricsProvider
+from .QKQuotes import QKQuotes
+from .QKRecorder import QKRecorder, QKRecordProvider, QKReplayProvider
+from .QKSubscription import QKSubscription
+from .QKSymbols import QKSymbols
 from .QKData import QKData
+from .QKTickData import QKTickData
 from .QKBroker import QKBroker
 
 
@@ -17,11 +33,47 @@ class QKStore(Store):
 
     params = (
         ('host', '127.0.0.1'),  # Адрес/IP компьютера с QUIK
+        ('cache_path', None),  # Папка локального кэша свечей. None - свечи не кэшируются
+        ('clock_period', 60),  # Период сверки биржевых часов с сервером QUIK в секундах
+        # Кол-во одновременных загрузок истории при запуске.
+        # Каждая загрузка сверх первой идет по своему подключению к QUIK.
+        # QuikSharp обслуживает одного клиента на паре портов, поэтому для QuikPy их не больше, чем задано портов в history_ports
+        ('history_workers', 1),
+        # Порты (запросов, функций обратного вызова) дополнительных экземпляров QuikSharp для загрузки истории
+        ('history_ports', ()),
+        # Площадки, информация о тикерах которых загружается при запуске одними пакетными запросами.
+        # Тикер без площадки ищется в них по порядку. Например, ('TQBR', 'TQOB', 'SPBFUT') для стратегий на много тикеров.
+        # По умолчанию тикеры запрашиваются по одному при первом обращении и сохраняются в справочник в папке кэша
+        ('symbol_classes', ()),
+        ('symbols_ttl', 86400),  # Время жизни справочника тикеров в папке кэша в секундах
+        # Постановка и снятие заявок по отдельному подключению к QUIK.
+        # Загрузка истории и запросы данных не задерживают транзакции.
+        # QuikSharp обслуживает одного клиента на паре портов, поэтому нужны порты второго экземпляра QuikSharp в trade_ports.
+        # Без отдельного подключения транзакция идет раньше остальных ждущих запросов подключения хранилища,
+        # но ждет окончания уже выполняемого запроса, например загрузки истории тикера
+        ('trade_connection', False),
+        ('trade_ports', None),  # Порты (запросов, функций обратного вызова) QuikSharp для подключения транзакций
+        # Замер задержек запросов и функций обратного вызова, очередей и скорости баров. Снимок в store.metrics
+        ('metrics', False),
+        ('metrics_path', None),  # Файл метрик в формате Prometheus. Задание файла включает метрики
+        ('metrics_period', 15),  # Период записи файла метрик в секундах
+        ('StopSteps', 10),  # Размер проскальзывания рыночной заявки в минимальных шагах цены
+        # Готовое подключение к QUIK вместо новых подключений. Например, симулятор QKSimulator.
+        # Все подключения хранилища, брокера и загрузки истории идут через него
+        ('provider', None),
+        # Файл записи ответов и функций обратного вызова QUIK. None - не записываются.
+        # Запись воспроизводится подключением QKReplayProvider в параметре provider
+        ('record_path', None),
     )
 
     # @classmethod
     def getdata(self, **kwargs):
-        """Return QKData with args, kwargs"""
+        """Return QKData with args, kwargs
+
+        Для тиков и секунд возвращается QKTickData из потока обезличенных сделок
+        """
+        if kwargs.get('timeframe') in (TimeFrame.Ticks, TimeFrame.Seconds):
+            return self.TickDataCls(self, **kwargs)
         data = self.DataCls(self, **kwargs)
         return data
 
@@ -33,20 +85,49 @@ class QKStore(Store):
 
     BrokerCls = QKBroker
     DataCls = QKData
+    TickDataCls = QKTickData
 
     MarketTimeZone = timezone('Europe/Moscow')
 
     def __init__(self):
         super().__init__()
+        # Второй клиент на тех же портах QuikSharp перехватит сеанс подключения хранилища
+        if self.p.trade_connection and self.p.provider is None and not self.p.trade_ports:
+            raise ValueError('Для отдельного подключения транзакций задайте порты второго экземпляра QuikSharp в trade_ports')
         self.notifs = deque()  # Уведомления хранилища
-        # Вызываем конструктор QuikPy с адресом хоста
-        self.provider = QuikPy(host=self.p.host)
-        self.symbols = {}  # Информация о тикерах
+        # Метрики. None - не замеряются
+        self.metrics = QKMetrics() if self.p.metrics or self.p.metrics_path else None
+        self.metrics_stop = Event()  # Остановка записи файла метрик
+        # Запись ответов и функций обратного вызова QUIK. None - не записываются
+        self.recorder = QKRecorder(self.p.record_path) if self.p.record_path else None
+        # Подключение к QUIK с адресом хоста
+        self.provider = self.open_provider()
+        # Подключение для транзакций. Без отдельного подключения транзакции идут по подключению хранилища
+        self.trade_provider = self.open_provider(False, self.p.trade_ports) if self.p.trade_connection else self.provider
         # Проверяем подключен ли QUIK к серверу брокера
         self.connected = self.provider.isConnected()
         # Список классов. В некоторых таблицах тикер указывается без кода класса
         self.class_codes = self.provider.getClassesList()
-        self.subscribed_data = {}  # Словарь созданных дата классов
+        # Справочник тикеров. Хранится в папке кэша, если она задана
+        self.symbols = QKSymbols(self, self.p.symbol_classes, os.path.join(self.p.cache_path, 'symbols.json') if self.p.cache_path else None, self.p.symbols_ttl)
+        self.symbols.load()
+        self.converters = {}  # Перевод кол-ва и цен тикеров. (Код площадки, Код тикера) -> Перевод
+        self.subscriptions = {}  # Подписки QUIK. Название -> Подписка со всеми ее данными
+        self.tick_data = {}  # Тиковые данные. (Код площадки, Код тикера) -> Список данных
+        # Новые бары подписок, восстанавливаемых после переподключения. Название -> Список баров.
+        # Выдаются после пропущенных баров
+        self.held_bars = {}
+        self.held_lock = Lock()  # Бары ставит поток обработки функций обратного вызова, выдает поток восстановления
+        self.recover_lock = Lock()  # Восстановления после нескольких переподключений подряд идут одно за другим
+        self.datas = []  # Данные, добавленные в cerebro. Их историю загружаем при запуске
+        self.history_providers = []  # Дополнительные подключения к QUIK для загрузки истории
+        self.replay_feeds = []  # Данные, получившие последний новый бар при воспроизведении записи
+        # Локальный кэш свечей. Из QUIK будут запрашиваться только новые свечи
+        self.cache = QKCache(self.p.cache_path) if self.p.cache_path else None
+        # Биржевые часы. Общие для всех данных
+        self.clock = QKClock(self, self.p.clock_period)
+        # Последние цены тикеров, которые держит и торгует брокер
+        self.quotes = QKQuotes(self)
 
     def start(self):
         # Подключение терминала к серверу QUIK
@@ -55,6 +136,19 @@ class QKStore(Store):
         self.provider.OnDisconnected = self._on_disconnected
         # Обработчик новых баров по подписке из QUIK
         self.provider.OnNewCandle = self._on_candle
+        # Обработчик обезличенных сделок для тиковых данных
+        self.provider.OnAllTrade = self._on_all_trade
+        # Изменение параметров тикеров для кэша последних цен
+        self.provider.OnParam = self.quotes.on_param
+        if isinstance(self.p.provider, QKReplayProvider):  # Ускоренное воспроизведение записи ждет, пока данные заберут бары
+            self.p.provider.wait_consumed = self.wait_consumed
+        if self.metrics:
+            self.metrics.add_collector(self.collect_metrics)
+            if self.p.metrics_path:  # Файл метрик пишем в отдельном потоке
+                self.metrics_stop.clear()
+                Thread(target=self.dump_metrics, name='QKMetrics', daemon=True).start()
+        self.load_histories()  # Загружаем историю всех данных до их запуска
+        self.symbols.flush()  # Тикеры, найденные при загрузке, сохраняем одним файлом
 
     def put_notification(self, msg, *args, **kwargs):
         self.notifs.append((msg, args, kwargs))
@@ -67,32 +161,289 @@ class QKStore(Store):
     def stop(self):
         # Возвращаем обработчик по умолчанию
         self.provider.OnNewCandle = self.provider.default_handler
+        self.provider.OnAllTrade = self.provider.default_handler
+        self.provider.OnParam = self.provider.default_handler
+        self.quotes.close()
+        self.symbols.flush()  # Сохраняем тикеры, найденные за время работы
         # Закрываем соединение для запросов и поток обработки функций обратного вызова
         self.provider.close_connection()
+        if self.trade_provider is not self.provider:  # Закрываем подключение для транзакций
+            self.trade_provider.close_connection()
+        for provider in self.history_providers:  # Закрываем дополнительные подключения
+            provider.close_connection()
+        self.history_providers.clear()
+        if self.metrics and self.p.metrics_path:  # Записываем итоговые метрики
+            self.metrics_stop.set()
+            self.metrics.dump(self.p.metrics_path)
+        if self.recorder:
+            self.recorder.close()
 
     # Функции
 
+    def load_histories(self):
+        """Загрузка истории всех данных хранилища
+
+        Одновременно идет не больше history_workers загрузок.
+        Время запуска определяется самым долгим тикером, а не суммой всех тикеров
+        """
+        datas = [data for data in self.datas if data.history is None]
+        if not datas:  # Если загружать нечего
+            return  # то выходим, дальше не продолжаем
+        providers = self.provider_pool(max(min(self.p.history_workers, len(datas)), 1))
+        workers = providers.qsize()
+        now = date2num(self.clock.now())  # Биржевое время берем до загрузок, чтобы часы не сверялись по занятому подключению
+
+        def load(data):
+            provider = providers.get()  # Занимаем свободное подключение
+            try:
+                data.history = data.get_history(provider, now)
+            finally:
+                providers.put(provider)  # Освобождаем подключение
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(load, datas):  # Ошибки загрузки передаем дальше
+                pass
+
+    def make_provider(self, callbacks=True, ports=None):
+        """Новое подключение к QUIK
+
+        :param bool callbacks: Нужны ли подключению функции обратного вызова. QuikPy подключается к ним всегда
+        :param tuple ports: Порты запросов и функций обратного вызова QuikSharp. None - порты QuikPy по умолчанию
+        """
+        if ports is None:
+            provider = QuikPy(host=self.p.host)
+        else:
+            requests_port, callbacks_port = ports
+            provider = QuikPy(host=self.p.host, requests_port=requests_port, callbacks_port=callbacks_port)
+        return QKLockedProvider(provider)  # Подключением пользуются несколько потоков
+
+    def open_provider(self, callbacks=True, ports=None):
+        """Новое подключение к QUIK. Если метрики включены, то с замером задержек
+
+        :param bool callbacks: Нужны ли подключению функции обратного вызова
+        :param tuple ports: Порты запросов и функций обратного вызова QuikSharp. None - порты по умолчанию
+        """
+        provider = self.make_provider(callbacks, ports) if self.p.provider is None else self.p.provider
+        if self.recorder:  # Записываем ответы подключения до замера задержек
+            provider = QKRecordProvider(provider, self.recorder)
+        return QKMetricsProvider(provider, self.metrics) if self.metrics else provider
+
+    def collect_metrics(self, metrics):
+        """Очереди хранилища и данных перед снимком метрик
+
+        :param QKMetrics metrics: Метрики
+        """
+        for data in self.datas:  # Бары, пришедшие в данные, но еще не выданные в BackTrader
+            metrics.set('qk_feed_backlog', len(data.bars), feed=data.feed_name)
+        for datas in list(self.tick_data.values()):  # Готовые бары и необработанные сделки тиковых данных
+            for data in datas:
+                metrics.set('qk_feed_backlog', len(data.bars) + len(data.ticks), feed=data.feed_name)
+        metrics.set('qk_held_bars', sum(len(bars) for bars in list(self.held_bars.values())))  # Бары, придержанные на время восстановления
+        callbacks = getattr(self.provider, 'callbacks', None)  # Очередь функций обратного вызова подключения, если она есть
+        if callbacks is not None:
+            metrics.set('qk_callback_backlog', callbacks.qsize())
+
+    def dump_metrics(self):
+        """Поток записи файла метрик"""
+        while not self.metrics_stop.wait(self.p.metrics_period):
+            try:
+                self.metrics.dump(self.p.metrics_path)
+            except OSError as e:  # Ошибка записи не останавливает запись в следующий раз
+                print(f'Ошибка записи метрик {self.p.metrics_path}: {e}')
+
+    def provider_pool(self, workers):
+        """Очередь свободных подключений к QUIK для одновременных запросов
+
+        Первое подключение - подключение хранилища. Недостающие дополнительные подключения открываются
+        на портах history_ports. Подключений не больше, чем задано портов, плюс подключение хранилища
+
+        :param int workers: Кол-во подключений
+        """
+        ports = self.p.history_ports
+        if self.p.provider is None:  # Второй клиент QuikPy на тех же портах QuikSharp не обслуживается
+            workers = min(workers, len(ports) + 1)
+        while len(self.history_providers) < workers - 1:  # Открываем недостающие подключения
+            i = len(self.history_providers)
+            self.history_providers.append(self.open_provider(False, ports[i] if i < len(ports) else None))
+        providers = Queue()  # Свободные подключения
+        for provider in [self.provider] + self.history_providers[:workers - 1]:
+            providers.put(provider)
+        return providers
+
+    def get_bars_since(self, class_code, sec_code, interval, dt, provider=None, now=None):
+        """Бары из QUIK, начиная с бара с датой/временем открытия dt
+
+        Кол-во баров оцениваем по времени, прошедшему с dt.
+        Если QUIK вернул не все бары с dt, то удваиваем кол-во
+
+        :param str class_code: Код площадки
+        :param str sec_code: Код тикера
+        :param int interval: Временной интервал в минутах
+        :param float dt: Дата/время открытия бара в формате BackTrader
+        :param QuikPy provider: Подключение к QUIK. По умолчанию, подключение хранилища
+        :param float now: Текущее биржевое время в формате BackTrader. По умолчанию, по биржевым часам
+        """
+        provider = provider or self.provider
+        if now is None:
+            now = date2num(self.clock.now())  # Текущее биржевое время
+        count = max(int((now - dt) / (interval / 1440)), 0) + 2  # С запасом на текущий бар
+        while True:
+            bars = QKBars.from_quik(provider.get_candles_ds(class_code, sec_code, interval, count))
+            # Если в QUIK больше нет баров, или получили бары, начиная с dt
+            if len(bars) < count or bars.datetime[0] <= dt:
+                return bars
+            count *= 2
+
+    def recover(self):
+        """Восстановление подписок после переподключения
+
+        Подписки восстанавливаются по подключению хранилища, т.к. новые бары приходят по его функциям обратного вызова.
+        Пропущенные бары загружаются одновременно по history_workers подключениям.
+        Запросы по подключению хранилища ждут запросов потока BackTrader и брокера (QKLockedProvider).
+        По каждой подписке из QUIK получаем только бары, пропущенные с последнего выданного бара.
+        Они выдаются данным по порядку до новых баров, пришедших за время восстановления
+        """
+        with self.recover_lock:
+            subscriptions = list(self.subscriptions.items())
+            if not subscriptions:
+                return
+            print(f'Проверка подписки тикеров ({len(subscriptions)})')
+            providers = self.provider_pool(max(min(self.p.history_workers, len(subscriptions)), 1))
+            workers = providers.qsize()
+            now = date2num(self.clock.now())  # Биржевое время берем до проверки подписок
+
+            def recover_subscription(subscription):
+                dataname, subscription = subscription
+                class_code, sec_code, interval = subscription.class_code, subscription.sec_code, subscription.interval
+                provider = providers.get()  # Занимаем свободное подключение
+                bars = QKBars()  # Пропущенные бары
+                try:
+                    # Подписываемся только по подключению хранилища. Новые бары придут по его функциям обратного вызова
+                    if not self.provider.is_subs(class_code, sec_code, interval):  # Если нет подписки на тикер/интервал
+                        self.provider.subs_to_candles(class_code, sec_code, interval)  # то отправляем запрос на новую подписку
+                    last_dt = subscription.last_dt
+                    if last_dt is not None:  # Если бары по подписке уже выдавались
+                        bars = self.get_bars_since(class_code, sec_code, interval, last_dt, provider, now).since(last_dt)
+                        if bars:  # Последний бар придет по подписке
+                            bars.pop()
+                except Exception as e:  # Подписка восстанавливается, даже если пропущенные бары не получены
+                    print(f'{class_code}.{sec_code} на интервале {interval}: ошибка восстановления {e}')
+                finally:
+                    providers.put(provider)  # Освобождаем подключение
+                    with self.held_lock:  # Выдаем пропущенные бары, затем новые бары, пришедшие за время восстановления
+                        for i in range(len(bars)):
+                            subscription.put_bar(bars[i])
+                        for bar in self.held_bars.pop(dataname, []):
+                            subscription.put_bar(bar)
+                print(f'{class_code}.{sec_code} на интервале {interval}: пропущено баров {len(bars)}')
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for _ in executor.map(recover_subscription, subscriptions):
+                    pass
+
+    def base_interval(self, data):
+        """Интервал подписки QUIK для данных
+
+        Если на этот же тикер есть данные с меньшим интервалом, на который делится интервал данных,
+        то подписываемся на наименьший из них, а бары данных собираем из его баров.
+        Недели и месяцы так не собираются
+        """
+        if data.interval > 1440:  # Для недель и месяцев
+            return data.interval  # подписываемся на свой интервал
+        return min((other.interval for other in self.datas
+                    if other.p.live and other.class_code == data.class_code and
+                    other.sec_code == data.sec_code and data.interval % other.interval == 0),
+                   default=data.interval)
+
+    def subscribe(self, data):
+        """Подписка данных на новые бары
+
+        На тикер создается одна подписка QUIK по наименьшему интервалу.
+        Запросы в QUIK идут только для первых данных подписки
+        """
+        class_code, sec_code = data.class_code, data.sec_code
+        interval = self.base_interval(data)  # Интервал подписки
+        dataname = f'{class_code}.{sec_code}_{interval}'
+        subscription = self.subscriptions.get(dataname)
+        new = subscription is None  # Новая подписка QUIK
+        if new:
+            subscription = QKSubscription(class_code, sec_code, interval)
+        if interval == data.interval:  # Если бары подписки идут в данные напрямую
+            if subscription.last_dt is None:  # Бары подписки пойдут после истории данных
+                subscription.last_dt = data.history_last_dt
+        else:  # Если бары данных собираются из баров подписки
+            data.builder = QKBarBuilder(data.interval * 60)
+            other = subscription.find_derived(data.interval)
+            if other is not None:  # Если такие же бары уже собираются
+                data.builder.bar = list(other.builder.bar) if other.builder.bar else None  # то начинаем с их собираемого бара
+            else:
+                self.seed_builder(data, subscription)
+        subscription.add(data)
+        self.subscriptions[dataname] = subscription
+        # TODO: Does is_subs check needed?
+        if new and not self.provider.is_subs(class_code, sec_code, interval):
+            self.provider.subs_to_candles(class_code, sec_code, interval)
+
+    def unsubscribe(self, data):
+        """Отмена подписки данных на новые бары
+
+        Подписка QUIK отменяется, когда ее бары больше никому не нужны
+        """
+        dataname = f'{data.class_code}.{data.sec_code}_{self.base_interval(data)}'
+        subscription = self.subscriptions.get(dataname)
+        if subscription is None:
+            return
+        subscription.remove(data)
+        if not subscription:  # Если у подписки не осталось данных
+            del self.subscriptions[dataname]
+            self.provider.unsubs_from_candles(subscription.class_code, subscription.sec_code, subscription.interval)
+
+    def subscribe_ticks(self, data):
+        """Подписка тиковых данных на обезличенные сделки
+
+        QUIK присылает все обезличенные сделки. Подписка только выбирает сделки тикера
+        """
+        self.tick_data.setdefault((data.class_code, data.sec_code), []).append(data)
+
+    def unsubscribe_ticks(self, data):
+        """Отмена подписки тиковых данных на обезличенные сделки"""
+        key = (data.class_code, data.sec_code)
+        datas = [tick_data for tick_data in self.tick_data.get(key, []) if tick_data is not data]
+        if datas:
+            self.tick_data[key] = datas
+        else:
+            self.tick_data.pop(key, None)
+
+    def seed_builder(self, data, subscription):
+        """Начало собираемого бара данных из баров подписки, пришедших до нее
+
+        :param QKData data: Данные
+        :param QKSubscription subscription: Подписка
+        """
+        interval = subscription.interval
+        bars = QKBars.from_quik(self.provider.get_candles_ds(
+            data.class_code, data.sec_code, interval, data.interval // interval + 1))
+        if not bars:
+            return
+        if len(bars) > 1 and subscription.last_dt is None:  # Бары подписки пойдут после баров, уже учтенных в истории и собираемом баре
+            subscription.last_dt = bars.datetime[-2]
+        start = data.builder.bucket(bars.datetime[-1])  # Дата/время открытия текущего собираемого бара
+        for i in range(len(bars) - 1):  # Последний бар придет по подписке
+            if data.builder.bucket(bars.datetime[i]) == start:
+                data.builder.add(*bars[i])
+
     def get_symbol_info(self, class_code, sec_code, reload=False):
         """Получение информации тикера
 
         :param str class_code: Код площадки
         :param str sec_code: Код тикера
         :param bool reload: Получить информацию из QUIK
-        :return: Значение из кэша/QUIK или None, если тикер не найден
-        """
-        # Если нужно получить информацию из QUIK или
-        # нет информации о тикере в справочнике
-        if reload or (class_code, sec_code) not in self.symbols:
-            # Получаем информацию о тикере из QUIK
-            symbol_info = self.provider.getSecurityInfo(class_code, sec_code)
-            # Если ответ не пришел (возникла ошибка). Например, для опциона
-            if not symbol_info:
-                print(f'Информация о {class_code}.{sec_code} не найдена')
-                return None
-            # Заносим информацию о тикере в справочник
-            self.symbols[(class_code, sec_code)] = symbol_info
-        # Возвращаем значение из справочника
-        return self.symbols[(class_code, sec_code)]
+        :return: Значение из справочника/QUIK или None, если тикер не найден
+        """
+        symbol_info = self.symbols.get(class_code, sec_code, reload)
+        if symbol_info is None:
+            print(f'Информация о {class_code}.{sec_code} не найдена')
+        return symbol_info
 
     def from_ticker(self, ticker):
         """Код площадки и код тикера из названия тикера(с кодом площадки или без него)
@@ -106,8 +457,8 @@ class QKStore(Store):
             class_code = symbol_parts[0]  # Код площадки
             sec_code = '.'.join(symbol_parts[1:])  # Код тикера
         else:  # Если тикер задан без площадки
-            # Получаем код площадки по коду инструмента из имеющихся классов
-            class_code = self.provider.getSecurityClass(self.class_codes, ticker)
+            # Получаем код площадки по коду инструмента из справочника или из имеющихся классов
+            class_code = self.symbols.class_code(ticker, self.class_codes)
             sec_code = ticker  # Код тикера
         return class_code, sec_code
 
@@ -121,8 +472,30 @@ class QKStore(Store):
         """
         return f'{class_code}.{sec_code}'
 
-    # TODO: Completly remove the transfer from the lots to pieces
-    # size_to_lots, lots_to_size, bt_to_quik_price, quik_to_bt_price
+    def data_name_to_class_sec_code(self, dataname):
+        """Код площадки и код тикера из названия данных (с кодом площадки или без него)"""
+        return self.from_ticker(dataname)
+
+    def class_sec_code_to_data_name(self, class_code, sec_code):
+        """Название данных из кода площадки и кода тикера"""
+        return self.to_ticker(class_code, sec_code)
+
+    def get_converter(self, class_code, sec_code):
+        """Перевод кол-ва и цен тикера между BackTrader и QUIK
+
+        Создается один раз на тикер. Для ненайденного тикера не запоминается, чтобы найти его в следующий раз
+
+        :param str class_code: Код площадки
+        :param str sec_code: Код тикера
+        :return: Перевод тикера
+        """
+        converter = self.converters.get((class_code, sec_code))
+        if converter is None:
+            symbol_info = self.get_symbol_info(class_code, sec_code)
+            converter = QKConverter.from_symbol_info(class_code, sec_code, symbol_info)
+            if symbol_info:
+                self.converters[(class_code, sec_code)] = converter
+        return converter
 
     def size_to_lots(self, class_code, sec_code, size: int):
         """Перевод кол-ва из штук в лоты
@@ -132,13 +505,7 @@ class QKStore(Store):
         :param int size: Кол-во в штуках
         :return: Кол-во в лотах
         """
-        # Получаем параметры тикера (lot_size)
-        si = self.get_symbol_info(class_code, sec_code)
-        if not si:  # Если тикер не найден
-            return size  # то кол-во не изменяется
-        lot_size = si['lot_size']  # Размер лота тикера
-        # Если задан лот, то переводим
-        return int(size / lot_size) if lot_size > 0 else size
+        return self.get_converter(class_code, sec_code).size_to_lots(size)
 
     def lots_to_size(self, class_code, sec_code, lots: int):
         """Перевод кол-ва из лотов в штуки
@@ -148,13 +515,7 @@ class QKStore(Store):
         :param int lots: Кол-во в лотах
         :return: Кол-во в штуках
         """
-        # Получаем параметры тикера (lot_size)
-        si = self.get_symbol_info(class_code, sec_code)
-        if not si:  # Если тикер не найден
-            return lots  # то лот не изменяется
-        lot_size = si['lot_size']  # Размер лота тикера
-        # Если задан лот, то переводим
-        return lots * lot_size if lot_size > 0 else lots
+        return self.get_converter(class_code, sec_code).lots_to_size(lots)
 
     def bt_to_quik_price(self, class_code, sec_code, price: float):
         """Перевод цен из BackTrader в QUIK
@@ -164,17 +525,7 @@ class QKStore(Store):
         :param float price: Цена в BackTrader
         :return: Цена в QUIK
         """
-        if class_code == 'TQOB':  # Для рынка облигаций
-            return price / 10  # цену делим на 10
-        if class_code == 'SPBFUT':  # Для рынка фьючерсов
-            # Получаем параметры тикера (lot_size)
-            si = self.get_symbol_info(class_code, sec_code)
-            if not si:  # Если тикер не найден
-                return price  # то цена не изменяется
-            lot_size = si['lot_size']  # Размер лота тикера
-            if lot_size > 0:  # Если лот задан
-                return price * lot_size  # то цену умножаем на лот
-        return price  # В остальных случаях цена не изменяется
+        return self.get_converter(class_code, sec_code).bt_to_quik_price(price)
 
     def quik_to_bt_price(self, class_code, sec_code, price: float):
         """Перевод цен из QUIK в BackTrader
@@ -184,17 +535,7 @@ class QKStore(Store):
         :param float price: Цена в QUIK
         :return: Цена в BackTrader
         """
-        if class_code == 'TQOB':  # Для рынка облигаций
-            return price * 10  # цену умножаем на 10
-        if class_code == 'SPBFUT':  # Для рынка фьючерсов
-            # Получаем параметры тикера (lot_size)
-            si = self.get_symbol_info(class_code, sec_code)
-            if not si:  # Если тикер не найден
-                return price  # то цена не изменяется
-            lot_size = si['lot_size']  # Размер лота тикера
-            if lot_size > 0:  # Если лот задан
-                return price / lot_size  # то цену делим на лот
-        return price  # В остальных случаях цена не изменяется
+        return self.get_converter(class_code, sec_code).quik_to_bt_price(price)
 
     def _on_connected(self, data):
         """Обработка событий подключения к QUIK"""
@@ -202,20 +543,14 @@ class QKStore(Store):
         dt = datetime.now(self.MarketTimeZone)
         print(f'{dt.strftime("%d.%m.%Y %H:%M")}: QUIK Подключен')
         self.connected = True  # QUIK подключен к серверу брокера
-        print(f'Проверка подписки тикеров ({len(self.subscribed_data)})')
-        # Пробегаемся по всем подписанным тикерам
-        for sub_symb in self.subscribed_data.values():
-            class_code = sub_symb.class_code  # Код площадки
-            sec_code = sub_symb.sec_code  # Код тикера
-            interval = sub_symb.interval  # Временной интервал
-            print(f'{class_code}.{sec_code} на интервале {interval}', end=' ')
-
-            # Если нет подписки на тикер/интервал
-            if not self.provider.is_subs(class_code, sec_code, interval):
-                self.provider.subs_to_candles(class_code, sec_code, interval)
-                print('нет подписки. Отправлен запрос на новую подписку')
-            else:  # Если подписка была, то переподписываться не нужно
-                print('есть подписка')
+        self.clock.reset()  # Сверяем биржевые часы после переподключения
+        if not self.subscriptions:
+            return
+        with self.held_lock:  # Новые бары подписок придержим до выдачи пропущенных баров
+            for dataname in list(self.subscriptions):
+                self.held_bars.setdefault(dataname, [])
+        # Восстанавливаем подписки в отдельном потоке, чтобы не задерживать обработку функций обратного вызова
+        Thread(target=self.recover, daemon=True).start()
 
     def _on_disconnected(self, data):
         """Обработка событий отключения от QUIK"""
@@ -227,6 +562,50 @@ class QKStore(Store):
         print(f'{dt.strftime("%d.%m.%Y %H:%M")}: QUIK Отключен')
         self.connected = False
 
+    def wait_consumed(self, cmd, data, timeout):
+        """Ожидание, пока данные не заберут выданные им новые бары
+
+        Нужно ускоренному воспроизведению записи (QKReplayProvider). Каждая функция обратного вызова ждет,
+        пока BackTrader не обработает прошлый новый бар, а новый бар еще и пока его данные не заберут все бары.
+        Поэтому события приходят между барами, а данные переходят в LIVE, как при записи
+
+        :param str cmd: Название функции обратного вызова
+        :param dict data: Данные функции обратного вызова
+        :param float timeout: Максимальное время ожидания каждых данных в секундах
+        """
+        feeds = self.replay_feeds  # Данные, получившие прошлый новый бар
+        if cmd == 'OnNewCandle':
+            subscription = self.subscriptions.get(f'{data["class"]}.{data["sec"]}_{data["interval"]}')
+            self.replay_feeds = subscription.datas + subscription.derived if subscription is not None else []
+            feeds = feeds + self.replay_feeds
+        for feed in feeds:
+            feed.bars.wait_drained(timeout)
+
     def _on_candle(self, data):
+        """Обработка нового бара по подписке
+
+        Бар переводится один раз и раздается всем данным подписки
+        """
         dataname = f'{data["class"]}.{data["sec"]}_{data["interval"]}'
-        self.subscribed_data[dataname].bars.append(data)
+        bar = QKBars.quik_bar(data)
+        if self.held_bars:  # Если идет восстановление подписок после переподключения
+            with self.held_lock:
+                held = self.held_bars.get(dataname)
+                if held is not None:  # Если подписка еще восстанавливается
+                    held.append(bar)  # то бар выдадим после пропущенных баров
+                    return
+        subscription = self.subscriptions.get(dataname)
+        if subscription is not None:
+            subscription.put_bar(bar)
+
+    def _on_all_trade(self, data):
+        """Обработка обезличенной сделки
+
+        Сделка только обновляет последнюю цену и ставится в очередь тиковых данных тикера. Запросов в QUIK нет
+        """
+        trade = data['data']
+        self.quotes.on_all_trade(trade['class_code'], trade['sec_code'], trade['price'])
+        datas = self.tick_data.get((trade['class_code'], trade['sec_code']))
+        if datas:
+            for tick_data in datas:
+                tick_data.put_tick(trade['datetime'], trade['price'], trade['qty'])
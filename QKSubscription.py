@@ -0,0 +1,68 @@
+class QKSubscription:
+    """Подписка QUIK на новые бары тикера/интервала
+
+    Одна подписка QUIK раздает бары всем своим данным. Данные добавляются и удаляются без запросов в QUIK.
+    Подписка QUIK отменяется, когда у нее не остается данных.
+    Списки данных не изменяются, а заменяются, чтобы поток обработки функций обратного вызова
+    мог раздавать бары без блокировок
+    """
+
+    def __init__(self, class_code, sec_code, interval):
+        """
+        :param str class_code: Код площадки
+        :param str sec_code: Код тикера
+        :param int interval: Временной интервал в минутах
+        """
+        self.class_code = class_code
+        self.sec_code = sec_code
+        self.interval = interval
+        self.datas = []  # Данные, получающие бары подписки напрямую
+        self.derived = []  # Данные, собирающие бары большего интервала из баров подписки
+        self.last_dt = None  # Дата/время открытия последнего выданного бара
+
+    @property
+    def dataname(self):
+        """Название подписки"""
+        return f'{self.class_code}.{self.sec_code}_{self.interval}'
+
+    def __len__(self):
+        """Кол-во данных подписки"""
+        return len(self.datas) + len(self.derived)
+
+    def add(self, data):
+        """Добавление данных
+
+        :param QKData data: Данные. Если у данных есть сборщик баров, то бары данных собираются из баров подписки
+        """
+        if data.builder is None:
+            self.datas = self.datas + [data]
+        else:
+            self.derived = self.derived + [data]
+
+    def remove(self, data):
+        """Удаление данных"""
+        # Сравниваем по ссылке, т.к. == у данных BackTrader создает индикатор
+        self.datas = [other for other in self.datas if other is not data]
+        self.derived = [other for other in self.derived if other is not data]
+
+    def find_derived(self, interval):
+        """Данные, собирающие бары интервала interval. None, если таких данных нет"""
+        return next((data for data in self.derived if data.interval == interval), None)
+
+    def put_bar(self, bar):
+        """Выдача бара всем данным подписки
+
+        Бары, не новее последнего выданного бара, пропускаются
+
+        :param tuple bar: Бар (dt, open, high, low, close, volume, live)
+        """
+        if self.last_dt is not None and bar[0] <= self.last_dt:  # Если бар уже выдавался
+            return
+        self.last_dt = bar[0]
+        for data in self.datas:
+            data.put_bar(*bar)
+        if self.derived:
+            close_dt = bar[0] + self.interval / 1440  # Дата/время закрытия бара подписки
+            for data in self.derived:
+                for derived_bar in data.builder.add(*bar, close_dt=close_dt):
+                    data.put_bar(*derived_bar)
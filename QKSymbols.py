@@ -0,0 +1,140 @@
+import json
+import os
+from threading import Lock
+from time import time
+
+
+class QKSymbols:
+    """Справочник тикеров QUIK
+
+    При запуске информация о всех тикерах заданных площадок загружается из QUIK пакетами,
+    а не по одному запросу на тикер. Справочник сохраняется в файл и перезагружается из QUIK,
+    когда становится старше ttl секунд.
+    Тикеры ищутся по коду площадки и коду тикера, и по коду тикера без площадки.
+    Тикеры, найденные в QUIK по одному, дописываются в файл при сохранении flush
+    """
+
+    bulk_size = 500  # Кол-во тикеров в одном пакетном запросе информации
+
+    def __init__(self, store, class_codes=(), path=None, ttl=86400):
+        """
+        :param QKStore store: Хранилище QUIK
+        :param tuple class_codes: Коды площадок, тикеры которых загружаются при запуске
+        :param str path: Файл справочника. None - справочник не сохраняется
+        :param float ttl: Время жизни файла справочника в секундах
+        """
+        self.store = store
+        self.class_codes = tuple(class_codes)
+        self.path = path
+        self.ttl = ttl
+        self.lock = Lock()  # Справочником пользуются данные, брокер и потоки загрузки истории
+        self.symbols = {}  # Информация о тикерах. (Код площадки, Код тикера) -> Информация о тикере
+        self.sec_classes = {}  # Коды площадок тикеров. Код тикера -> Код площадки
+        self.loaded = 0  # Время пакетной загрузки справочника из QUIK. От него отсчитывается время жизни файла
+        self.dirty = False  # Есть тикеры, еще не сохраненные в файл
+
+    def load(self):
+        """Загрузка справочника из файла или из QUIK, если файла нет или он устарел"""
+        with self.lock:
+            if not self.load_file():  # Если справочник не загрузился из файла
+                self.load_quik()  # то загружаем его из QUIK
+                if self.symbols:  # Если QUIK не вернул тикеры, например, нет подключения к серверу, то файл не перезаписываем
+                    self.save()  # и сохраняем в файл
+
+    def load_file(self):
+        """Загрузка справочника из файла
+
+        :return: True - справочник загружен, False - файла нет, он устарел или в нем другие площадки
+        """
+        if not self.path:
+            return False
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):  # Файла нет или он испорчен
+            return False
+        if time() - catalog.get('time', 0) >= self.ttl or tuple(catalog.get('class_codes', ())) != self.class_codes:
+            return False
+        self.loaded = catalog['time']
+        for class_code, sec_code, symbol_info in catalog.get('symbols', []):
+            self.add(symbol_info, class_code, sec_code)
+        return True
+
+    def load_quik(self):
+        """Пакетная загрузка информации о всех тикерах площадок из QUIK"""
+        provider = self.store.provider
+        self.loaded = time()
+        keys = []  # Коды площадок и тикеров в формате <Код площадки>|<Код тикера>
+        for class_code in self.class_codes:
+            sec_codes = provider.getClassSecurities(class_code)  # Коды тикеров через запятую
+            keys.extend(f'{class_code}|{sec_code}' for sec_code in (sec_codes or '').split(',') if sec_code)
+        for i in range(0, len(keys), self.bulk_size):
+            for symbol_info in provider.getSecurityInfoBulk(keys[i:i + self.bulk_size]) or []:
+                if symbol_info:  # Для ненайденных тикеров информации нет
+                    self.add(symbol_info)
+
+    def save(self):
+        """Сохранение справочника в файл"""
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'time': self.loaded, 'class_codes': self.class_codes,
+                       'symbols': [(*key, symbol_info) for key, symbol_info in self.symbols.items()]}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)  # Файл справочника всегда целый
+
+    def add(self, symbol_info, class_code=None, sec_code=None):
+        """Добавление информации о тикере в справочник
+
+        :param dict symbol_info: Информация о тикере
+        :param str class_code: Код площадки. None - берется из информации о тикере
+        :param str sec_code: Код тикера. None - берется из информации о тикере
+        """
+        class_code = class_code or symbol_info['class_code']
+        sec_code = sec_code or symbol_info['code']
+        self.symbols[(class_code, sec_code)] = symbol_info
+        # Без площадки тикер относится к первой площадке по порядку загрузки
+        self.sec_classes.setdefault(sec_code, class_code)
+
+    def get(self, class_code, sec_code, reload=False):
+        """Информация о тикере
+
+        Тикеры, которых нет в справочнике, запрашиваются из QUIK по одному и добавляются в справочник
+
+        :param str class_code: Код площадки
+        :param str sec_code: Код тикера
+        :param bool reload: Получить информацию из QUIK
+        :return: Информация о тикере или None, если тикер не найден
+        """
+        symbol_info = None if reload else self.symbols.get((class_code, sec_code))
+        if symbol_info is not None:
+            return symbol_info
+        symbol_info = self.store.provider.getSecurityInfo(class_code, sec_code)
+        if not symbol_info:  # Если ответ не пришел (возникла ошибка). Например, для опциона
+            return None
+        with self.lock:
+            self.add(symbol_info, class_code, sec_code)
+            self.dirty = True  # Файл перезапишем один раз при сохранении
+        return symbol_info
+
+    def flush(self):
+        """Сохранение в файл тикеров, найденных в QUIK по одному"""
+        with self.lock:
+            if self.dirty:
+                self.save()
+                self.dirty = False
+
+    def class_code(self, sec_code, class_codes):
+        """Код площадки тикера
+
+        :param str sec_code: Код тикера
+        :param str class_codes: Коды площадок через запятую для поиска в QUIK, если тикера нет в справочнике
+        :return: Код площадки
+        """
+        class_code = self.sec_classes.get(sec_code)
+        if class_code is None:
+            class_code = self.store.provider.getSecurityClass(class_codes, sec_code)
+            if class_code:
+                self.sec_classes[sec_code] = class_code
+        return class_code
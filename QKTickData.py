@@ -0,0 +1,130 @@
+from datetime import datetime
+from threading import Condition
+
+from backtrader.feed import AbstractDataBase
+from backtrader import TimeFrame, date2num
+
+from .QKBars import QKBars, QKBarBuilder
+
+
+class QKTickData(AbstractDataBase):
+    """Тиковые данные QUIK из потока обезличенных сделок
+
+    - TimeFrame.Ticks - каждая сделка идет отдельным баром
+    - TimeFrame.Seconds, TimeFrame.Minutes - бары собираются из сделок по compression секунд/минут
+
+    Тикер должен быть включен в таблицу обезличенных сделок QUIK. Истории нет, только новые сделки
+    """
+
+    params = (
+        ('qcheck', 0.5),  # Максимальное время ожидания новых сделок в секундах
+        # Через сколько секунд после окончания времени собираемого бара выдавать его по биржевым часам, если новых сделок нет.
+        # Биржевые часы точны до секунды, а сделки бара могут прийти с опозданием
+        ('flush_delay', 1),
+    )
+
+    def islive(self):
+        """Сделки идут одна за другой. Cerebro не будет запускать preload и runonce"""
+        return True
+
+    def __init__(self, store, **kwargs):
+        self.store = store
+        # По тикеру получаем код площадки и код тикера
+        self.class_code, self.sec_code = self.store.from_ticker(self.p.dataname)
+        self.bars = QKBars()  # Буфер баров по столбцам
+        self.lock = Condition()  # Сделки ставятся в очередь из потока обработки функций обратного вызова
+        self.ticks = []  # Очередь необработанных сделок (Дата/время QUIK, Цена, Кол-во)
+        self.feed_name = self.p.dataname  # Название данных в метриках
+        # Секунд в собираемом баре. Для тиков бары не собираются
+        match self.p.timeframe:
+            case TimeFrame.Seconds:
+                self.builder = QKBarBuilder(self.p.compression)
+            case TimeFrame.Minutes:
+                self.builder = QKBarBuilder(self.p.compression * 60)
+            case _:
+                self.builder = None
+
+    def setenvironment(self, env):
+        """Добавление хранилища QUIK в cerebro"""
+        super().setenvironment(env)
+        env.addstore(self.store)  # Добавление хранилища QUIK в cerebro
+
+    def start(self):
+        super().start()
+        self.feed_name = self._name or self.feed_name  # Название, заданное в cerebro
+        self.store.subscribe_ticks(self)
+        self.put_notification(self.LIVE)
+
+    def _load(self):
+        """Загружаем новый бар в BackTrader
+
+        return None - Нового бара нет, но будет
+        return True - Новый бар есть
+        """
+        if not self.bars:  # Если готовых баров нет
+            self.take_ticks(self._qcheck)  # то ждем сделки и переводим их в бары
+            if not self.bars:
+                return None
+
+        dt, bar_open, high, low, close, volume, live = self.bars.popleft()
+        self.lines.datetime[0] = dt
+        self.lines.open[0] = bar_open
+        self.lines.high[0] = high
+        self.lines.low[0] = low
+        self.lines.close[0] = close
+        self.lines.volume[0] = volume
+        self.lines.openinterest[0] = 0
+        if self.store.metrics:  # Считаем бары, выданные в BackTrader
+            self.store.metrics.inc('qk_feed_bars_total', feed=self.feed_name)
+        return True
+
+    def stop(self):
+        super().stop()
+        self.store.unsubscribe_ticks(self)
+        self.put_notification(self.DISCONNECTED)
+
+    def haslivedata(self):
+        """Есть ли готовые бары или необработанные сделки"""
+        return len(self.bars) > 0 or len(self.ticks) > 0
+
+    # Функции
+
+    def put_tick(self, dt, price, qty):
+        """Постановка сделки в очередь. Вызывается хранилищем из потока обработки функций обратного вызова
+
+        Сделка не переводится, а только ставится в очередь. Перевод идет пакетами в потоке BackTrader
+
+        :param dict dt: Дата/время сделки QUIK
+        :param float price: Цена
+        :param float qty: Кол-во
+        """
+        with self.lock:
+            self.ticks.append((dt, price, qty))
+            if len(self.ticks) == 1:  # Если очередь была пустой
+                self.lock.notify()  # то будим поток BackTrader
+
+    def take_ticks(self, timeout):
+        """Перевод всех сделок из очереди в бары
+
+        :param float timeout: Максимальное время ожидания сделок в секундах
+        """
+        with self.lock:
+            if not self.ticks:
+                self.lock.wait(timeout)
+            ticks, self.ticks = self.ticks, []  # Забираем всю очередь разом
+        builder = self.builder
+        for dt, price, qty in ticks:
+            dt = date2num(datetime(dt['year'], dt['month'], dt['day'], dt['hour'], dt['min'],
+                                   dt['sec'], dt.get('mcs', dt.get('ms', 0) * 1000)))
+            if builder is None:  # Для тиков
+                self.bars.append(dt, price, price, price, price, qty, True)  # каждая сделка - бар
+            elif builder.is_late(dt):  # Опоздавшая сделка бара, уже выданного по биржевым часам, пропускается
+                if self.store.metrics:  # Иначе BackTrader получит второй бар с той же датой/временем
+                    self.store.metrics.inc('qk_late_ticks_total', feed=self.feed_name)
+            else:  # Если бары собираются из сделок
+                for bar in builder.add(dt, price, price, price, price, qty, True):
+                    self.bars.append(*bar)
+        # Если сделок нет, а время собираемого бара вышло, то выдаем его, не дожидаясь следующей сделки
+        if builder is not None and builder.bar and \
+                date2num(self.store.clock.now()) >= builder.bar[0] + (builder.seconds + self.p.flush_delay) / 86400:
+            self.bars.append(*builder.flush())
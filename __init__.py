@@ -1,3 +1,8 @@
 from .QKStore import *
 from .QKData import *  # Также подключает данные в хранилище
+from .QKTickData import *
 from .QKBroker import *  # Также подключает брокера в хранилище
+from .QKAsyncStore import *
+from .QKSimulator import *
+from .QKRecorder import *
+from .QKLockedProvider import *
@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+from threading import Timer
+
+import pytest
+
+# Для импортирования QKStore
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parents[2]))
+
+from BackTraderQuik.QKStore import QKStore  # Хранилище QUIK
+from BackTraderQuik.QKSimulator import QKSimulator  # Симулятор QUIK
+
+# Тесты идут на симуляторе QUIK без терминала. Для импорта хранилища нужен установленный QuikPy
+start_dt = datetime(2024, 1, 10, 10, 0)  # Дата/время первой свечи
+
+
+def make_candles(count):
+    """Минутные свечи внутри торговой сессии (10:00-18:20) с детерминированным движением цены"""
+    candles, price = [], 100.0
+    for i in range(count):
+        day, minute = divmod(i, 500)  # 500 минутных свечей в день
+        dt = start_dt + timedelta(days=day, minutes=minute)
+        open_price = price
+        price = max(price + (i * 7919) % 21 / 100 - 0.1, 1)
+        candles.append((dt, open_price, max(open_price, price) + 0.05, min(open_price, price) - 0.05, price, 100))
+    return candles
+
+
+def run(cerebro, timeout=10):
+    """Запуск cerebro. Если торговая система не остановила его сама, то останавливаем через timeout секунд
+
+    :return: Торговая система
+    """
+    timer = Timer(timeout, cerebro.runstop)
+    timer.daemon = True
+    timer.start()
+    try:
+        return cerebro.run()[0]
+    finally:
+        timer.cancel()
+
+
+@pytest.fixture
+def new_store():
+    """Новое хранилище на симуляторе. Хранилище - singleton, поэтому для каждого теста сбрасываем созданное"""
+    simulators = []
+
+    def make(simulator, **kwargs):
+        simulators.append(simulator)
+        QKStore._singleton = None
+        return QKStore(provider=simulator, clock_period=0, **kwargs)
+
+    yield make
+    for simulator in simulators:  # Останавливаем потоки симуляторов
+        simulator.close_connection()
+    QKStore._singleton = None
+
+
+@pytest.fixture
+def simulator():
+    """Симулятор с минутными свечами фьючерса SPBFUT.SiZ4. Последние 20 свечей приходят как новые бары"""
+    simulator = QKSimulator(live_bars=20, bar_period=0.02)
+    simulator.add_candles('SPBFUT', 'SiZ4', 1, make_candles(520))
+    return simulator
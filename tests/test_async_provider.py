@@ -0,0 +1,66 @@
+import asyncio
+import concurrent.futures
+import json
+from threading import Thread
+from time import sleep
+
+import pytest
+
+from BackTraderQuik.QKAsyncProvider import QKAsyncProvider, QKSyncProvider
+
+
+@pytest.fixture
+def port():
+    """Сервер запросов QuikSharp в своем потоке. Отвечает на запрос его командой.
+    Запрос huge получает ответ больше limit, запрос hang остается без ответа
+
+    :return: Порт запросов
+    """
+    loop = asyncio.new_event_loop()
+
+    async def handle(reader, writer):
+        while line := await reader.readline():
+            request = json.loads(line)
+            if request['cmd'] == 'huge':
+                writer.write(b'x' * 5000 + b'\r\n')
+            elif request['cmd'] != 'hang':
+                writer.write((json.dumps({'id': request['id'], 'data': request['cmd']}) + '\r\n').encode())
+            await writer.drain()
+
+    server = loop.run_until_complete(asyncio.start_server(handle, '127.0.0.1', 0))
+    Thread(target=loop.run_forever, daemon=True).start()
+    yield server.sockets[0].getsockname()[1]
+    loop.call_soon_threadsafe(server.close)
+    loop.call_soon_threadsafe(loop.stop)
+
+
+@pytest.fixture
+def provider(port, monkeypatch):
+    """Синхронное подключение без функций обратного вызова с ответами до 1 КБ"""
+    monkeypatch.setattr(QKAsyncProvider, 'limit', 1024)
+    provider = QKSyncProvider('127.0.0.1', port, None, timeout=0.5)
+    yield provider
+    provider.close_connection()
+
+
+def test_request(provider):
+    """Ответ приходит на свой запрос"""
+    assert provider.run(provider.aprovider.data('getInfoParam')) == 'getInfoParam'
+
+
+def test_timeout_cancels_request(provider):
+    """Запрос без ответа отменяется по таймауту и не остается в ожидаемых ответах"""
+    with pytest.raises(concurrent.futures.TimeoutError):
+        provider.run(provider.aprovider.data('hang'))
+    sleep(0.05)  # Отмена выполняется в цикле событий
+    assert not provider.aprovider.futures
+    assert provider.run(provider.aprovider.data('after')) == 'after'  # Подключение продолжает работать
+
+
+def test_reader_error_fails_requests(provider):
+    """Ответ больше limit закрывает подключение. Ждущий и следующие запросы сразу получают ошибку, а не зависают"""
+    with pytest.raises(ConnectionError):
+        provider.run(provider.aprovider.data('huge'))
+    with pytest.raises(ConnectionError):
+        provider.run(provider.aprovider.data('after'))
+    assert not provider.aprovider.futures
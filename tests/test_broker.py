@@ -0,0 +1,189 @@
+import backtrader as bt
+import pytest
+
+from conftest import make_candles, run
+from BackTraderQuik.QKSimulator import QKSimulator
+
+
+class Orders(bt.Strategy):
+    """Запись статусов заявок. Заявки выставляются в LIVE в place, дальше - по статусам в on_order"""
+
+    def __init__(self):
+        self.orders = []  # Заявки по порядку выставления
+        self.statuses = {}  # Номер заявки в BackTrader -> Список статусов
+
+    def notify_order(self, order):
+        self.statuses.setdefault(order.ref, []).append(order.getstatusname())
+        self.on_order(order)
+
+    def next(self):
+        if self.data._laststatus == self.data.LIVE and not self.orders:  # Первая заявка - по первому новому бару
+            self.orders.append(self.place())
+        elif self.orders:
+            self.on_bar()
+
+    def place(self):
+        """Первая заявка"""
+        raise NotImplementedError
+
+    def on_order(self, order):
+        """Изменение статуса заявки"""
+        pass
+
+    def on_bar(self):
+        """Новый бар после выставления первой заявки"""
+        pass
+
+
+class RoundTrip(Orders):
+    """Покупка по рынку и закрытие позиции после исполнения"""
+
+    def place(self):
+        return self.buy(size=2)
+
+    def on_order(self, order):
+        if order.status != order.Completed:
+            return
+        if order.isbuy():
+            self.orders.append(self.sell(size=2))
+        else:
+            self.env.runstop()
+
+
+class CancelStop(Orders):
+    """Стоп заявка на покупку выше рынка снимается, не сработав"""
+
+    def place(self):
+        price = self.data.close[0] * 1.5
+        return self.buy(exectype=bt.Order.StopLimit, price=price, plimit=price, size=1)
+
+    def on_order(self, order):
+        if order.status == order.Accepted:
+            self.cancel(order)
+        elif order.status == order.Canceled:
+            self.env.runstop()
+
+
+class CancelLinked(Orders):
+    """Стоп заявка на покупку ниже рынка срабатывает, а выставленная по ней лимитная заявка ниже рынка снимается"""
+
+    def place(self):
+        price = self.data.close[0]
+        return self.buy(exectype=bt.Order.StopLimit, price=price * 0.999, plimit=price * 0.5, size=1)
+
+    def on_bar(self):
+        order = self.orders[0]
+        if order.alive() and self.broker.stop_linked:  # Если стоп заявка сработала
+            self.cancel(order)
+
+    def on_order(self, order):
+        if order.status == order.Canceled:
+            self.env.runstop()
+
+
+class FillStop(Orders):
+    """Стоп заявка на покупку ниже рынка срабатывает, и выставленная по ней заявка сразу исполняется"""
+
+    def place(self):
+        price = self.data.close[0]
+        return self.buy(exectype=bt.Order.StopLimit, price=price * 0.999, plimit=price * 2, size=1)
+
+    def on_order(self, order):
+        if order.status == order.Completed:
+            self.env.runstop()
+
+
+class LateStopSimulator(QKSimulator):
+    """Симулятор, в котором заявка по сработавшей стоп заявке приходит без номера транзакции,
+    а событие по стоп заявке с номером этой заявки опаздывает на полсекунды"""
+
+    stop_trigger = False  # Выставляется заявка по сработавшей стоп заявке
+
+    def new_order(self, trans_id, *args):
+        return super().new_order(0 if self.stop_trigger else trans_id, *args)
+
+    def match_orders(self, *args):
+        self.stop_trigger = True
+        try:
+            return super().match_orders(*args)
+        finally:
+            self.stop_trigger = False
+
+    def callback(self, cmd, data, delay=0.0):
+        if cmd == 'OnStopOrder' and data['data'].get('linkedorder'):
+            delay = 0.5
+        return super().callback(cmd, data, delay)
+
+
+def run_orders(store, strategy, **kwargs):
+    """Запуск торговой системы с брокером QUIK по фьючерсу SPBFUT.SiZ4
+
+    :return: Торговая система, Брокер
+    """
+    cerebro = bt.Cerebro(stdstats=False)
+    broker = store.getbroker(use_positions=False, **kwargs)
+    cerebro.setbroker(broker)
+    cerebro.adddata(store.getdata(dataname='SPBFUT.SiZ4', timeframe=bt.TimeFrame.Minutes, compression=1, live=True))
+    cerebro.addstrategy(strategy)
+    return run(cerebro), broker
+
+
+@pytest.fixture
+def actions(simulator):
+    """Транзакции, отправленные в симулятор: (Действие, Номер снимаемой заявки)"""
+    sent = []
+    send_transaction = simulator.SendTransaction
+
+    def record(transaction):
+        sent.append((transaction['ACTION'], transaction.get('ORDER_KEY') or transaction.get('STOP_ORDER_KEY')))
+        return send_transaction(transaction)
+
+    simulator.SendTransaction = record
+    return sent
+
+
+def test_market_round_trip(new_store, simulator):
+    """Рыночная заявка исполняется по последней цене, позиция открывается и закрывается"""
+    strategy, broker = run_orders(new_store(simulator), RoundTrip)
+    assert len(strategy.orders) == 2
+    closes = [candle[4] for candle in make_candles(520)]
+    for order in strategy.orders:
+        assert strategy.statuses[order.ref] == ['Submitted', 'Accepted', 'Completed']
+        assert abs(order.executed.size) == 2
+        assert min(abs(order.executed.price - close) for close in closes) == pytest.approx(0)  # По цене одной из свечей
+    assert broker.getposition(strategy.data).size == 0
+
+
+def test_cancel_stop(new_store, simulator, actions):
+    """Не сработавшая стоп заявка снимается как стоп заявка"""
+    strategy, broker = run_orders(new_store(simulator), CancelStop)
+    order = strategy.orders[0]
+    assert strategy.statuses[order.ref][-1] == 'Canceled'
+    assert actions[-1] == ('KILL_STOP_ORDER', str(order.info['stop_order_num']))
+    assert not simulator.stop_orders
+    assert not broker.qk_stop_orders
+
+
+def test_cancel_linked_order(new_store, simulator, actions):
+    """После срабатывания стоп заявки снимается выставленная по ней заявка"""
+    strategy, broker = run_orders(new_store(simulator), CancelLinked)
+    order = strategy.orders[0]
+    assert strategy.statuses[order.ref][-1] == 'Canceled'
+    action, order_num = actions[-1]
+    assert action == 'KILL_ORDER'
+    assert not simulator.orders[int(order_num)]['flags'] & 1  # Выставленная по стоп заявке заявка снята
+    assert not any(qk_order['flags'] & 1 for qk_order in simulator.orders.values())
+    assert not broker.stop_linked
+
+
+def test_stop_fill_without_trans_id(new_store):
+    """Сделка заявки по стоп заявке без номера транзакции не теряется, если событие по стоп заявке опоздало"""
+    simulator = LateStopSimulator(live_bars=60, bar_period=0.05)  # Уведомления о заявках приходят с новыми барами
+    simulator.add_candles('SPBFUT', 'SiZ4', 1, make_candles(560))
+    strategy, broker = run_orders(new_store(simulator), FillStop, fill_timeout=0.2)
+    order = strategy.orders[0]
+    assert strategy.statuses[order.ref][-1] == 'Completed'
+    assert order.executed.size == 1
+    assert not broker.pending_fills
+    assert not broker.qk_stop_orders
+    assert not broker.stop_linked
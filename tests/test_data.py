@@ -0,0 +1,70 @@
+from datetime import datetime
+
+import backtrader as bt
+import pytest
+
+from conftest import make_candles, run
+from BackTraderQuik.QKSimulator import QKSimulator
+
+
+class Collect(bt.Strategy):
+    """Запись баров и статусов данных. Останавливается после live_bars новых баров"""
+    params = (('live_bars', 0),)
+
+    def __init__(self):
+        self.bars = []  # (Дата/время, Цена закрытия)
+        self.statuses = []  # Статусы данных
+        self.live = 0  # Кол-во баров, пришедших в статусе LIVE
+
+    def notify_data(self, data, status, *args, **kwargs):
+        self.statuses.append(data._getstatusname(status))
+
+    def next(self):
+        self.bars.append((bt.num2date(self.data.datetime[0]), self.data.close[0]))
+        if self.data._laststatus == self.data.LIVE:
+            self.live += 1
+            if self.live >= self.p.live_bars:
+                self.env.runstop()
+
+
+def test_history_load(new_store):
+    """История загружается целиком, по порядку и с теми же ценами"""
+    candles = make_candles(600)
+    simulator = QKSimulator()
+    simulator.add_candles('TQBR', 'SBER', 1, candles)
+    store = new_store(simulator)
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.adddata(store.getdata(dataname='TQBR.SBER', timeframe=bt.TimeFrame.Minutes, compression=1, live=False))
+    cerebro.addstrategy(Collect)
+    strategy = run(cerebro)
+    assert [dt for dt, _ in strategy.bars] == [candle[0] for candle in candles]
+    assert [close for _, close in strategy.bars] == pytest.approx([candle[4] for candle in candles])
+
+
+def test_history_between_dates(new_store):
+    """Из истории выдаются только бары от fromdate до todate"""
+    simulator = QKSimulator()
+    simulator.add_candles('TQBR', 'SBER', 1, make_candles(600))
+    store = new_store(simulator)
+    cerebro = bt.Cerebro(stdstats=False)
+    fromdate, todate = datetime(2024, 1, 10, 12, 0), datetime(2024, 1, 10, 13, 0)
+    cerebro.adddata(store.getdata(dataname='TQBR.SBER', timeframe=bt.TimeFrame.Minutes, compression=1, live=False,
+                                  fromdate=fromdate, todate=todate))
+    cerebro.addstrategy(Collect)
+    strategy = run(cerebro)
+    assert strategy.bars[0][0] == fromdate
+    assert strategy.bars[-1][0] == todate
+    assert len(strategy.bars) == 61
+
+
+def test_live_bars(new_store, simulator):
+    """После истории новые бары приходят по подписке в статусе LIVE без пропусков и повторов"""
+    store = new_store(simulator)
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.adddata(store.getdata(dataname='SPBFUT.SiZ4', timeframe=bt.TimeFrame.Minutes, compression=1, live=True))
+    cerebro.addstrategy(Collect, live_bars=10)
+    strategy = run(cerebro)
+    assert strategy.statuses[:3] == ['NOTSUBSCRIBED', 'DELAYED', 'LIVE']
+    assert strategy.live == 10
+    dts = [dt for dt, _ in strategy.bars]
+    assert dts == [candle[0] for candle in make_candles(len(dts))]  # История и новые бары идут подряд, без пропусков и повторов